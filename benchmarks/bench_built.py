@@ -0,0 +1,66 @@
+"""
+Build time of ``$`` queries with a growing number of optional clauses.
+
+Compares the compiled clause table (:class:`sqlpy.sqlpy.BuiltQuery`) against the
+list scan / substring based builder it replaced. The built SQL cache is bypassed so
+only the assembly is measured.
+
+    $ python benchmarks/bench_built.py
+"""
+from __future__ import print_function, absolute_import
+import timeit
+from sqlpy.sqlpy import BuiltQuery
+from bench_scanner import legacy_parse_args as parse_args
+
+
+def legacy_build(in_arr, keys):
+    """The builder used before the clause table, kept for comparison."""
+    query_arr = []
+    query_dict = {'#': []}
+    arg_offset = 0
+    for i, line in enumerate(in_arr):
+        args = parse_args(line)
+        if not args:
+            query_arr.append({'#': {'idx': i + arg_offset, 'query_line': line}})
+            query_dict['#'].append(i + arg_offset)
+            continue
+        arg = args.pop()
+        query_arr.append({arg: {'idx': i + arg_offset, 'query_line': line}})
+        query_dict[arg] = i + arg_offset
+
+    def build():
+        query_built = ''
+        query_built_arr = list(query_arr[idx]['#'] for idx in query_dict['#'])
+        for key in keys:
+            arg_idx = query_dict.get(key)
+            if arg_idx and query_arr[arg_idx][key] not in query_built_arr:
+                query_built_arr.append(query_arr[arg_idx][key])
+                parse_args(query_arr[arg_idx][key]['query_line'])
+        for q in sorted(query_built_arr, key=lambda x: x.get('idx')):
+            if q.get('query_line') not in query_built:
+                query_built = "{}\n{}".format(query_built, q.get('query_line'))
+        return query_built
+    return build
+
+
+def make_lines(n_clauses):
+    lines = ['SELECT * FROM testdb', 'WHERE 1=1']
+    lines.extend('AND col_{0} = %(arg_{0})s'.format(i) for i in range(n_clauses))
+    return lines
+
+
+def main(repeat=5, number=200):
+    print('{:>8} {:>14} {:>14} {:>8}'.format('clauses', 'legacy (us)', 'compiled (us)', 'speedup'))
+    for n_clauses in (50, 100, 250, 500):
+        lines = make_lines(n_clauses)
+        # supply every second argument
+        keys = frozenset('arg_{}'.format(i) for i in range(0, n_clauses, 2))
+        built = BuiltQuery(lines)
+        legacy = legacy_build(lines, keys)
+        t_legacy = min(timeit.repeat(legacy, repeat=repeat, number=number)) / number * 1e6
+        t_built = min(timeit.repeat(lambda: built.build(keys), repeat=repeat, number=number)) / number * 1e6
+        print('{:>8} {:>14.1f} {:>14.1f} {:>7.1f}x'.format(n_clauses, t_legacy, t_built, t_legacy / t_built))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""
+Encoding throughput of the ``copy=True`` bulk load, writing to an in-memory sink, in the
+CSV and binary ``COPY`` formats. The rows are generated lazily, so memory stays flat no
+matter the row count.
+
+    $ python benchmarks/bench_copy.py
+"""
+from __future__ import print_function, absolute_import
+import datetime
+import io
+from sqlpy.bulk import write_copy
+
+
+def rows(n):
+    day = datetime.date(2020, 1, 1)
+    for i in range(n):
+        yield (i, 'user {}'.format(i), i * 0.5, i % 2 == 0, day)
+
+
+def main(n=200000):
+    for copy_format in ('csv', 'binary'):
+        sink = io.BytesIO()
+        result = write_copy(rows(n), sink, copy_format)
+        print('{:<7} {:>9} rows {:>11} bytes {:8.3f}s {:>10.0f} rows/s'
+              .format(copy_format, result.rows, result.bytes, result.duration, result.rows_per_second))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""
+Per call overhead of a prepared function over calling the cursor directly, with logging
+disabled and no hooks registered, against a registered no-op hook, metrics, and INFO
+logging to a null handler.
+
+The cursor does no work, so the times are the cost of sqlpy alone.
+
+    $ python benchmarks/bench_overhead.py
+"""
+from __future__ import print_function, absolute_import
+import logging
+import os
+import shutil
+import tempfile
+import timeit
+from sqlpy import Queries
+
+
+class NullCursor(object):
+    def execute(self, query, args):
+        pass
+
+    def fetchall(self):
+        return []
+
+
+def main(repeat=5, number=100000):
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'queries.sql')
+        with open(path, 'w') as queries_file:
+            queries_file.write('-- name: select_one\nSELECT * FROM hello WHERE id = %s')
+        cur = NullCursor()
+        args = (1,)
+        sql = Queries(path)
+        sql_metrics = Queries(path, metrics=True)
+        sql_hooked = Queries(path)
+        sql_hooked.add_hook('after_execute', lambda event: None)
+        fn = sql.SELECT_ONE
+        query = fn.__query__
+
+        def direct():
+            cur.execute(query, args)
+            return cur.fetchall()
+
+        def per_call(call):
+            return min(timeit.repeat(call, repeat=repeat, number=number)) / number * 1e6
+
+        logging.getLogger('sqlpy').setLevel(logging.WARNING)
+        t_direct = per_call(direct)
+        rows = [('cursor directly', t_direct),
+                ('no hooks, logging off', per_call(lambda: fn(cur, args))),
+                ('no-op hook', per_call(lambda: sql_hooked.SELECT_ONE(cur, args))),
+                ('metrics', per_call(lambda: sql_metrics.SELECT_ONE(cur, args)))]
+        logger = logging.getLogger('sqlpy')
+        logger.setLevel(logging.INFO)
+        logger.addHandler(logging.NullHandler())
+        logger.propagate = False
+        rows.append(('INFO logging', per_call(lambda: fn(cur, args))))
+        print('{:<24} {:>10} {:>12}'.format('', 'us/call', 'overhead us'))
+        for label, t in rows:
+            print('{:<24} {:>10.2f} {:>12.2f}'.format(label, t, t - t_direct))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
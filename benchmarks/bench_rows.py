@@ -0,0 +1,45 @@
+"""
+Memory per row and construction time of each ``row_type``, converting the same fetched
+rows of a four column query. The memory is that of the row objects alone, the column
+values are shared by every type.
+
+    $ python benchmarks/bench_rows.py
+"""
+from __future__ import print_function, absolute_import
+import gc
+import timeit
+import tracemalloc
+from sqlpy.rows import ROW_TYPES, make_converter
+
+NAMES = ('id', 'name', 'score', 'active')
+
+
+def fetched(n):
+    names = ['user {}'.format(i) for i in range(n)]
+    # lists, so the tuple type pays its conversion too
+    return [[i, names[i], i * 0.5, i % 2 == 0] for i in range(n)]
+
+
+def row_bytes(convert, rows):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        converted = convert(rows)
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del converted
+    return used / float(len(rows))
+
+
+def main(n=100000, repeat=5):
+    rows = fetched(n)
+    for row_type in ROW_TYPES:
+        convert = make_converter(row_type, NAMES, 'Row')
+        seconds = min(timeit.repeat(lambda: convert(rows), repeat=repeat, number=1))
+        print('{:<11} {:8.1f} bytes/row {:8.3f}us/row'.format(row_type, row_bytes(convert, rows), seconds / n * 1e6))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Parameter scanning time of long generated SQL lines.
+
+Compares :func:`sqlpy.sqlpy.scan_params` and :func:`sqlpy.sqlpy.parse_args` built on it,
+against the character loop ``parse_args`` they replaced.
+
+    $ python benchmarks/bench_scanner.py
+"""
+from __future__ import print_function, absolute_import
+import timeit
+from sqlpy.exceptions import SQLParseException
+from sqlpy.sqlpy import parse_args, scan_params
+
+
+def legacy_parse_args(s):
+    """The character loop used before the scanner, kept for comparison."""
+    if '%(' not in s:
+        return None
+    arg_start = []
+    arg_end = []
+    out = set()
+    for ii, c in enumerate(s):
+        if c != '%' and c != ')':
+            continue
+        elif c == '%' and s[ii + 1] == '(':
+            arg_start.append(ii + 2)
+        elif c == ')' and False if ii + 1 == len(s) else s[ii + 1] == 's':
+            arg_end.append(ii)
+    if len(arg_start) != len(arg_end):
+        raise SQLParseException('parse error, arg numbers do not match in string s: ', s)
+    for i in range(len(arg_start)):
+        if arg_end[i] - arg_start[i] < 1:
+            raise SQLParseException('parse error, no argument found between (...): ', s)
+        out.add(s[arg_start[i]:arg_end[i]])
+    return out
+
+
+def make_line(n_params):
+    return 'SELECT * FROM testdb WHERE 1=1 ' + ' '.join(
+        "AND col_{0} = %(arg_{0})s AND note_{0} <> 'n/a'".format(i) for i in range(n_params))
+
+
+def main(repeat=5):
+    print('{:>8} {:>10} {:>12} {:>12} {:>14} {:>8}'.format(
+        'params', 'chars', 'legacy (us)', 'scan (us)', 'parse_args (us)', 'speedup'))
+    for n_params in (10, 100, 1000, 5000):
+        line = make_line(n_params)
+        number = max(5, 2000 // n_params)
+        assert legacy_parse_args(line) == parse_args(line)
+        t_legacy = min(timeit.repeat(lambda: legacy_parse_args(line), repeat=repeat, number=number)) / number * 1e6
+        t_scan = min(timeit.repeat(lambda: scan_params(line), repeat=repeat, number=number)) / number * 1e6
+        t_parse = min(timeit.repeat(lambda: parse_args(line), repeat=repeat, number=number)) / number * 1e6
+        print('{:>8} {:>10} {:>12.1f} {:>12.1f} {:>14.1f} {:>7.1f}x'.format(
+            n_params, len(line), t_legacy, t_scan, t_parse, t_legacy / t_parse))
+
+
+if __name__ == '__main__':
+    main()
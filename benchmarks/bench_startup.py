@@ -0,0 +1,48 @@
+"""
+Startup time of :class:`sqlpy.Queries` on a generated file of 10k queries, loading
+all of them eagerly against indexing them with ``lazy=True``.
+
+    $ python benchmarks/bench_startup.py
+"""
+from __future__ import print_function, absolute_import
+import os
+import shutil
+import tempfile
+import timeit
+from sqlpy import Queries
+
+TEMPLATES = [
+    '-- name: select_{0}\n-- select number {0}\nSELECT * FROM table_{0}\nWHERE id = %s;',
+    '-- name: insert_{0}!\nINSERT INTO table_{0} (a, b)\nVALUES (%(a)s, %(b)s);',
+    '-- name: built_{0}$\nSELECT * FROM table_{0}\nWHERE 1=1\nAND a = %(a)s\nAND b = %(b)s\nAND c = %(c)s',
+]
+
+
+def write_queries(path, n_queries):
+    with open(path, 'w') as queries_file:
+        queries_file.write('\n\n'.join(TEMPLATES[i % len(TEMPLATES)].format(i) for i in range(n_queries)))
+
+
+def main(n_queries=10000, repeat=3):
+    tmp = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp, 'queries.sql')
+        write_queries(path, n_queries)
+        t_eager = min(timeit.repeat(lambda: Queries(path), repeat=repeat, number=1))
+        t_lazy = min(timeit.repeat(lambda: Queries(path, lazy=True), repeat=repeat, number=1))
+
+        def use_five():
+            sql = Queries(path, lazy=True)
+            for name in sql.available_queries[:5]:
+                getattr(sql, name)
+        t_lazy_use = min(timeit.repeat(use_five, repeat=repeat, number=1))
+        print('{} queries'.format(n_queries))
+        print('{:<28} {:>8.1f} ms'.format('eager load', t_eager * 1e3))
+        print('{:<28} {:>8.1f} ms'.format('lazy load', t_lazy * 1e3))
+        print('{:<28} {:>8.1f} ms'.format('lazy load + use 5 queries', t_lazy_use * 1e3))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
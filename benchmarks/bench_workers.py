@@ -0,0 +1,48 @@
+"""
+Load time of :class:`sqlpy.Queries` on a generated directory of SQL files, parsing
+serially against ``workers=N`` processes, to place ``sqlpy.config.WORKERS_MIN_SIZE``.
+The pool is only used with several cores.
+
+    $ python benchmarks/bench_workers.py
+"""
+from __future__ import print_function, absolute_import
+import multiprocessing
+import os
+import shutil
+import tempfile
+import timeit
+import sqlpy.sqlpy
+from sqlpy import Queries
+from bench_startup import TEMPLATES
+
+N_FILES = 200
+
+
+def write_queries_dir(path, n_queries, n_files=N_FILES):
+    per_file = n_queries // n_files
+    for f in range(n_files):
+        with open(os.path.join(path, 'queries_{:04d}.sql'.format(f)), 'w') as queries_file:
+            queries_file.write('\n\n'.join(TEMPLATES[i % len(TEMPLATES)].format(i)
+                                           for i in range(f * per_file, (f + 1) * per_file)))
+
+
+def main(repeat=3):
+    cpus = multiprocessing.cpu_count()
+    worker_counts = sorted(set([1, 2, 4, cpus]))
+    print('{} cpus, {} files'.format(cpus, N_FILES))
+    # measure the pool below the threshold too
+    sqlpy.sqlpy.WORKERS_MIN_SIZE = 0
+    print('{:>10} '.format('queries') + ' '.join('{:>12}'.format('workers={}'.format(w)) for w in worker_counts))
+    for n_queries in (1000, 10000, 50000):
+        tmp = tempfile.mkdtemp()
+        try:
+            write_queries_dir(tmp, n_queries)
+            times = [min(timeit.repeat(lambda: Queries(tmp, workers=workers), repeat=repeat, number=1))
+                     for workers in worker_counts]
+            print('{:>10} '.format(n_queries) + ' '.join('{:>9.1f} ms'.format(t * 1e3) for t in times))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
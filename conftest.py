@@ -0,0 +1,4 @@
+import sys
+
+# the asyncio API and its tests use async generators
+collect_ignore = ['test_sqlpy_aio.py'] if sys.version_info < (3, 6) else []
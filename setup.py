@@ -19,10 +19,14 @@ Links
 """
 from __future__ import print_function
 from setuptools import setup
+import io
 import os
+import re
 import sys
 
-VERSION = '0.3.5'
+# read rather than imported, the package needs its dependencies to import
+with io.open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sqlpy', 'config.py'), encoding='utf-8') as f:
+    VERSION = re.search(r"^VERSION = '([^']+)'", f.read(), re.M).group(1)
 
 if sys.argv[-1] == 'build':
     os.system("python setup.py bdist_wheel")
@@ -60,5 +64,6 @@ setup(
       'Programming Language :: Python :: 2',
       'Programming Language :: Python :: 3'
   ],
+  extras_require={'numpy': ['numpy'], 'pandas': ['numpy', 'pandas']},
   entry_points={'console_scripts': ['sqlpy=sqlpy:main']}
 )
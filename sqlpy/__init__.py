@@ -1,10 +1,17 @@
 from __future__ import print_function, absolute_import
 import logging
+import sys
+from .config import VERSION
 from .sqlpy import Queries, load_queries, parse_sql_entry, QueryType
+from .slowlog import SlowQueryLog
+from .cache import ResultCache
 from .exceptions import (SQLpyException, SQLLoadException,
                          SQLParseException, SQLArgumentException)
+if sys.version_info >= (3, 6):
+    from .aio import AsyncQueries, AsyncCursorAdapter
 
 
+__version__ = VERSION
 __description__ = 'Write actual SQL to retrieve your data.'
 
 # add default NullHandler to avoid "No handler found" warnings.
@@ -16,8 +23,13 @@ __all__ = [
     'load_queries',
     'parse_sql_entry',
     'QueryType',
+    'SlowQueryLog',
+    'ResultCache',
     'SQLpyException',
     'SQLLoadException',
     'SQLParseException',
     'SQLArgumentException'
 ]
+
+if sys.version_info >= (3, 6):
+    __all__ += ['AsyncQueries', 'AsyncCursorAdapter']
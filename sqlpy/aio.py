@@ -0,0 +1,435 @@
+"""
+Asyncio counterpart of :class:`sqlpy.Queries`, requires Python 3.6+.
+
+The SQL files are parsed exactly as for :class:`sqlpy.Queries`, only the prepared
+functions differ. They are ``async def`` functions awaiting the cursor through an
+:class:`AsyncCursorAdapter`.
+"""
+from __future__ import print_function, absolute_import
+from functools import partial
+from timeit import default_timer as timer
+import logging
+from .config import extensions, quote_ident, STREAM_BATCH_SIZE, IDENTIFIERS_CACHE_SIZE, DEFAULT_CONFIG, QueryType
+from .exceptions import SQLpyException
+from .rows import RowFactory, check_row_type
+from .sqlpy import (Queries, LRUCache, check_fetch_args, format_query_identifiers, log_query,
+                    prepare_built_query)
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+
+class AsyncCursorAdapter(object):
+    """
+    Adapts an asyncio DB API cursor to the calls made by the :class:`AsyncQueries` functions.
+
+    The default implementation awaits the cursor methods of the same name, as provided by
+    aiopg, aiomysql, aiosqlite and psycopg 3 async cursors. Subclass it for drivers with a
+    different API.
+    """
+    async def execute(self, cur, query, args):
+        await cur.execute(query, args)
+
+    async def executemany(self, cur, query, args):
+        await cur.executemany(query, args)
+
+    async def callproc(self, cur, procname, args):
+        await cur.callproc(procname, args)
+
+    async def fetchall(self, cur):
+        return await cur.fetchall()
+
+    async def fetchone(self, cur):
+        return await cur.fetchone()
+
+    async def fetchmany(self, cur, size):
+        return await cur.fetchmany(size)
+
+    def quote_ident(self, ident, cur):
+        """
+        Safely quotes an identifier, used to format ``identifiers`` into the query.
+
+        Supported for psycopg2 based cursors, such as aiopg, exposing the psycopg2 cursor
+        as ``cur.raw``.
+        """
+        if not quote_ident:
+            raise SQLpyException('"quote_ident" is not supported')
+        return extensions.quote_ident(ident, getattr(cur, 'raw', cur))
+
+
+async def fetch_results(adapter, cur, n=None, stream=False, batch_size=None, metrics=None, started=0, executing=0,
+                        convert=None):
+    """
+    Helper function to avoid repeating the result fetching block, ``convert`` converts
+    a list of fetched rows as for :func:`sqlpy.sqlpy.fetch_results`
+
+    Returns:
+        The rows, a single row for ``n=1``, or an async generator of rows when streaming
+    """
+    if metrics is not None:
+        executed = timer()
+    if stream:
+        if metrics is not None:
+            metrics.record(started, executing, executed)
+        return iter_results(adapter, cur, batch_size or STREAM_BATCH_SIZE, metrics, convert)
+    try:
+        if not n:
+            rows = await adapter.fetchall(cur)
+        elif n == 1:
+            rows = await adapter.fetchone(cur)
+        else:
+            rows = await adapter.fetchmany(cur, n)
+        if convert is not None:
+            if n == 1:
+                rows = convert([rows])[0] if rows is not None else None
+            else:
+                rows = convert(rows)
+    except Exception:
+        if metrics is not None:
+            metrics.record_error()
+        raise
+    if metrics is not None:
+        metrics.record(started, executing, executed, timer(),
+                       int(rows is not None) if n == 1 else len(rows) if rows else 0)
+    return rows
+
+
+async def iter_results(adapter, cur, batch_size, metrics=None, convert=None):
+    """
+    Yields the rows of an executed query, fetching ``batch_size`` rows at a time and
+    converting each batch with ``convert``.
+    """
+    fetch_time = 0
+    count = 0
+    try:
+        while True:
+            if metrics is not None:
+                fetching = timer()
+                try:
+                    rows = await adapter.fetchmany(cur, batch_size)
+                except Exception:
+                    metrics.record_error(call=False)
+                    raise
+                fetch_time += timer() - fetching
+                count += len(rows)
+            else:
+                rows = await adapter.fetchmany(cur, batch_size)
+            if not rows:
+                return
+            if convert is not None:
+                rows = convert(rows)
+            for row in rows:
+                yield row
+    finally:
+        if metrics is not None:
+            metrics.record_fetch(fetch_time, count)
+
+
+async def fetch_rows(adapter, cur, query, rows):
+    """
+    Executes a ``RETURNING`` query once per row, as ``executemany`` does not keep the
+    rows returned by each statement.
+
+    Returns:
+        :obj:`list`: the rows returned by every execution
+    """
+    returned = []
+    for row in rows:
+        await adapter.execute(cur, query, row)
+        returned.extend(await adapter.fetchall(cur))
+    return returned
+
+
+def check_options(kwargs):
+    """
+    Helper function rejecting the :class:`sqlpy.Queries` function options, such as
+    ``prepare``, ``copy`` or ``server_side``, which the :class:`AsyncQueries` functions
+    do not support, instead of silently ignoring them.
+
+    Raises:
+        SQLpyException: When an unsupported option is set.
+    """
+    unsupported = sorted(key for key, value in kwargs.items() if value)
+    if unsupported:
+        raise SQLpyException('"{}" is not supported by AsyncQueries'.format(unsupported[0]))
+
+
+class AsyncQueryFnFactory:
+    @staticmethod
+    def make_query(query, built, sql_type, name, doc, adapter, metrics=None, hooks=None, config=DEFAULT_CONFIG):
+        # the settings are bound as defaults, so each AsyncQueries object keeps its own
+        log_query_params_default = config.log_query_params
+        strict_parse = config.strict_parse
+        row_type_default = config.row_type
+        row_factory = RowFactory(name)
+        identifiers_cache = LRUCache(IDENTIFIERS_CACHE_SIZE)
+
+        if sql_type == QueryType.INSERT_UPDATE_DELETE:
+            async def fn(query, cur, args=tuple(), many=None, identifiers=None, log_query_params=log_query_params_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_options(kwargs)
+                if identifiers:
+                    query = format_query_identifiers(query, identifiers, adapter.quote_ident, cur, identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query, args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, cur, log_query_params, bool(many),
+                                                 aio=True)
+                try:
+                    if many:
+                        await adapter.executemany(cur, query, args)
+                    else:
+                        await adapter.execute(cur, query, args)
+                except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
+                    logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
+                                 .format(type(e), name, query), exc_info=True)
+                    raise
+                else:
+                    if event is not None:
+                        hooks.after_execute(event)
+                    if metrics is not None:
+                        metrics.record(started, executing, timer())
+                    return True
+
+            fn_partial = partial(fn, query)
+
+        elif sql_type == QueryType.RETURN_ID:
+            async def fn(query, cur, args=tuple(), n=None, many=None, identifiers=None, log_query_params=log_query_params_default,
+                         stream=False, batch_size=None, row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_options(kwargs)
+                check_fetch_args(n, stream, batch_size)
+                check_row_type(row_type)
+                if many and stream:
+                    raise SQLpyException('"stream" can not be used with "many" by AsyncQueries')
+                if identifiers:
+                    query = format_query_identifiers(query, identifiers, adapter.quote_ident, cur, identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query, args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, cur, log_query_params, bool(many),
+                                                 aio=True)
+                returned = None
+                try:
+                    if many:
+                        returned = await fetch_rows(adapter, cur, query, args)
+                    else:
+                        await adapter.execute(cur, query, args)
+                except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
+                    logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
+                                 .format(type(e), name, query), exc_info=True)
+                    raise
+                else:
+                    if event is not None:
+                        hooks.after_execute(event)
+                    convert = partial(row_factory.convert, cur, row_type) if row_type is not None else None
+                    if many:
+                        if metrics is not None:
+                            metrics.record(started, executing, timer(), rows=len(returned))
+                        if convert is not None:
+                            returned = convert(returned)
+                        if n == 1:
+                            return returned[0] if returned else None
+                        return returned[:n] if n else returned
+                    return await fetch_results(adapter, cur, n, stream, batch_size, metrics, started, executing,
+                                               convert)
+
+            fn_partial = partial(fn, query)
+
+        elif sql_type == QueryType.CALL_PROC:
+            async def fn(query, cur, args=tuple(), n=None, identifiers=None, log_query_params=log_query_params_default,
+                         stream=False, batch_size=None, row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_options(kwargs)
+                check_fetch_args(n, stream, batch_size)
+                check_row_type(row_type)
+                if identifiers:
+                    query = format_query_identifiers(query, identifiers, adapter.quote_ident, cur, identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query, args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, cur, log_query_params, aio=True)
+                try:
+                    await adapter.callproc(cur, query, args)
+                except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
+                    logger.error('Exception Type "{}" raised, on executing procedure "{}"\n____\n{}\n____'
+                                 .format(type(e), name, query), exc_info=True)
+                    raise
+                else:
+                    if event is not None:
+                        hooks.after_execute(event)
+                    convert = partial(row_factory.convert, cur, row_type) if row_type is not None else None
+                    return await fetch_results(adapter, cur, n, stream, batch_size, metrics, started, executing,
+                                               convert)
+
+            fn_partial = partial(fn, query)
+
+        elif sql_type == QueryType.SELECT:
+            async def fn(query, cur, args=tuple(), n=None, identifiers=None, log_query_params=log_query_params_default,
+                         stream=False, batch_size=None, row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_options(kwargs)
+                check_fetch_args(n, stream, batch_size)
+                check_row_type(row_type)
+                if identifiers:
+                    query = format_query_identifiers(query, identifiers, adapter.quote_ident, cur, identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query, args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, cur, log_query_params, aio=True)
+                try:
+                    await adapter.execute(cur, query, args)
+                except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
+                    logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
+                                 .format(type(e), name, query), exc_info=True)
+                    raise
+                else:
+                    if event is not None:
+                        hooks.after_execute(event)
+                    convert = partial(row_factory.convert, cur, row_type) if row_type is not None else None
+                    return await fetch_results(adapter, cur, n, stream, batch_size, metrics, started, executing,
+                                               convert)
+
+            fn_partial = partial(fn, query)
+
+        elif sql_type == QueryType.SELECT_BUILT:
+            async def fn(query, built, built_cache, cur, args=dict(), n=None, identifiers=None,
+                         log_query_params=log_query_params_default, stream=False, batch_size=None,
+                         row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_options(kwargs)
+                check_fetch_args(n, stream, batch_size)
+                check_row_type(row_type)
+                query_built = prepare_built_query(built, built_cache, args, strict_parse)
+                if identifiers:
+                    query_built = format_query_identifiers(query_built, identifiers, adapter.quote_ident, cur,
+                                                           identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query_built, args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query_built, args, cur, log_query_params,
+                                                 aio=True)
+                try:
+                    await adapter.execute(cur, query_built, args)
+                except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
+                    logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
+                                 .format(type(e), name, query_built), exc_info=True)
+                    raise
+                else:
+                    if event is not None:
+                        hooks.after_execute(event)
+                    convert = partial(row_factory.convert, cur, row_type) if row_type is not None else None
+                    return await fetch_results(adapter, cur, n, stream, batch_size, metrics, started, executing,
+                                               convert)
+
+            built_cache = LRUCache(config.built_cache_size)
+            fn_partial = partial(fn, query, built, built_cache)
+            fn_partial.__built__ = built
+            fn_partial.__built_cache__ = built_cache
+
+        fn_partial.__doc__ = doc
+        fn_partial.__query__ = query
+        fn_partial.__sql_type__ = sql_type
+        fn_partial.__row_factory__ = row_factory
+        fn_partial.__identifiers_cache__ = identifiers_cache
+        fn_partial.__name__ = name
+        fn_partial.func_name = name
+
+        return fn_partial
+
+
+class AsyncQueries(Queries):
+    """
+    Builds awaitable prepared functions of SQL statements for execution.
+
+    Takes the same arguments as :class:`sqlpy.Queries`, the functions are called in the same
+    way but must be awaited, and take an asyncio cursor. With ``stream=True`` the awaited
+    result is an async generator of rows.
+
+    Args:
+        adapter (:class:`AsyncCursorAdapter`, optional): Adapter awaiting the cursor calls,
+            defaults to :class:`AsyncCursorAdapter`.
+
+    Raises:
+        SQLpyException: When given a ``result_cache``, which is not supported.
+    """
+    def __init__(self, filepath, adapter=None, **kwargs):
+        if kwargs.get('result_cache') is not None:
+            raise SQLpyException('"result_cache" is not supported by AsyncQueries')
+        self.adapter = adapter or AsyncCursorAdapter()
+        super(AsyncQueries, self).__init__(filepath, **kwargs)
+
+    def __repr__(self):
+        """
+        Prints a list of available SQL statement function by name.
+        """
+        return "sqlpy.AsyncQueries(" + self.available_queries.__repr__() + ")"
+
+    def bind(self, pool, commit=True, name='default'):
+        """
+        Not supported, the functions of :meth:`sqlpy.Queries.bind` end the transaction
+        and give back the connection before an awaitable function has run.
+
+        Raises:
+            SQLpyException: Always.
+        """
+        raise SQLpyException('"bind" is not supported by AsyncQueries')
+
+    def batch(self, cur, mode=None):
+        """
+        Not supported, the calls of a :meth:`sqlpy.Queries.batch` are executed without
+        being awaited.
+
+        Raises:
+            SQLpyException: Always.
+        """
+        raise SQLpyException('"batch" is not supported by AsyncQueries')
+
+    def make_query(self, definition):
+        """
+        Creates the awaitable prepared function of a parsed SQL statement.
+
+        Args:
+            definition (:class:`sqlpy.sqlpy.SQLDefinition`)
+
+        Returns:
+            :obj:`functools.partial`
+        """
+        return AsyncQueryFnFactory.make_query(definition.query, definition.built, definition.sql_type,
+                                              definition.name, definition.doc, self.adapter,
+                                              self.query_metrics(definition), self._hooks, self.config)
@@ -0,0 +1,305 @@
+"""
+Batches of SQL statement function calls sent together, created with
+:meth:`sqlpy.Queries.batch`.
+
+The calls made on a :class:`QueryBatch` are queued, each returning a :class:`BatchResult`,
+and executed when the batch exits. Depending on the driver they are sent as
+
+- ``'pipeline'``: psycopg 3 pipeline mode, one cursor per call, one round trip
+- ``'multi'``: a single multi-statement ``execute`` of the client side bound queries, with
+  ``nextset()`` moving to the result of the next call, for drivers with ``mogrify`` and
+  ``nextset`` such as PyMySQL
+- ``'sequential'``: one call after the other, on any driver
+"""
+from __future__ import print_function, absolute_import
+import logging
+from functools import partial
+from timeit import default_timer as timer
+from .config import QueryType, extensions, quote_ident
+from .exceptions import SQLpyException
+from .rows import check_row_type
+from .sqlpy import check_fetch_args, fetch_results, format_query_identifiers, prepare_built_query
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+#: The ways a batch can be executed, see :func:`batch_mode`
+BATCH_MODES = ('pipeline', 'multi', 'sequential')
+
+# the call arguments supported by every mode, the others need a dedicated execution,
+# batched calls always execute, without the result cache
+_BATCH_OPTIONS = ('args', 'n', 'identifiers', 'log_query_params', 'row_type', 'cache_ttl')
+
+_NOT_EXECUTED = object()
+
+
+def batch_mode(cur):
+    """
+    Picks how a batch is executed on ``cur``.
+
+    Returns:
+        :obj:`str`: ``'pipeline'`` when the connection has a ``pipeline()`` method,
+            ``'multi'`` when the cursor has ``mogrify`` and a working ``nextset``, else
+            ``'sequential'``
+    """
+    if hasattr(getattr(cur, 'connection', None), 'pipeline'):
+        return 'pipeline'
+    # psycopg2 cursors have a nextset which always raises NotSupportedError
+    psycopg2_cursor = quote_ident is not None and isinstance(cur, extensions.cursor)
+    if hasattr(cur, 'mogrify') and hasattr(cur, 'nextset') and not psycopg2_cursor:
+        return 'multi'
+    return 'sequential'
+
+
+def end_statement(statement):
+    """
+    Helper function preparing a statement to be joined with others by ``;``.
+
+    Strips the trailing ``;`` and whitespace of ``statement``, and ends a trailing ``--``
+    line comment with a newline so that it does not comment out the next statement.
+
+    Args:
+        statement (:obj:`str` or :obj:`bytes`): the mogrified statement
+
+    Returns:
+        The statement, of the same type
+    """
+    newline, semicolon, comment = ((b'\n', b';', b'--') if isinstance(statement, bytes) and bytes is not str
+                                   else ('\n', ';', '--'))
+    statement = statement.rstrip().rstrip(semicolon).rstrip()
+    if comment in statement.rsplit(newline, 1)[-1]:
+        statement += newline
+    return statement
+
+
+class BatchResult(object):
+    """
+    The deferred result of a call queued on a :class:`QueryBatch`, available once the
+    batch is executed.
+    """
+    __slots__ = ('name', '_value')
+
+    def __init__(self, name):
+        self.name = name
+        self._value = _NOT_EXECUTED
+
+    @property
+    def done(self):
+        return self._value is not _NOT_EXECUTED
+
+    def get(self):
+        """
+        Returns:
+            the result of the call, as returned by the function when called directly
+
+        Raises:
+            SQLpyException: When the batch has not been executed, or failed.
+        """
+        if self._value is _NOT_EXECUTED:
+            raise SQLpyException('The batch of "{}" has not been executed'.format(self.name))
+        return self._value
+
+    value = property(get)
+
+    def __repr__(self):
+        return 'BatchResult({}, {})'.format(self.name, repr(self._value) if self.done else 'pending')
+
+
+class BatchCall(object):
+    __slots__ = ('name', 'sql_type', 'fn', 'args', 'kwargs', 'result', 'query', 'query_args', 'event')
+
+    def __init__(self, name, fn, args, kwargs):
+        self.name = name
+        self.sql_type = fn.__sql_type__
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = BatchResult(name)
+        self.query = None
+        self.query_args = None
+        self.event = None
+
+
+class QueryBatch(object):
+    """
+    Queues calls of the SQL statement functions of a :class:`sqlpy.Queries` object, to
+    execute them together on one cursor.
+
+    Functions are called on the batch as they would be on the queries object, without
+    the cursor. Calls of ``@`` queries, or with options other than ``n``, ``identifiers``,
+    ``log_query_params`` and ``row_type``, raise.
+
+    Args:
+        queries (:class:`sqlpy.Queries`): the queries called
+        cur (:obj:`cursor`): the cursor the batch is executed on
+        mode (:obj:`str`, optional): one of :data:`BATCH_MODES`, picked by
+            :func:`batch_mode` by default
+    """
+    def __init__(self, queries, cur, mode=None):
+        if mode is not None and mode not in BATCH_MODES:
+            raise SQLpyException('"mode" must be one of {}'.format(', '.join(BATCH_MODES)))
+        self._queries = queries
+        self._cur = cur
+        self.mode = mode or batch_mode(cur)
+        self._calls = []
+        self._executed = False
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._queries.available_queries:
+            raise AttributeError(name)
+
+        def fn(*args, **kwargs):
+            return self._queue(name, args, kwargs)
+        fn.__name__ = str(name)
+        self.__dict__[name] = fn
+        return fn
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # a failing block discards its calls
+        if exc_type is None:
+            self.execute()
+        return False
+
+    def _queue(self, name, args, kwargs):
+        if self._executed:
+            raise SQLpyException('The batch has already been executed')
+        fn = getattr(self._queries, name)
+        sql_type = fn.__sql_type__
+        if sql_type == QueryType.CALL_PROC:
+            raise SQLpyException('"{}" is a procedure, which can not be batched'.format(name))
+        # query_options defaults are bound as partial keywords, the call overrides them
+        options = dict(getattr(fn, 'keywords', None) or {})
+        options.update(kwargs)
+        unsupported = sorted(key for key, value in options.items() if key not in _BATCH_OPTIONS and value)
+        if unsupported:
+            raise SQLpyException('"{}" can not be used in a batch'.format(unsupported[0]))
+        if len(args) > 1:
+            raise SQLpyException('Batched calls take the query arguments only, as "args"')
+        check_fetch_args(options.get('n'), False, None)
+        check_row_type(options.get('row_type'))
+        call = BatchCall(name, fn, args, options)
+        self._calls.append(call)
+        return call.result
+
+    def execute(self):
+        """
+        Executes the queued calls, done on exit of a ``with`` block.
+
+        Raises:
+            SQLpyException: When the batch has already been executed.
+        """
+        if self._executed:
+            raise SQLpyException('The batch has already been executed')
+        self._executed = True
+        if not self._calls:
+            return
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('Executing batch of {} queries ({}): {}'.format(
+                len(self._calls), self.mode, ', '.join(call.name for call in self._calls)))
+        if self.mode == 'sequential':
+            for call in self._calls:
+                call.result._value = call.fn(self._cur, *call.args, **call.kwargs)
+            return
+        started = timer()
+        for call in self._calls:
+            self._prepare(call)
+        events = self._before_execute()
+        try:
+            if self.mode == 'pipeline':
+                self._execute_pipeline(started)
+            else:
+                self._execute_multi(started)
+        except Exception as e:
+            # the calls whose result was already fetched succeeded
+            for call in self._calls:
+                if call.result.done:
+                    continue
+                metrics = self._queries.query_metrics(call)
+                if metrics is not None:
+                    metrics.record_error()
+                if call.event is not None:
+                    events.on_error(call.event, e)
+            logger.error('Exception Type "{}" raised, on executing batch of queries {}'
+                         .format(type(e), ', '.join(call.name for call in self._calls)), exc_info=True)
+            raise
+
+    def _prepare(self, call):
+        """Builds the SQL and arguments of a call, as its function would"""
+        fn = call.fn
+        args = call.args[0] if call.args else call.kwargs.get('args')
+        if call.sql_type == QueryType.SELECT_BUILT:
+            args = dict() if args is None else args
+            query = prepare_built_query(fn.__built__, fn.__built_cache__, args, self._queries.config.strict_parse)
+        else:
+            args = tuple() if args is None else args
+            query = fn.__query__
+        identifiers = call.kwargs.get('identifiers')
+        if identifiers:
+            if not quote_ident:
+                raise SQLpyException('"quote_ident" is not supported')
+            query = format_query_identifiers(query, identifiers, extensions.quote_ident, self._cur,
+                                             fn.__identifiers_cache__)
+        call.query = query
+        call.query_args = args
+
+    def _before_execute(self):
+        hooks = self._queries._hooks
+        if not hooks.active:
+            return hooks
+        for call in self._calls:
+            log_query_params = call.kwargs.get('log_query_params', self._queries.config.log_query_params)
+            call.event = hooks.before_execute(call.name, call.sql_type, call.query, call.query_args,
+                                              self._cur, log_query_params)
+        return hooks
+
+    def _finish(self, call, cur, started, executing):
+        """Fetches the result of a call from the cursor holding it"""
+        metrics = self._queries.query_metrics(call)
+        if call.event is not None:
+            self._queries._hooks.after_execute(call.event)
+        if call.sql_type == QueryType.INSERT_UPDATE_DELETE:
+            if metrics is not None:
+                metrics.record(started, executing, timer())
+            value = True
+        else:
+            row_type = call.kwargs.get('row_type', self._queries.config.row_type)
+            convert = partial(call.fn.__row_factory__.convert, cur, row_type) if row_type is not None else None
+            value = fetch_results(cur, call.kwargs.get('n'), metrics=metrics, started=started, executing=executing,
+                                  convert=convert)
+        result_cache = self._queries.result_cache
+        if result_cache is not None and call.sql_type in (QueryType.INSERT_UPDATE_DELETE, QueryType.RETURN_ID):
+            result_cache.invalidate(call.fn.__tables__ or None)
+        call.result._value = value
+
+    def _execute_pipeline(self, started):
+        conn = self._cur.connection
+        row_factory = getattr(self._cur, 'row_factory', None)
+        cursors = []
+        try:
+            executing = timer()
+            with conn.pipeline():
+                for call in self._calls:
+                    cur = conn.cursor(row_factory=row_factory) if row_factory is not None else conn.cursor()
+                    cursors.append(cur)
+                    cur.execute(call.query, call.query_args)
+            for call, cur in zip(self._calls, cursors):
+                self._finish(call, cur, started, executing)
+        finally:
+            for cur in cursors:
+                cur.close()
+
+    def _execute_multi(self, started):
+        statements = [end_statement(self._cur.mogrify(call.query, call.query_args)) for call in self._calls]
+        separator = b';\n' if isinstance(statements[0], bytes) and bytes is not str else ';\n'
+        executing = timer()
+        self._cur.execute(separator.join(statements))
+        for i, call in enumerate(self._calls):
+            if i:
+                self._cur.nextset()
+            self._finish(call, self._cur, started, executing)
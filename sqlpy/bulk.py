@@ -0,0 +1,479 @@
+"""
+Bulk execution of ``!`` queries: ``many=True`` calls executed page by page, and loading
+through PostgreSQL ``COPY ... FROM STDIN`` with the ``copy=True`` call option.
+
+Both consume their rows incrementally from any iterable. For ``COPY`` the rows are encoded
+into buffers of about ``buffer_size`` bytes, and handed to ``cursor.copy_expert`` through a
+:class:`CopyReader`. The encoders only need a file-like object, so they can be run against
+an in-memory file with :func:`write_copy`.
+"""
+from __future__ import print_function, absolute_import
+import binascii
+import datetime
+import json
+import logging
+import re
+import struct
+import uuid
+from collections import namedtuple
+from itertools import islice
+from timeit import default_timer as timer
+from .config import COPY_BUFFER_SIZE, execute_values
+from .exceptions import SQLpyException
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+try:
+    text_type = unicode
+except NameError:  # pragma: no cover
+    text_type = str
+
+#: The ``COPY`` formats rows can be encoded in
+COPY_FORMATS = ('csv', 'binary')
+
+# only an INSERT of bare placeholders, anything else (ON CONFLICT, SELECT, expressions)
+# would change meaning as a COPY
+_insert_re = re.compile(r'\s*INSERT\s+INTO\s+(?P<table>(?:"[^"]*"|[^\s("])+)\s*(?P<columns>\([^)]*\))?'
+                        r'\s*VALUES\s*(?:%s|\(\s*%s(?:\s*,\s*%s)*\s*\))\s*;?\s*\Z',
+                        re.IGNORECASE)
+_copy_re = re.compile(r'\s*COPY\s', re.IGNORECASE)
+
+_csv_special_re = re.compile(r'[,"\r\n]')
+
+# PostgreSQL epoch of the binary date and timestamp formats
+_PG_EPOCH_DATE = datetime.date(2000, 1, 1)
+_PG_EPOCH = datetime.datetime(2000, 1, 1)
+
+_BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+_BINARY_TRAILER = struct.pack('!h', -1)
+_NULL = struct.pack('!i', -1)
+_pack_field_count = struct.Struct('!h').pack
+_pack_length = struct.Struct('!i').pack
+_pack_bool = struct.Struct('!i?').pack
+_pack_int = struct.Struct('!iq').pack
+_pack_float = struct.Struct('!id').pack
+_pack_date = struct.Struct('!ii').pack
+
+
+def check_many_args(page_size, commit_every, savepoint_every):
+    """
+    Helper function to validate the paging arguments of a ``many=True`` call
+    """
+    for arg, value in (('page_size', page_size), ('commit_every', commit_every),
+                       ('savepoint_every', savepoint_every)):
+        if value is not None and (not isinstance(value, int) or value < 1):
+            raise SQLpyException('"{}" must be an Integer >= 1'.format(arg))
+    if commit_every and savepoint_every:
+        raise SQLpyException('"commit_every" can not be used with "savepoint_every"')
+
+
+def iter_pages(rows, page_size):
+    """
+    Yields lists of up to ``page_size`` rows, consuming ``rows`` one page at a time.
+    """
+    rows = iter(rows)
+    while True:
+        page = list(islice(rows, page_size))
+        if not page:
+            return
+        yield page
+
+
+def iter_many(cur, query, rows, page_size, commit_every=None, savepoint_every=None, progress=None, fetch=False):
+    """
+    Executes a query for every row, one page of rows per ``execute_values`` call, or per
+    ``executemany`` call on drivers other than psycopg2, yielding after every page. Only
+    one page is held in memory.
+
+    Args:
+        cur (:obj:`cursor`): cursor object
+        query (:obj:`str`): the query
+        rows: iterable of row arguments
+        page_size (:obj:`int`): rows per page
+        commit_every (:obj:`int`, optional): commit the connection of ``cur`` every that
+            many pages, and after the last one
+        savepoint_every (:obj:`int`, optional): release and set a savepoint every that many
+            pages, on error the pages since the last one are rolled back before raising
+        progress (:obj:`callable`, optional): called with the number of rows and pages
+            executed so far, after every page
+        fetch (:obj:`bool`, optional): fetch the rows returned by each page, with
+            ``execute_values(..., fetch=True)``, or one ``execute`` and ``fetchall`` per row
+            on other drivers as ``executemany`` does not keep the rows of each statement
+
+    Yields:
+        The :obj:`list` of rows returned by each page with ``fetch``, else the number of
+        rows of each page
+    """
+    checkpoint_every = commit_every or savepoint_every
+    if savepoint_every:
+        cur.execute('SAVEPOINT sqlpy_many')
+    count = 0
+    pages = 0
+    try:
+        for page in iter_pages(rows, page_size):
+            if execute_values:
+                returned = execute_values(cur, query, page, page_size=len(page), fetch=fetch)
+            elif fetch:
+                returned = fetch_rows(cur, query, page)
+            else:
+                cur.executemany(query, page)
+                returned = None
+            count += len(page)
+            pages += 1
+            if checkpoint_every and pages % checkpoint_every == 0:
+                if commit_every:
+                    cur.connection.commit()
+                else:
+                    cur.execute('RELEASE SAVEPOINT sqlpy_many')
+                    cur.execute('SAVEPOINT sqlpy_many')
+            if progress is not None:
+                progress(count, pages)
+            yield returned if fetch else len(page)
+    except Exception:
+        if savepoint_every:
+            try:
+                cur.execute('ROLLBACK TO SAVEPOINT sqlpy_many')
+            except Exception:
+                logger.error('Could not roll back to the last "many" savepoint', exc_info=True)
+        raise
+    if commit_every:
+        cur.connection.commit()
+    elif savepoint_every:
+        cur.execute('RELEASE SAVEPOINT sqlpy_many')
+
+
+def fetch_rows(cur, query, page):
+    """
+    Helper function executing a ``RETURNING`` query once per row of ``page``.
+
+    Returns:
+        :obj:`list`: the rows returned by every execution
+    """
+    returned = []
+    for row in page:
+        cur.execute(query, row)
+        returned.extend(cur.fetchall())
+    return returned
+
+
+def execute_many(cur, query, rows, page_size, commit_every=None, savepoint_every=None, progress=None):
+    """
+    Executes a query for every row, page by page, see :func:`iter_many`.
+
+    Returns:
+        :obj:`int`: the number of rows executed
+    """
+    return sum(iter_many(cur, query, rows, page_size, commit_every, savepoint_every, progress))
+
+
+def fetch_many(cur, query, rows, page_size, commit_every=None, savepoint_every=None, progress=None):
+    """
+    Executes a ``RETURNING`` query for every row, page by page, see :func:`iter_many`.
+
+    Returns:
+        :obj:`list`: the rows returned by every page
+    """
+    return [row for returned in iter_many(cur, query, rows, page_size, commit_every, savepoint_every, progress,
+                                          fetch=True)
+            for row in returned]
+
+
+def iter_returning(pages, metrics=None, convert=None):
+    """
+    Yields the rows returned by the pages of :func:`iter_many`, executing the next page
+    once the rows of the previous one are consumed.
+
+    Args:
+        pages: :func:`iter_many` generator, with ``fetch=True``
+        metrics (:class:`sqlpy.metrics.QueryMetrics`, optional): records the rows and time
+            spent executing the pages, once the generator is exhausted or closed
+        convert (:obj:`callable`, optional): converts the rows of each page
+    """
+    elapsed = 0
+    count = 0
+    try:
+        while True:
+            if metrics is not None:
+                executing = timer()
+                try:
+                    returned = next(pages, None)
+                except Exception:
+                    metrics.record_error(call=False)
+                    raise
+                elapsed += timer() - executing
+            else:
+                returned = next(pages, None)
+            if returned is None:
+                return
+            count += len(returned)
+            if convert is not None:
+                returned = convert(returned)
+            for row in returned:
+                yield row
+    finally:
+        pages.close()
+        if metrics is not None:
+            metrics.record_fetch(elapsed, count)
+
+
+class CopyResult(namedtuple('CopyResult', ['rows', 'bytes', 'duration'])):
+    """
+    Outcome of a ``copy=True`` call: the number of rows and bytes sent, and the seconds the
+    ``COPY`` took.
+    """
+    __slots__ = ()
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.duration if self.duration > 0 else 0.0
+
+
+def copy_statement(query, copy_format='csv'):
+    """
+    Derives the ``COPY ... FROM STDIN`` statement loading the rows of an ``INSERT`` query.
+
+    ``INSERT INTO table (a, b) VALUES %s``, or ``VALUES (%s, %s)``, becomes
+    ``COPY table (a, b) FROM STDIN ...``, a query which is already a ``COPY`` is returned
+    unchanged.
+
+    Raises:
+        SQLpyException: When the query is neither a ``COPY`` nor an ``INSERT INTO`` of bare
+            ``%s`` placeholders, with nothing after its ``VALUES``.
+    """
+    check_copy_format(copy_format)
+    if _copy_re.match(query):
+        return query
+    match = _insert_re.match(query)
+    if not match:
+        raise SQLpyException('"copy" requires a COPY query, or an INSERT INTO ... VALUES of %s placeholders only')
+    columns = match.group('columns')
+    options = "FORMAT csv, ENCODING 'UTF8'" if copy_format == 'csv' else 'FORMAT binary'
+    return 'COPY {}{} FROM STDIN WITH ({})'.format(match.group('table'), ' ' + columns if columns else '', options)
+
+
+def check_copy_format(copy_format):
+    if copy_format not in COPY_FORMATS:
+        raise SQLpyException('"copy_format" must be one of {}'.format(', '.join(COPY_FORMATS)))
+
+
+def csv_value(value):
+    """
+    Encodes a value as a CSV field for ``COPY``. ``None`` is an unquoted empty field, the
+    ``NULL`` of the CSV format, so empty strings are quoted.
+
+    Bytes are ``bytea`` hex. On Python 2 a ``str`` is decoded as UTF-8 text, or encoded as
+    ``bytea`` hex when it is not valid UTF-8, pass a ``bytearray`` for binary data.
+    """
+    if value is None:
+        return ''
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, (bytearray, memoryview)) or (bytes is not str and isinstance(value, bytes)):
+        return '\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+    if isinstance(value, bytes):
+        # a Python 2 str, text when it is UTF-8, else binary
+        try:
+            value = value.decode('utf-8')
+        except UnicodeDecodeError:
+            return '\\x' + binascii.hexlify(value).decode('ascii')
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, dict):
+        value = json.dumps(value)
+    elif not isinstance(value, text_type):
+        value = text_type(value)
+    if not value or value == '\\.' or _csv_special_re.search(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
+
+
+def encode_csv(rows, buffer_size=COPY_BUFFER_SIZE, counter=None):
+    """
+    Yields the rows encoded in the ``COPY`` CSV format, in UTF-8 chunks of about
+    ``buffer_size`` bytes.
+
+    Args:
+        rows: iterable of row sequences
+        buffer_size (:obj:`int`, optional): size of the chunks yielded
+        counter (:obj:`list`, optional): its first item is incremented per row encoded
+    """
+    lines = []
+    size = 0
+    count = 0
+    try:
+        for row in rows:
+            line = ','.join([csv_value(value) for value in row]) + '\n'
+            lines.append(line)
+            size += len(line)
+            count += 1
+            if size >= buffer_size:
+                yield ''.join(lines).encode('utf-8')
+                lines = []
+                size = 0
+        if lines:
+            yield ''.join(lines).encode('utf-8')
+    finally:
+        if counter is not None:
+            counter[0] += count
+
+
+def binary_value(value):
+    """
+    Encodes a value as a field of the ``COPY`` binary format, length prefixed.
+
+    The Python type picks the PostgreSQL type: ``bool`` for ``boolean``, ``int`` for
+    ``bigint``, ``float`` for ``double precision``, text for ``text`` and ``varchar``,
+    bytes for ``bytea``, ``date``, naive ``datetime`` for ``timestamp`` and ``uuid``. The
+    column must be of that type.
+
+    Raises:
+        SQLpyException: When the value has no binary encoding.
+    """
+    if value is None:
+        return _NULL
+    if isinstance(value, bool):
+        return _pack_bool(1, value)
+    if isinstance(value, int):
+        return _pack_int(8, value)
+    if isinstance(value, float):
+        return _pack_float(8, value)
+    if isinstance(value, text_type):
+        value = value.encode('utf-8')
+        return _pack_length(len(value)) + value
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+        return _pack_length(len(value)) + value
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is not None:
+            raise SQLpyException('timezone aware datetimes have no binary COPY encoding, use copy_format="csv"')
+        delta = value - _PG_EPOCH
+        return _pack_int(8, (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds)
+    if isinstance(value, datetime.date):
+        return _pack_date(4, (value - _PG_EPOCH_DATE).days)
+    if isinstance(value, uuid.UUID):
+        return _pack_length(16) + value.bytes
+    raise SQLpyException('{} values have no binary COPY encoding, use copy_format="csv"'.format(type(value)))
+
+
+def encode_binary(rows, buffer_size=COPY_BUFFER_SIZE, counter=None):
+    """
+    Yields the rows encoded in the ``COPY`` binary format, in chunks of about
+    ``buffer_size`` bytes. See :func:`binary_value` for the supported types.
+
+    Args:
+        rows: iterable of row sequences
+        buffer_size (:obj:`int`, optional): size of the chunks yielded
+        counter (:obj:`list`, optional): its first item is incremented per row encoded
+    """
+    parts = [_BINARY_HEADER]
+    size = len(_BINARY_HEADER)
+    count = 0
+    try:
+        for row in rows:
+            fields = [binary_value(value) for value in row]
+            parts.append(_pack_field_count(len(fields)))
+            parts.extend(fields)
+            size += 2 + sum(len(field) for field in fields)
+            count += 1
+            if size >= buffer_size:
+                yield b''.join(parts)
+                parts = []
+                size = 0
+        parts.append(_BINARY_TRAILER)
+        yield b''.join(parts)
+    finally:
+        if counter is not None:
+            counter[0] += count
+
+
+class CopyReader(object):
+    """
+    Read only file-like object over the encoded rows, as read by ``cursor.copy_expert``.
+
+    Args:
+        rows: iterable of row sequences
+        copy_format (:obj:`str`, optional): ``'csv'`` or ``'binary'``
+        buffer_size (:obj:`int`, optional): size of the encoded chunks
+
+    Attributes:
+        rows (:obj:`int`): rows encoded so far
+        bytes (:obj:`int`): bytes read so far
+    """
+    def __init__(self, rows, copy_format='csv', buffer_size=COPY_BUFFER_SIZE):
+        check_copy_format(copy_format)
+        self._counter = [0]
+        encode = encode_csv if copy_format == 'csv' else encode_binary
+        self._chunks = encode(rows, buffer_size, self._counter)
+        self._chunk = b''
+        self._pos = 0
+        self.bytes = 0
+
+    @property
+    def rows(self):
+        return self._counter[0]
+
+    def read(self, size=-1):
+        parts = []
+        wanted = size if size is not None and size >= 0 else None
+        while wanted is None or wanted > 0:
+            if self._pos >= len(self._chunk):
+                self._chunk = next(self._chunks, None)
+                self._pos = 0
+                if self._chunk is None:
+                    self._chunk = b''
+                    break
+            end = len(self._chunk) if wanted is None else self._pos + wanted
+            part = self._chunk[self._pos:end]
+            self._pos += len(part)
+            if wanted is not None:
+                wanted -= len(part)
+            parts.append(part)
+        data = b''.join(parts)
+        self.bytes += len(data)
+        return data
+
+    def close(self):
+        self._chunks.close()
+
+
+def write_copy(rows, file, copy_format='csv', buffer_size=COPY_BUFFER_SIZE):
+    """
+    Writes the encoded rows to a binary file-like object, such as :class:`io.BytesIO`.
+
+    Returns:
+        :class:`CopyResult`
+    """
+    started = timer()
+    reader = CopyReader(rows, copy_format, buffer_size)
+    while True:
+        data = reader.read(buffer_size)
+        if not data:
+            break
+        file.write(data)
+    return CopyResult(reader.rows, reader.bytes, timer() - started)
+
+
+def copy_rows(cur, query, rows, copy_format='csv', buffer_size=COPY_BUFFER_SIZE):
+    """
+    Loads the rows with ``cur.copy_expert``, through the ``COPY`` statement derived from
+    ``query`` by :func:`copy_statement`.
+
+    Returns:
+        :class:`CopyResult`
+
+    Raises:
+        SQLpyException: When the cursor has no ``copy_expert`` method.
+    """
+    if not hasattr(cur, 'copy_expert'):
+        raise SQLpyException('"copy" requires a cursor with a "copy_expert" method (psycopg2)')
+    statement = copy_statement(query, copy_format)
+    started = timer()
+    reader = CopyReader(rows, copy_format, buffer_size)
+    try:
+        cur.copy_expert(statement, reader, buffer_size)
+    finally:
+        reader.close()
+    return CopyResult(reader.rows, reader.bytes, timer() - started)
@@ -0,0 +1,216 @@
+"""
+Result cache of ``SELECT`` queries, enabled with ``sqlpy.Queries(..., result_cache=ResultCache())``.
+
+A query is cached when called with ``cache_ttl``, usually set once through
+``query_options``. Results are keyed by the query name, arguments, identifiers, ``n``,
+row type, cursor class and connection, and expire after ``cache_ttl`` seconds. The tables of every query are found
+when it is parsed, see :func:`sqlpy.sqlpy.query_tables`, so calling a ``!`` or ``<!>``
+query drops the cached results reading the tables it writes, and calling a ``@``
+procedure drops them all.
+"""
+from __future__ import print_function, absolute_import
+import logging
+import threading
+from collections import namedtuple
+from timeit import default_timer as timer
+from .config import RESULT_CACHE_SIZE
+from .sqlpy import LRUCache
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+#: Snapshot of the result cache counters of a query
+QueryCacheInfo = namedtuple('QueryCacheInfo', ['hits', 'misses', 'hit_ratio'])
+
+#: Returned by :meth:`ResultCache.get` for a key not cached
+MISS = object()
+
+_HITS, _MISSES = 0, 1
+
+
+def freeze(value):
+    """
+    Helper function converting call arguments to a hashable equivalent.
+
+    Raises:
+        TypeError: When ``value`` holds an unhashable type other than a :obj:`dict`,
+            :obj:`list` or :obj:`set`.
+    """
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((key, freeze(item)) for key, item in value.items())))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple(freeze(item) for item in value))
+    if isinstance(value, (set, frozenset)):
+        return (frozenset, frozenset(freeze(item) for item in value))
+    hash(value)
+    return value
+
+
+def connection_namespace(cur):
+    """
+    Helper function telling apart the databases the cached results are read from.
+
+    Returns:
+        the ``dsn`` of the connection of ``cur``, from ``connection.dsn`` (psycopg2) or
+        ``connection.info.dsn`` (psycopg 3), else the identity of the connection object
+    """
+    conn = getattr(cur, 'connection', None)
+    if conn is None:
+        return None
+    dsn = getattr(conn, 'dsn', None)
+    if dsn is None:
+        dsn = getattr(getattr(conn, 'info', None), 'dsn', None)
+    return dsn if dsn is not None else id(conn)
+
+
+class ResultCache(object):
+    """
+    Bounded cache of the results of ``SELECT`` and ``$`` queries, shared by the functions
+    of a :class:`sqlpy.Queries` object.
+
+    The cache is local to the process, writes made by other processes or outside of the
+    SQL statement functions are only seen once the entries expire. A cached result is
+    returned as a new list of the same rows, so rows must not be changed in place.
+
+    Args:
+        maxsize (:obj:`int`, optional): number of results held, the least recently used
+            are evicted beyond this
+        max_rows (:obj:`int`, optional): results with more rows are not cached
+        namespace (:obj:`callable`, optional): called with the cursor, returns the hashable
+            part of the keys telling apart the databases the results are read from. Default
+            is :func:`connection_namespace`
+    """
+    def __init__(self, maxsize=RESULT_CACHE_SIZE, max_rows=None, namespace=connection_namespace):
+        self.max_rows = max_rows
+        self.namespace = namespace
+        self._entries = LRUCache(maxsize)
+        #: keys of the cached results reading each table
+        self._tables = {}
+        #: number of invalidations of each table, and of the whole cache
+        self._versions = {}
+        self._generation = 0
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, name, cur, args, identifiers=None, n=None, row_type=None):
+        """
+        Returns:
+            :obj:`tuple`: the key of a call, ``None`` when its arguments are not hashable
+        """
+        try:
+            return (name, type(cur), self.namespace(cur), freeze(args), freeze(identifiers), n,
+                    row_type)
+        except TypeError:
+            return None
+
+    def get(self, key, default=MISS):
+        """
+        Returns:
+            the result cached under ``key``, or ``default`` when it is not cached or expired
+        """
+        entry = self._entries.get(key, MISS)
+        with self._lock:
+            if entry is not MISS and entry[1] <= timer():
+                self._drop(key)
+                entry = MISS
+            counters = self._counters.setdefault(key[0], [0, 0])
+            counters[_MISSES if entry is MISS else _HITS] += 1
+        if entry is MISS:
+            return default
+        result = entry[0]
+        return list(result) if isinstance(result, list) else result
+
+    def version(self, tables):
+        """
+        Returns:
+            the version of ``tables``, to pass to :meth:`put`
+        """
+        with self._lock:
+            return self._generation, tuple(self._versions.get(table, 0) for table in sorted(tables))
+
+    def put(self, key, result, ttl, tables, version):
+        """
+        Caches ``result`` for ``ttl`` seconds, unless ``tables`` were invalidated since
+        ``version`` was taken, before executing the query.
+        """
+        if self.max_rows is not None and isinstance(result, list) and len(result) > self.max_rows:
+            return
+        with self._lock:
+            if version != (self._generation, tuple(self._versions.get(table, 0) for table in sorted(tables))):
+                return
+            for table in tables:
+                self._tables.setdefault(table, set()).add(key)
+            evicted = self._entries.put(key, (list(result) if isinstance(result, list) else result,
+                                              timer() + ttl, tables))
+            for evicted_key, entry in evicted:
+                self._untag(evicted_key, entry[2])
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        if entry is not None:
+            self._untag(key, entry[2])
+
+    def _untag(self, key, tables):
+        for table in tables:
+            keys = self._tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tables[table]
+
+    def invalidate(self, tables=None):
+        """
+        Drops the cached results reading any of ``tables``, or every result when ``None``.
+        """
+        with self._lock:
+            if tables is None:
+                self._generation += 1
+                self._tables.clear()
+                self._entries.clear()
+            else:
+                for table in tables:
+                    self._versions[table] = self._versions.get(table, 0) + 1
+                    for key in self._tables.pop(table, ()):
+                        self._drop(key)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Invalidated cached results of {}'.format(
+                'all tables' if tables is None else ', '.join(sorted(tables))))
+
+    def invalidate_after(self, rows, tables):
+        """
+        Passes the rows of a streamed write through, invalidating ``tables`` once it ends.
+        """
+        try:
+            for row in rows:
+                yield row
+        finally:
+            self.invalidate(tables)
+
+    def clear(self, names=None):
+        """
+        Drops the cached results of the queries ``names``, or every result and the hit and
+        miss counters when ``None``.
+        """
+        if names is None:
+            self.invalidate(None)
+            with self._lock:
+                self._counters.clear()
+            return
+        names = set(names)
+        with self._lock:
+            for key in self._entries.keys():
+                if key[0] in names:
+                    self._drop(key)
+
+    def info(self):
+        """
+        Returns:
+            :obj:`dict`: :class:`QueryCacheInfo` keyed by the query name
+        """
+        with self._lock:
+            counters = dict((name, tuple(counts)) for name, counts in self._counters.items())
+        return dict((name, QueryCacheInfo(hits, misses, float(hits) / (hits + misses)))
+                    for name, (hits, misses) in counters.items())
@@ -0,0 +1,275 @@
+"""
+Columnar results, returned by ``SELECT`` and ``$`` functions called with ``columnar=True``.
+
+The rows are fetched ``batch_size`` at a time and copied into one NumPy array per column,
+so the full result is never held as Python row tuples. The dtype of each column is
+inferred from the values of the first batch, or from the type code of its
+``cursor.description`` entry with psycopg2. NumPy, and pandas for ``columnar='pandas'``,
+are imported on first use, so they are only needed when columnar results are used.
+"""
+from __future__ import print_function, absolute_import
+import datetime
+import logging
+from collections import OrderedDict
+from timeit import default_timer as timer
+from .config import extensions, STREAM_BATCH_SIZE
+from .exceptions import SQLpyException
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+#: The ``columnar`` call option values, a dict of NumPy arrays or a pandas DataFrame
+COLUMNAR_KINDS = ('numpy', 'pandas')
+
+#: NumPy dtypes of the PostgreSQL types with a fixed size representation, by type OID
+PG_DTYPES = {
+    16: '?',  # boolean
+    20: 'i8',  # bigint
+    21: 'i2',  # smallint
+    23: 'i4',  # integer
+    700: 'f4',  # real
+    701: 'f8',  # double precision
+    1082: 'M8[D]',  # date
+    1114: 'M8[us]',  # timestamp without time zone
+}
+
+# the dtype of columns holding any Python object, such as text or NULL
+_OBJECT = 'O'
+
+
+def import_numpy():
+    """
+    Helper function importing NumPy on first use.
+
+    Raises:
+        SQLpyException: When NumPy is not installed.
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise SQLpyException('"columnar" results require numpy, install it with "pip install numpy"')
+    return numpy
+
+
+def import_pandas():
+    """
+    Helper function importing pandas on first use.
+
+    Raises:
+        SQLpyException: When pandas is not installed.
+    """
+    try:
+        import pandas
+    except ImportError:
+        raise SQLpyException('"columnar=\'pandas\'" results require pandas, install it with "pip install pandas"')
+    return pandas
+
+
+def check_columnar_args(columnar, n, stream):
+    """
+    Helper function to validate the ``columnar`` option of a query function, before
+    executing it.
+
+    Returns:
+        :obj:`str`: ``'numpy'`` or ``'pandas'``
+
+    Raises:
+        SQLpyException: When ``columnar`` is not ``True`` or one of :data:`COLUMNAR_KINDS`,
+            is used with ``n`` or ``stream``, or its libraries are not installed.
+    """
+    kind = 'numpy' if columnar is True else columnar
+    if kind not in COLUMNAR_KINDS:
+        raise SQLpyException('"columnar" must be True or one of {}'.format(', '.join(COLUMNAR_KINDS)))
+    if n or stream:
+        raise SQLpyException('"columnar" can not be used with "n" or "stream"')
+    import_numpy()
+    if kind == 'pandas':
+        import_pandas()
+    return kind
+
+
+def infer_dtype(values, type_code=None):
+    """
+    Infers the NumPy dtype of a column from its first values.
+
+    A known psycopg2 ``type_code`` gives the dtype, see :data:`PG_DTYPES`. Otherwise
+    columns of ``int`` values are ``int64`` and of ``float`` (and ``int``) values
+    ``float64``, ``bool`` columns are ``bool``, naive ``datetime`` columns ``datetime64[us]``
+    and ``date`` columns ``datetime64[D]``. ``NULL`` values make an integer column
+    ``float64``, with ``NaN``, and a ``bool`` column ``object``. Anything else, such as text,
+    ``Decimal`` or timezone aware datetimes, is ``object``.
+
+    Args:
+        values (:obj:`list`): values of the column
+        type_code (:obj:`int`, optional): PostgreSQL type OID of the column
+
+    Returns:
+        :obj:`str`: a NumPy dtype string
+    """
+    has_null = None in values
+    dtype = PG_DTYPES.get(type_code)
+    if dtype is None:
+        types = set(type(value) for value in values if value is not None)
+        if not types:
+            return _OBJECT
+        if types == {int}:
+            dtype = 'i8'
+        elif types <= {int, float}:
+            dtype = 'f8'
+        elif types == {bool}:
+            dtype = '?'
+        elif types == {datetime.datetime} and all(value.tzinfo is None for value in values if value is not None):
+            dtype = 'M8[us]'
+        elif types == {datetime.date}:
+            dtype = 'M8[D]'
+        else:
+            return _OBJECT
+    if has_null:
+        return null_dtype(dtype)
+    return dtype
+
+
+def null_dtype(dtype):
+    """Helper function returning the dtype of a column of type ``dtype`` holding ``NULL``"""
+    if dtype[0] in 'iu':
+        return 'f8'
+    if dtype == '?':
+        return _OBJECT
+    # floats hold NaN and datetimes NaT
+    return dtype
+
+
+class ColumnBuilder(object):
+    """
+    A growing NumPy array of one column, converted to a wider dtype when a value does not
+    fit the current one.
+    """
+    __slots__ = ('numpy', 'array', 'size')
+
+    def __init__(self, numpy, dtype, capacity):
+        self.numpy = numpy
+        self.array = numpy.empty(capacity, dtype=dtype)
+        self.size = 0
+
+    def extend(self, values):
+        end = self.size + len(values)
+        if end > len(self.array):
+            self._resize(max(end, len(self.array) * 2))
+        kind = self.array.dtype.kind
+        # NULL would be stored as 0 or False
+        if kind in 'iub' and None in values:
+            self._convert('f8' if kind != 'b' else _OBJECT)
+        try:
+            self.array[self.size:end] = values
+        except (TypeError, ValueError, OverflowError):
+            # values the dtype inferred from the first batch can not hold
+            self._convert(_OBJECT)
+            self.array[self.size:end] = values
+        self.size = end
+
+    def _resize(self, capacity):
+        array = self.numpy.empty(capacity, dtype=self.array.dtype)
+        array[:self.size] = self.array[:self.size]
+        self.array = array
+
+    def _convert(self, dtype):
+        array = self.numpy.empty(len(self.array), dtype=dtype)
+        if dtype == _OBJECT and self.array.dtype.kind == 'M':
+            # datetime64 to Python objects, without NaT becoming an integer
+            array[:self.size] = self.array[:self.size].tolist()
+        else:
+            array[:self.size] = self.array[:self.size]
+        self.array = array
+
+    def finish(self):
+        """
+        Returns:
+            the array of the values added, copied when it holds more unused space
+        """
+        if self.size == len(self.array):
+            return self.array
+        return self.array[:self.size].copy()
+
+
+def column_names(cur):
+    """
+    Returns:
+        :obj:`list` of :obj:`str`: the column names of the result of ``cur``
+
+    Raises:
+        SQLpyException: When the query returned no result, or two columns share a name.
+    """
+    if not cur.description:
+        raise SQLpyException('"columnar" requires a query returning rows')
+    names = [column[0] for column in cur.description]
+    if len(set(names)) != len(names):
+        duplicated = sorted(set(name for name in names if names.count(name) > 1))
+        raise SQLpyException('"columnar" requires unique column names, "{}" is repeated'.format(duplicated[0]))
+    return names
+
+
+def batch_columns(rows, names):
+    """Helper function transposing a batch of rows, of tuples or dicts, into columns"""
+    if isinstance(rows[0], dict):
+        return [[row[name] for row in rows] for name in names]
+    return [list(column) for column in zip(*rows)]
+
+
+def fetch_columns(cur, kind='numpy', batch_size=None, close=None, metrics=None, started=0, executing=0):
+    """
+    Fetches the result of an executed query into one NumPy array per column.
+
+    Args:
+        cur (:obj:`cursor`): cursor object the query was executed on
+        kind (:obj:`str`): ``'numpy'`` or ``'pandas'``
+        batch_size (:obj:`int`): rows fetched per ``fetchmany`` call
+        close (:obj:`callable`, optional): called once the results have been fetched
+        metrics (:class:`sqlpy.metrics.QueryMetrics`, optional): records the call, from
+            the ``started`` and ``executing`` timer readings of the query function
+
+    Returns:
+        :obj:`collections.OrderedDict` of NumPy arrays keyed by column name, or a
+            ``pandas.DataFrame`` for ``'pandas'``
+    """
+    if metrics is not None:
+        executed = timer()
+    numpy = import_numpy()
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    try:
+        # a named cursor only describes its result once fetched from
+        rows = cur.fetchmany(batch_size) if cur.description or getattr(cur, 'name', None) else []
+        names = column_names(cur)
+        # psycopg2 type codes are PostgreSQL type OIDs
+        psycopg2_cursor = extensions is not None and isinstance(cur, extensions.cursor)
+        type_codes = [column[1] if psycopg2_cursor else None for column in cur.description]
+        # the row count is known up front with client side cursors
+        rowcount = getattr(cur, 'rowcount', -1)
+        capacity = rowcount if rowcount is not None and rowcount >= len(rows) else len(rows)
+        columns = batch_columns(rows, names) if rows else [[] for _ in names]
+        builders = [ColumnBuilder(numpy, infer_dtype(values, type_code), capacity)
+                    for values, type_code in zip(columns, type_codes)]
+        while rows:
+            for builder, values in zip(builders, columns):
+                builder.extend(values)
+            # only one batch of rows is held at a time
+            del rows, columns
+            rows = cur.fetchmany(batch_size)
+            if rows:
+                columns = batch_columns(rows, names)
+    except Exception:
+        if metrics is not None:
+            metrics.record_error()
+        raise
+    finally:
+        if close is not None:
+            close()
+    arrays = OrderedDict((name, builder.finish()) for name, builder in zip(names, builders))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('Fetched {} rows into columns: {}'.format(
+            builders[0].size if builders else 0,
+            ', '.join('{} {}'.format(name, array.dtype) for name, array in arrays.items())))
+    if metrics is not None:
+        metrics.record(started, executing, executed, timer(), builders[0].size if builders else 0)
+    if kind == 'pandas':
+        return import_pandas().DataFrame(arrays, columns=names)
+    return arrays
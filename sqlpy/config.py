@@ -1,5 +1,10 @@
+from collections import namedtuple
 from enum import Enum
 
+#: The sqlpy version, part of the key of on-disk parse cache entries,
+#: also read by ``setup.py`` so a release only changes it here
+VERSION = '0.3.5'
+
 #: Detect if psycopg2 driver is being used
 #: import quote_ident else set to None
 try:
@@ -16,6 +21,13 @@ try:
 except ImportError:  # pragma: no cover
     execute_values = None
 
+#: Detect if concurrent.futures is available (the futures backport on Python 2)
+#: import ProcessPoolExecutor else set to None
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:  # pragma: no cover
+    ProcessPoolExecutor = None
+
 #: The default value for strictly parsing built SQL queries
 #: matching the number of parameters supplied to the SQL code
 STRICT_BUILT_PARSE = False
@@ -28,6 +40,71 @@ UPPERCASE_QUERY_NAME = True
 #: query parameters in case of sensitive content
 LOG_QUERY_PARAMS = True
 
+#: The default number of built SQL strings cached per ``$`` query,
+#: keyed by the set of argument names supplied to the function
+BUILT_CACHE_SIZE = 128
+
+#: The number of SQL strings formatted with ``identifiers`` cached per query,
+#: keyed by the query and the identifiers supplied to the function
+IDENTIFIERS_CACHE_SIZE = 64
+
+#: The number of identifiers quoted by ``quote_ident`` cached per process
+QUOTED_IDENT_CACHE_SIZE = 1024
+
+#: The default number of rows fetched per ``fetchmany`` call
+#: when streaming results
+STREAM_BATCH_SIZE = 1000
+
+#: The default number of rows transferred per network round trip
+#: by a server side (named) cursor
+SERVER_SIDE_ITERSIZE = 2000
+
+#: The default value for executing queries through server side
+#: prepared statements
+PREPARE_STATEMENTS = False
+
+#: The default type of the rows returned, ``None`` keeps the rows
+#: returned by the cursor, see :mod:`sqlpy.rows`
+ROW_TYPE = None
+
+#: The settings of a :class:`sqlpy.Queries` object, resolved when its
+#: functions are made so each object keeps its own
+QueriesConfig = namedtuple('QueriesConfig', ['strict_parse', 'uppercase_name', 'log_query_params',
+                                             'built_cache_size', 'prepare', 'row_type'])
+
+#: The settings of functions made outside of a :class:`sqlpy.Queries` object
+DEFAULT_CONFIG = QueriesConfig(STRICT_BUILT_PARSE, UPPERCASE_QUERY_NAME, LOG_QUERY_PARAMS,
+                               BUILT_CACHE_SIZE, PREPARE_STATEMENTS, ROW_TYPE)
+
+#: The maximum number of prepared statements kept per connection,
+#: the least recently used are deallocated beyond this
+PREPARED_CACHE_SIZE = 64
+
+#: The default number of rows sent per statement by
+#: ``many=True`` calls, as for ``execute_values``
+MANY_PAGE_SIZE = 100
+
+#: The default number of bytes encoded per buffer when bulk
+#: loading rows with ``COPY``
+COPY_BUFFER_SIZE = 1 << 16
+
+#: Files of at least this many bytes are read through ``mmap``
+#: when loading SQL statements
+MMAP_MIN_SIZE = 1 << 20
+
+#: The SQL files of a :class:`sqlpy.Queries` given ``workers`` are only
+#: parsed in a process pool from this many bytes in total, and with
+#: several cores, below it starting the processes costs more than the parse
+WORKERS_MIN_SIZE = 1 << 20
+
+#: The upper bounds in seconds of the latency histogram buckets
+#: recorded per query when metrics are enabled
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+#: The default number of results held by a :class:`sqlpy.cache.ResultCache`,
+#: the least recently used are evicted beyond this
+RESULT_CACHE_SIZE = 1024
+
 
 class QueryType(Enum):
     """
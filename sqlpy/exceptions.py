@@ -15,8 +15,14 @@ class SQLLoadException(SQLpyException, IOError):
 
 class SQLParseException(SQLpyException, ValueError):
     """Exception raised when errors occur in building SQL strings."""
-    def __init__(self, msg, string):
-        super(SQLParseException, self).__init__('{}"{}"'.format(msg, string))
+    def __init__(self, msg, string, location=None):
+        self.msg = msg
+        self.string = string
+        self.location = location
+        if location:
+            super(SQLParseException, self).__init__('{}"{}" at {}'.format(msg, string, location))
+        else:
+            super(SQLParseException, self).__init__('{}"{}"'.format(msg, string))
 
 
 class SQLArgumentException(SQLpyException, ValueError):
@@ -0,0 +1,124 @@
+"""
+Callbacks around the execution of the prepared functions, registered with
+:meth:`sqlpy.Queries.add_hook`.
+
+With no callbacks registered a function only checks :attr:`Hooks.active`, no event is
+created.
+"""
+from __future__ import print_function, absolute_import
+import logging
+from timeit import default_timer as timer
+from .exceptions import SQLpyException
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+#: The hook points, in the order they are called
+HOOK_NAMES = ('before_execute', 'after_execute', 'on_error')
+
+
+class QueryEvent(object):
+    """
+    A query execution, passed to every callback of that execution.
+
+    Attributes:
+        name (:obj:`str`): name of the query
+        sql_type (:class:`sqlpy.config.QueryType`): type of the query
+        query (:obj:`str`): the SQL executed, built and with its identifiers formatted
+        args: the arguments of the query
+        cur (:obj:`cursor`): the cursor the query is executed on
+        log_query_params (:obj:`bool`): Weather the arguments may be logged, ``False`` when
+            they are sensitive
+        bulk (:obj:`bool`): Weather ``args`` are the rows of a ``many=True`` or ``copy=True``
+            call, which may be an iterator
+        aio (:obj:`bool`): Weather the query is executed by :class:`sqlpy.AsyncQueries`, on
+            an asyncio cursor
+        started (:obj:`float`): :func:`timeit.default_timer` reading before executing
+        duration (:obj:`float`): seconds spent executing, set for ``after_execute`` and
+            ``on_error``
+        error (:obj:`Exception`): the exception raised, set for ``on_error``
+        context (:obj:`dict`): free for callbacks to share state, such as a tracing span
+            opened by ``before_execute`` and closed by ``after_execute``
+    """
+    __slots__ = ('name', 'sql_type', 'query', 'args', 'cur', 'log_query_params', 'bulk', 'aio', 'started',
+                 'duration', 'error', 'context')
+
+    def __init__(self, name, sql_type, query, args, cur, log_query_params=True, bulk=False, aio=False):
+        self.name = name
+        self.sql_type = sql_type
+        self.query = query
+        self.args = args
+        self.cur = cur
+        self.log_query_params = log_query_params
+        self.bulk = bulk
+        self.aio = aio
+        self.started = None
+        self.duration = None
+        self.error = None
+        self.context = {}
+
+
+class Hooks(object):
+    """
+    The callbacks of a :class:`sqlpy.Queries` object, keyed by hook name.
+
+    Each callback is called with the :class:`QueryEvent`. An exception raised by a
+    callback is logged and does not affect the query.
+    """
+    def __init__(self):
+        self.callbacks = dict((hook, ()) for hook in HOOK_NAMES)
+        #: Weather any callback is registered
+        self.active = False
+
+    def add(self, hook, callback):
+        """
+        Registers a callback for ``before_execute``, ``after_execute`` or ``on_error``.
+        """
+        self._check(hook)
+        # replaced rather than appended, so running queries iterate a stable tuple
+        self.callbacks[hook] = self.callbacks[hook] + (callback,)
+        self.active = True
+
+    def remove(self, hook, callback):
+        """
+        Removes a callback registered with :meth:`add`.
+        """
+        self._check(hook)
+        self.callbacks[hook] = tuple(cb for cb in self.callbacks[hook] if cb != callback)
+        self.active = any(self.callbacks.values())
+
+    @staticmethod
+    def _check(hook):
+        if hook not in HOOK_NAMES:
+            raise SQLpyException('Unknown hook "{}", expected one of {}'.format(hook, ', '.join(HOOK_NAMES)))
+
+    def _call(self, hook, event):
+        for callback in self.callbacks[hook]:
+            try:
+                callback(event)
+            except Exception:
+                logger.error('Exception raised by "{}" hook {!r} of query "{}"'.format(hook, callback, event.name),
+                             exc_info=True)
+
+    def before_execute(self, name, sql_type, query, args, cur, log_query_params=True, bulk=False, aio=False):
+        """
+        Creates the event of an execution and calls the ``before_execute`` callbacks.
+
+        Returns:
+            :class:`QueryEvent`
+        """
+        event = QueryEvent(name, sql_type, query, args, cur, log_query_params, bulk, aio)
+        self._call('before_execute', event)
+        event.started = timer()
+        return event
+
+    def after_execute(self, event):
+        """Calls the ``after_execute`` callbacks of an execution."""
+        event.duration = timer() - event.started
+        self._call('after_execute', event)
+
+    def on_error(self, event, error):
+        """Calls the ``on_error`` callbacks of an execution."""
+        event.duration = timer() - event.started
+        event.error = error
+        self._call('on_error', event)
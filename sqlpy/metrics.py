@@ -0,0 +1,310 @@
+"""
+Per query execution metrics, enabled with ``sqlpy.Queries(..., metrics=True)``.
+
+Each prepared function records its calls, errors, rows returned and the latency of its
+build, execute and fetch phases into a :class:`QueryMetrics`. The counters are kept in
+per-thread shards, so recording takes no lock, and are only summed when read. The shard of
+a thread which has ended is folded into a retired total, so the shards do not grow with
+every thread ever seen. The pools
+bound with :meth:`sqlpy.Queries.bind` record their checkouts into a :class:`PoolMetrics`.
+"""
+from __future__ import print_function, absolute_import
+import threading
+import weakref
+from bisect import bisect_left
+from collections import namedtuple
+from .config import LATENCY_BUCKETS
+
+#: The phases of a query call, in order
+PHASES = ('build', 'execute', 'fetch')
+
+#: Snapshot of the latency histogram of a phase, ``buckets`` are cumulative
+#: ``(upper bound, count)`` pairs ending with ``float('inf')``
+LatencyStats = namedtuple('LatencyStats', ['count', 'sum', 'buckets'])
+
+#: Snapshot of the metrics of a query
+QueryStats = namedtuple('QueryStats', ['name', 'sql_type', 'calls', 'errors', 'rows', 'build', 'execute', 'fetch'])
+
+#: Snapshot of the metrics of a connection pool bound with :meth:`sqlpy.Queries.bind`
+PoolStats = namedtuple('PoolStats', ['name', 'checkouts', 'errors', 'wait'])
+
+# layout of a query shard: calls, errors, rows, then count, sum and bucket counts per phase
+_CALLS, _ERRORS, _ROWS, _PHASES_START = 0, 1, 2, 3
+# layout of a pool shard: checkouts, errors, then count, sum and bucket counts of the wait
+_CHECKOUTS, _CHECKOUT_ERRORS, _WAIT = 0, 1, 2
+
+
+class _ShardOwner(object):
+    """Held only by the thread local of a shard, so it is dropped when its thread ends"""
+    __slots__ = ('__weakref__',)
+
+
+class ShardedMetrics(object):
+    """
+    Counters and latency histograms kept in per-thread shards of ``counters`` slots
+    followed by one histogram per phase.
+
+    Args:
+        counters (:obj:`int`): number of plain counters at the start of a shard
+        phases (:obj:`int`): number of latency histograms
+        buckets (:obj:`tuple` of :obj:`float`): latency histogram bucket bounds in seconds
+    """
+    def __init__(self, counters, phases, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # count, sum, one slot per bucket and one for +Inf
+        self._phase_size = len(self.buckets) + 3
+        self._shard_size = counters + phases * self._phase_size
+        self._local = threading.local()
+        self._shards = []
+        # the counts of the shards of the threads which have ended
+        self._retired = [0] * self._shard_size
+        self._owners = set()
+        # reentrant, a shard may be retired by the thread holding the lock
+        self._lock = threading.RLock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = [0] * self._shard_size
+            owner = _ShardOwner()
+            with self._lock:
+                self._shards.append(shard)
+                self._owners.add(weakref.ref(owner, lambda ref: self._retire(ref, shard)))
+            self._local.owner = owner
+            self._local.shard = shard
+            return shard
+
+    def _retire(self, ref, shard):
+        """Folds the shard of an ended thread into the retired total"""
+        with self._lock:
+            self._owners.discard(ref)
+            self._shards = [other for other in self._shards if other is not shard]
+            self._retired = [total + value for total, value in zip(self._retired, shard)]
+
+    def _observe(self, shard, phase, seconds):
+        shard[phase] += 1
+        shard[phase + 1] += seconds
+        shard[phase + 2 + bisect_left(self.buckets, seconds)] += 1
+
+    def _totals(self):
+        with self._lock:
+            shards = self._shards + [self._retired]
+        return [sum(values) for values in zip(*shards)]
+
+    def _latency(self, total, start):
+        cumulative = 0
+        buckets = []
+        for bound, count in zip(self.buckets + (float('inf'),), total[start + 2:start + self._phase_size]):
+            cumulative += count
+            buckets.append((bound, cumulative))
+        return LatencyStats(total[start], total[start + 1], tuple(buckets))
+
+
+class QueryMetrics(ShardedMetrics):
+    """
+    Metrics of a single query.
+
+    Args:
+        name (:obj:`str`): name of the query
+        sql_type (:class:`sqlpy.config.QueryType`): type of the query
+        buckets (:obj:`tuple` of :obj:`float`, optional): latency histogram bucket bounds
+            in seconds, defaults to :class:`sqlpy.config.LATENCY_BUCKETS`
+    """
+    def __init__(self, name, sql_type, buckets=LATENCY_BUCKETS):
+        super(QueryMetrics, self).__init__(_PHASES_START, len(PHASES), buckets)
+        self.name = name
+        self.sql_type = sql_type
+        self._build = _PHASES_START
+        self._execute = self._build + self._phase_size
+        self._fetch = self._execute + self._phase_size
+
+    def record(self, started, executing, executed, fetched=None, rows=0):
+        """
+        Records a call from the :func:`timeit.default_timer` readings taken at its start,
+        before and after executing, and after fetching the rows. ``fetched`` is ``None``
+        for calls without a fetch phase.
+        """
+        shard = self._shard()
+        shard[_CALLS] += 1
+        shard[_ROWS] += rows
+        self._observe(shard, self._build, executing - started)
+        self._observe(shard, self._execute, executed - executing)
+        if fetched is not None:
+            self._observe(shard, self._fetch, fetched - executed)
+
+    def record_fetch(self, seconds, rows):
+        """Records the fetch phase of a streamed call, once the stream is finished."""
+        shard = self._shard()
+        shard[_ROWS] += rows
+        self._observe(shard, self._fetch, seconds)
+
+    def record_error(self, call=True):
+        """Records a failed call, ``call=False`` when the call was already recorded."""
+        shard = self._shard()
+        if call:
+            shard[_CALLS] += 1
+        shard[_ERRORS] += 1
+
+    def stats(self):
+        """
+        Returns:
+            :class:`QueryStats`: the metrics summed over every thread
+        """
+        total = self._totals()
+        phases = [self._latency(total, start) for start in (self._build, self._execute, self._fetch)]
+        return QueryStats(self.name, self.sql_type, total[_CALLS], total[_ERRORS], total[_ROWS], *phases)
+
+
+class PoolMetrics(ShardedMetrics):
+    """
+    Metrics of a connection pool: the connections checked out, the failed checkouts and
+    the time spent waiting for a connection.
+
+    Args:
+        name (:obj:`str`): name the pool was bound with
+        buckets (:obj:`tuple` of :obj:`float`, optional): latency histogram bucket bounds
+            in seconds, defaults to :class:`sqlpy.config.LATENCY_BUCKETS`
+    """
+    def __init__(self, name, buckets=LATENCY_BUCKETS):
+        super(PoolMetrics, self).__init__(_WAIT, 1, buckets)
+        self.name = name
+
+    def record_checkout(self, seconds):
+        """Records a connection checked out after waiting ``seconds``."""
+        shard = self._shard()
+        shard[_CHECKOUTS] += 1
+        self._observe(shard, _WAIT, seconds)
+
+    def record_error(self):
+        """Records a failed checkout."""
+        self._shard()[_CHECKOUT_ERRORS] += 1
+
+    def stats(self):
+        """
+        Returns:
+            :class:`PoolStats`: the metrics summed over every thread
+        """
+        total = self._totals()
+        return PoolStats(self.name, total[_CHECKOUTS], total[_CHECKOUT_ERRORS], self._latency(total, _WAIT))
+
+
+class MetricsRegistry(object):
+    """
+    The :class:`QueryMetrics` of the queries of a :class:`sqlpy.Queries` object.
+
+    Args:
+        buckets (:obj:`tuple` of :obj:`float`, optional): latency histogram bucket bounds
+            in seconds, defaults to :class:`sqlpy.config.LATENCY_BUCKETS`
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._queries = {}
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def query(self, name, sql_type):
+        """
+        Returns the :class:`QueryMetrics` of a query, created on first use. A reloaded query
+        of the same name and type keeps adding to the same metrics.
+        """
+        key = (name, sql_type)
+        with self._lock:
+            metrics = self._queries.get(key)
+            if metrics is None:
+                metrics = self._queries[key] = QueryMetrics(name, sql_type, self.buckets)
+        return metrics
+
+    def pool(self, name):
+        """
+        Returns the :class:`PoolMetrics` of a bound pool, created on first use.
+        """
+        with self._lock:
+            metrics = self._pools.get(name)
+            if metrics is None:
+                metrics = self._pools[name] = PoolMetrics(name, self.buckets)
+        return metrics
+
+    def pool_stats(self):
+        """
+        Returns:
+            :obj:`dict`: :class:`PoolStats` keyed by the pool name
+        """
+        with self._lock:
+            pools = list(self._pools.values())
+        return dict((metrics.name, metrics.stats()) for metrics in pools)
+
+    def stats(self):
+        """
+        Returns:
+            :obj:`dict`: :class:`QueryStats` keyed by the query name
+        """
+        with self._lock:
+            queries = list(self._queries.values())
+        return dict((metrics.name, metrics.stats()) for metrics in queries)
+
+    def prometheus(self, prefix='sqlpy'):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        Args:
+            prefix (:obj:`str`, optional): prefix of the metric names
+
+        Returns:
+            :obj:`str`
+        """
+        stats = sorted(self.stats().values(), key=lambda s: s.name)
+        lines = []
+        for metric, help_text, field in (('query_calls_total', 'Calls of each query.', 'calls'),
+                                         ('query_errors_total', 'Calls of each query which raised.', 'errors'),
+                                         ('query_rows_total', 'Rows returned by each query.', 'rows')):
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, help_text))
+            lines.append('# TYPE {}_{} counter'.format(prefix, metric))
+            for s in stats:
+                lines.append('{}_{}{{{}}} {}'.format(prefix, metric, _labels(s), getattr(s, field)))
+        metric = '{}_query_duration_seconds'.format(prefix)
+        lines.append('# HELP {} Latency of the build, execute and fetch phases of each query.'.format(metric))
+        lines.append('# TYPE {} histogram'.format(metric))
+        for s in stats:
+            for phase in PHASES:
+                latency = getattr(s, phase)
+                labels = _labels(s, phase)
+                for bound, count in latency.buckets:
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, _format_bound(bound), count))
+                lines.append('{}_sum{{{}}} {!r}'.format(metric, labels, float(latency.sum)))
+                lines.append('{}_count{{{}}} {}'.format(metric, labels, latency.count))
+        pools = sorted(self.pool_stats().values(), key=lambda s: s.name)
+        if pools:
+            for metric, help_text, field in (('pool_checkouts_total', 'Connections checked out of each pool.',
+                                              'checkouts'),
+                                             ('pool_checkout_errors_total', 'Failed checkouts of each pool.',
+                                              'errors')):
+                lines.append('# HELP {}_{} {}'.format(prefix, metric, help_text))
+                lines.append('# TYPE {}_{} counter'.format(prefix, metric))
+                for s in pools:
+                    lines.append('{}_{}{{pool="{}"}} {}'.format(prefix, metric, _escape(s.name), getattr(s, field)))
+            metric = '{}_pool_wait_seconds'.format(prefix)
+            lines.append('# HELP {} Time spent waiting for a connection of each pool.'.format(metric))
+            lines.append('# TYPE {} histogram'.format(metric))
+            for s in pools:
+                labels = 'pool="{}"'.format(_escape(s.name))
+                for bound, count in s.wait.buckets:
+                    lines.append('{}_bucket{{{},le="{}"}} {}'.format(metric, labels, _format_bound(bound), count))
+                lines.append('{}_sum{{{}}} {!r}'.format(metric, labels, float(s.wait.sum)))
+                lines.append('{}_count{{{}}} {}'.format(metric, labels, s.wait.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(stats, phase=None):
+    labels = 'query="{}",type="{}"'.format(_escape(stats.name), stats.sql_type.name)
+    if phase:
+        labels += ',phase="{}"'.format(phase)
+    return labels
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(float(bound))
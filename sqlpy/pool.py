@@ -0,0 +1,147 @@
+"""
+Functions bound to a connection pool, created with :meth:`sqlpy.Queries.bind`.
+
+A bound function checks out a connection, opens a cursor, calls the prepared function,
+commits, and gives the connection back, so call sites no longer pass a cursor or manage
+transactions.
+"""
+from __future__ import print_function, absolute_import
+import logging
+import types
+from timeit import default_timer as timer
+from .exceptions import SQLpyException
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+
+class ConnectionSource(object):
+    """
+    Where a bound :class:`sqlpy.Queries` gets its connections from.
+
+    ``pool`` is either a pool with ``getconn()`` and ``putconn(conn, close=False)`` methods,
+    such as psycopg2's ``SimpleConnectionPool`` and ``ThreadedConnectionPool``, or a
+    callable returning a new connection, closed after each call.
+
+    Raises:
+        SQLpyException: When ``pool`` is neither.
+    """
+    def __init__(self, pool):
+        if hasattr(pool, 'getconn') and hasattr(pool, 'putconn'):
+            self._factory = None
+        elif callable(pool):
+            self._factory = pool
+        else:
+            raise SQLpyException('"pool" must have getconn and putconn methods, or be a connection factory')
+        self.pool = pool
+
+    def acquire(self):
+        if self._factory is not None:
+            return self._factory()
+        return self.pool.getconn()
+
+    def release(self, conn, discard=False):
+        """Gives ``conn`` back, closing it when ``discard`` or it came from a factory."""
+        if self._factory is not None:
+            conn.close()
+        else:
+            self.pool.putconn(conn, close=discard)
+
+
+class BoundQueries(object):
+    """
+    View of a :class:`sqlpy.Queries` object whose functions run on a connection of a pool.
+
+    Each call checks out a connection, opens a cursor, calls the function of the same
+    name with it and the given arguments, then commits, or rolls back when it raises or
+    ``commit=False``. The connection is given back once the results are fetched, or once a
+    ``stream=True`` generator is exhausted or closed.
+
+    Args:
+        queries (:class:`sqlpy.Queries`): the queries called
+        pool: a pool or a connection factory, see :class:`ConnectionSource`
+        commit (:obj:`bool`, optional): Weather to commit after each successful call
+        metrics (:class:`sqlpy.metrics.PoolMetrics`): records the checkouts and wait time
+    """
+    def __init__(self, queries, pool, commit=True, metrics=None):
+        self._queries = queries
+        self._source = ConnectionSource(pool)
+        self._commit = commit
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self._queries.available_queries:
+            raise AttributeError(name)
+
+        def fn(*args, **kwargs):
+            return self._call(name, args, kwargs)
+        fn.__name__ = str(name)
+        fn.__doc__ = getattr(self._queries, name).__doc__
+        # the function is looked up on every call, so reloaded queries are picked up
+        self.__dict__[name] = fn
+        return fn
+
+    @property
+    def available_queries(self):
+        return self._queries.available_queries
+
+    def _checkout(self):
+        waiting = timer()
+        try:
+            conn = self._source.acquire()
+        except Exception:
+            if self.metrics is not None:
+                self.metrics.record_error()
+            raise
+        if self.metrics is not None:
+            self.metrics.record_checkout(timer() - waiting)
+        return conn
+
+    def _call(self, name, args, kwargs):
+        conn = self._checkout()
+        cur = None
+        try:
+            cur = conn.cursor()
+            result = getattr(self._queries, name)(cur, *args, **kwargs)
+        except Exception:
+            self._finish(conn, cur, False)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return self._stream(result, conn, cur)
+        self._finish(conn, cur, True)
+        return result
+
+    def _stream(self, rows, conn, cur):
+        ok = False
+        try:
+            for row in rows:
+                yield row
+            ok = True
+        finally:
+            rows.close()
+            self._finish(conn, cur, ok)
+
+    def _finish(self, conn, cur, ok):
+        discard = False
+        try:
+            if cur is not None:
+                cur.close()
+            if ok and self._commit:
+                conn.commit()
+            else:
+                conn.rollback()
+        except Exception:
+            # a connection which can not end its transaction is not reused
+            discard = True
+            if ok:
+                raise
+            logger.error('Could not roll back a pooled connection', exc_info=True)
+        finally:
+            self._source.release(conn, discard)
+
+    def pool_stats(self):
+        """
+        Returns:
+            :class:`sqlpy.metrics.PoolStats`: the checkouts and wait time of the pool
+        """
+        return self.metrics.stats()
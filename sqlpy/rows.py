@@ -0,0 +1,180 @@
+"""
+Row types of query results, set with ``sqlpy.Queries(..., row_type=)`` or per call.
+
+The rows fetched from the cursor are converted a batch at a time to tuples, namedtuples,
+instances of a generated ``__slots__`` class, or dicts. The row class of each query is
+built from ``cursor.description`` on first use and cached by a :class:`RowFactory`, it is
+only rebuilt when the column names change.
+"""
+from __future__ import print_function, absolute_import
+import re
+from collections import namedtuple
+from itertools import starmap
+from operator import itemgetter
+from .exceptions import SQLpyException
+
+#: The supported ``row_type`` values, ``None`` leaves the rows as the cursor returns them
+ROW_TYPES = ('tuple', 'namedtuple', 'slots', 'dict')
+
+_not_ident_re = re.compile(r'\W')
+
+
+def check_row_type(row_type):
+    """
+    Helper function to validate a ``row_type``.
+
+    Raises:
+        SQLpyException: When ``row_type`` is not ``None`` or one of :data:`ROW_TYPES`.
+    """
+    if row_type is not None and row_type not in ROW_TYPES:
+        raise SQLpyException('"row_type" must be None or one of {}'.format(', '.join(ROW_TYPES)))
+
+
+def row_class_name(name):
+    """Helper function turning a query name into a valid class name"""
+    name = _not_ident_re.sub('_', name) or 'Row'
+    return 'Row_' + name if name[0].isdigit() else name
+
+
+def row_fields(names):
+    """
+    Helper function returning the attribute names of the columns ``names``.
+
+    Names which are not valid identifiers, keywords, duplicates or starting with an
+    underscore are replaced by ``_<index>``, as with ``namedtuple(..., rename=True)``.
+    """
+    return namedtuple('Row', names, rename=True)._fields
+
+
+class SlotsRow(object):
+    """
+    Base class of the ``row_type='slots'`` row classes, made by :func:`make_slots_class`.
+
+    Rows compare equal to rows of the same class with the same values, iterate over their
+    values in column order and convert to a dict with :meth:`_asdict`.
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __iter__(self):
+        for field in self._fields:
+            yield getattr(self, field)
+
+    def __len__(self):
+        return len(self._fields)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and tuple(self) == tuple(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,
+                               ', '.join('{}={!r}'.format(field, getattr(self, field)) for field in self._fields))
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+
+def make_slots_class(class_name, fields):
+    """
+    Builds a :class:`SlotsRow` subclass with a ``__slots__`` entry per field, constructed
+    from the values of a row in column order.
+
+    The ``__init__`` is generated to assign each field directly, so a row costs one call.
+    """
+    source = 'def __init__({}):\n{}'.format(
+        ', '.join(('self',) + tuple(fields)),
+        ''.join('    self.{0} = {0}\n'.format(field) for field in fields) or '    pass\n')
+    namespace = {}
+    exec(source, namespace)
+    # a native str, as type() requires on Python 2
+    return type(str(class_name), (SlotsRow,), {'__slots__': tuple(fields), '_fields': tuple(fields),
+                                               '__init__': namespace['__init__']})
+
+
+def make_converter(row_type, names, class_name='Row'):
+    """
+    Creates the function converting a batch of rows with the columns ``names``.
+
+    Args:
+        row_type (:obj:`str`): one of :data:`ROW_TYPES`
+        names (:obj:`tuple` of :obj:`str`): the column names, in order
+        class_name (:obj:`str`, optional): name of the namedtuple or slots class
+
+    Returns:
+        :obj:`callable`: taking a :obj:`list` of rows, as sequences or dicts, and
+            returning a :obj:`list` of rows of ``row_type``
+    """
+    if row_type == 'dict':
+        def convert(rows):
+            if not rows or isinstance(rows[0], dict):
+                return [dict(row) for row in rows]
+            return [dict(zip(names, row)) for row in rows]
+        return convert
+
+    if row_type == 'tuple':
+        make = None
+    elif row_type == 'namedtuple':
+        make = namedtuple(class_name, names, rename=True)
+    else:
+        make = make_slots_class(class_name, row_fields(names))
+    values = itemgetter(*names) if len(names) > 1 else None
+
+    def convert(rows):
+        if not rows:
+            return []
+        if isinstance(rows[0], dict):
+            rows = [values(row) for row in rows] if values else [(row[names[0]],) for row in rows]
+        if make is None:
+            return rows if type(rows[0]) is tuple else list(map(tuple, rows))
+        return list(starmap(make, rows))
+    convert.row_class = make
+    return convert
+
+
+class RowFactory(object):
+    """
+    The cached row converters of a query, one per ``row_type``.
+
+    Args:
+        name (:obj:`str`): name of the query, used as the name of its row classes
+    """
+    __slots__ = ('class_name', '_converters')
+
+    def __init__(self, name):
+        self.class_name = row_class_name(name)
+        self._converters = {}
+
+    def converter(self, cur, row_type):
+        """
+        Returns the converter of the result of ``cur`` to ``row_type``, built when the
+        column names differ from the last result.
+
+        Returns:
+            :obj:`callable`: see :func:`make_converter`, ``None`` when ``cur`` has no result
+        """
+        description = cur.description
+        if not description:
+            return None
+        names = tuple(column[0] for column in description)
+        cached = self._converters.get(row_type)
+        if cached is not None and cached[0] == names:
+            return cached[1]
+        convert = make_converter(row_type, names, self.class_name)
+        # replaced as a whole, so concurrent calls see either converter
+        self._converters[row_type] = (names, convert)
+        return convert
+
+    def convert(self, cur, row_type, rows):
+        """
+        Converts a batch of rows fetched from ``cur``.
+
+        Returns:
+            :obj:`list`: the rows as ``row_type``
+        """
+        convert = self.converter(cur, row_type)
+        return convert(rows) if convert is not None else rows
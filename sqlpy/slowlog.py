@@ -0,0 +1,136 @@
+"""
+Slow query log, enabled with ``sqlpy.Queries(..., slow_query_log=SlowQueryLog(threshold))``.
+
+Executions slower than the threshold are logged as a warning and kept in a bounded ring
+buffer, optionally with the ``EXPLAIN (FORMAT JSON)`` plan of the query. The log is an
+``after_execute`` hook, see :meth:`sqlpy.Queries.add_hook`.
+"""
+from __future__ import print_function, absolute_import
+import logging
+import random
+import threading
+import time
+from collections import deque, namedtuple
+from timeit import default_timer as timer
+from .config import QueryType
+
+# get the module logger
+logger = logging.getLogger(__name__)
+
+#: Stored in place of the arguments of functions called with ``log_query_params=False``
+REDACTED = '<redacted>'
+
+#: Stored in place of the rows of ``many=True`` and ``copy=True`` calls, as
+#: ``'<N rows>'`` when their number is known
+BULK_ROWS = '<rows>'
+
+#: A slow execution, ``time`` is the wall clock time it finished at
+SlowQuery = namedtuple('SlowQuery', ['name', 'sql_type', 'query', 'args', 'duration', 'time', 'plan'])
+
+
+class SlowQueryLog(object):
+    """
+    Records the executions taking at least ``threshold`` seconds.
+
+    With ``explain=True`` a sample of the slow executions are explained, on a new cursor of
+    the same connection so the results of the query are left untouched. Within a transaction
+    the ``EXPLAIN`` runs in a savepoint, so a failing ``EXPLAIN`` does not abort it.
+    PostgreSQL only, the executions of :class:`sqlpy.AsyncQueries` are not explained.
+
+    Args:
+        threshold (:obj:`float`): execution time in seconds from which a query is slow
+        explain (:obj:`bool`, optional): Weather to capture the ``EXPLAIN (FORMAT JSON)`` plan
+            of slow queries.
+        explain_sample_rate (:obj:`float`, optional): fraction of the slow executions explained
+        explain_interval (:obj:`float`, optional): minimum seconds between two plans captured
+            for the same query
+        maxlen (:obj:`int`, optional): number of slow executions kept, the oldest are dropped
+    """
+    def __init__(self, threshold, explain=False, explain_sample_rate=1.0, explain_interval=60.0, maxlen=100):
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_sample_rate = explain_sample_rate
+        self.explain_interval = explain_interval
+        self.entries = deque(maxlen=maxlen)
+        self._last_explained = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        """Records ``event`` if it is slow, called as an ``after_execute`` hook."""
+        if event.duration < self.threshold:
+            return
+        logger.warning('Slow query "{}" executed in {:.3f}s'.format(event.name, event.duration))
+        plan = None
+        # a bulk call has no single statement to explain, and the hook can not await the
+        # cursor of an async call
+        if self.explain and not event.bulk and not event.aio and self._sample(event.name):
+            plan = explain_query(event)
+        if not event.log_query_params:
+            args = REDACTED
+        elif event.bulk:
+            # the rows would be kept alive by the ring buffer
+            args = '<{} rows>'.format(len(event.args)) if hasattr(event.args, '__len__') else BULK_ROWS
+        else:
+            args = event.args
+        self.entries.append(SlowQuery(event.name, event.sql_type, event.query, args, event.duration,
+                                      time.time(), plan))
+
+    def _sample(self, name):
+        if self.explain_sample_rate < 1 and random.random() >= self.explain_sample_rate:
+            return False
+        now = timer()
+        with self._lock:
+            last = self._last_explained.get(name)
+            if last is not None and now - last < self.explain_interval:
+                return False
+            self._last_explained[name] = now
+        return True
+
+    def dump(self):
+        """
+        Returns:
+            :obj:`list` of :obj:`dict`: the recorded slow executions, oldest first
+        """
+        return [dict(entry._asdict(), sql_type=entry.sql_type.name) for entry in list(self.entries)]
+
+    def clear(self):
+        """Drops the recorded slow executions."""
+        self.entries.clear()
+
+
+def explain_query(event):
+    """
+    Captures the ``EXPLAIN (FORMAT JSON)`` plan of an executed query.
+
+    Returns:
+        The plan, or ``None`` when the query can not be explained
+    """
+    conn = getattr(event.cur, 'connection', None)
+    if conn is None or event.sql_type == QueryType.CALL_PROC:
+        return None
+    # autocommit connections have no transaction to protect
+    savepoint = not getattr(conn, 'autocommit', True)
+    cur = conn.cursor()
+    try:
+        if savepoint:
+            cur.execute('SAVEPOINT sqlpy_explain')
+        try:
+            cur.execute('EXPLAIN (FORMAT JSON) ' + event.query, event.args)
+            row = cur.fetchone()
+        except Exception:
+            if savepoint:
+                cur.execute('ROLLBACK TO SAVEPOINT sqlpy_explain')
+            raise
+        if savepoint:
+            cur.execute('RELEASE SAVEPOINT sqlpy_explain')
+    except Exception:
+        logger.warning('Could not explain slow query "{}"'.format(event.name), exc_info=True)
+        return None
+    finally:
+        try:
+            cur.close()
+        except Exception:
+            pass
+    if isinstance(row, dict):
+        return next(iter(row.values()))
+    return row[0] if row else None
@@ -1,9 +1,33 @@
 from __future__ import print_function, absolute_import
+import glob
+import mmap
+import multiprocessing
 import os
-from .config import (extensions, quote_ident, STRICT_BUILT_PARSE, UPPERCASE_QUERY_NAME,
-                     LOG_QUERY_PARAMS, QueryType, execute_values)
+import re
+import tempfile
+import threading
+import uuid
+import weakref
+from hashlib import sha1
+try:
+    import cPickle as pickle
+except ImportError:  # pragma: no cover
+    import pickle
+from .config import (VERSION, extensions, quote_ident, UPPERCASE_QUERY_NAME, BUILT_CACHE_SIZE, IDENTIFIERS_CACHE_SIZE,
+                     QUOTED_IDENT_CACHE_SIZE,
+                     STREAM_BATCH_SIZE, SERVER_SIDE_ITERSIZE, QueriesConfig, DEFAULT_CONFIG, PREPARED_CACHE_SIZE, MMAP_MIN_SIZE, WORKERS_MIN_SIZE, MANY_PAGE_SIZE, COPY_BUFFER_SIZE, QueryType,
+                     ProcessPoolExecutor)
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
 from functools import partial
 from itertools import takewhile
+from timeit import default_timer as timer
+from .bulk import check_many_args, copy_rows, execute_many, fetch_many, iter_many, iter_returning
+from .columnar import check_columnar_args, fetch_columns
+from .rows import RowFactory, check_row_type
+from .hooks import Hooks
+from .metrics import MetricsRegistry, PoolMetrics
+from .pool import BoundQueries
 from .exceptions import (SQLpyException, SQLLoadException,
                          SQLParseException, SQLArgumentException)
 import logging
@@ -22,6 +46,360 @@ def log_query(query, args, log_query_params):
         logger.info('Arguments: {}'.format(args))
 
 
+def check_fetch_args(n, stream, batch_size):
+    """
+    Helper function to validate the result fetching arguments of a query function
+    """
+    if n and (not isinstance(n, int) or n < 1):
+        raise SQLpyException('"n" must be an Integer >= 1')
+    if batch_size is not None and (not isinstance(batch_size, int) or batch_size < 1):
+        raise SQLpyException('"batch_size" must be an Integer >= 1')
+    if n and stream:
+        raise SQLpyException('"n" can not be used with "stream"')
+
+
+def fetch_results(cur, n=None, stream=False, batch_size=None, close=None, metrics=None, started=0, executing=0,
+                  convert=None):
+    """
+    Helper function to avoid repeating the result fetching block
+
+    Args:
+        cur (:obj:`cursor`): cursor object the query was executed on
+        n (:obj:`int`): number of results to fetch, all if ``None``
+        stream (:obj:`bool`): return a generator of rows instead of a list
+        batch_size (:obj:`int`): rows fetched per ``fetchmany`` call when streaming
+        close (:obj:`callable`, optional): called once the results have been fetched
+        metrics (:class:`sqlpy.metrics.QueryMetrics`, optional): records the call, from
+            the ``started`` and ``executing`` timer readings of the query function
+        convert (:obj:`callable`, optional): converts a list of fetched rows, see
+            :class:`sqlpy.rows.RowFactory`
+
+    Returns:
+        The rows, a single row for ``n=1``, or a generator of rows when streaming
+    """
+    if metrics is not None:
+        executed = timer()
+    if stream:
+        if metrics is not None:
+            metrics.record(started, executing, executed)
+        return iter_results(cur, batch_size or STREAM_BATCH_SIZE, close, metrics, convert)
+    try:
+        if not n:
+            rows = cur.fetchall()
+        elif n == 1:
+            rows = cur.fetchone()
+        else:
+            rows = cur.fetchmany(n)
+        if convert is not None:
+            if n == 1:
+                rows = convert([rows])[0] if rows is not None else None
+            else:
+                rows = convert(rows)
+    except Exception:
+        if metrics is not None:
+            metrics.record_error()
+        raise
+    finally:
+        if close is not None:
+            close()
+    if metrics is not None:
+        metrics.record(started, executing, executed, timer(),
+                       int(rows is not None) if n == 1 else len(rows) if rows else 0)
+    return rows
+
+
+def iter_results(cur, batch_size, close=None, metrics=None, convert=None):
+    """
+    Yields the rows of an executed query, fetching ``batch_size`` rows at a time.
+
+    Only one batch is held in memory. Rows not consumed when the generator is closed
+    early are left on the cursor and discarded by its next ``execute``.
+
+    Args:
+        cur (:obj:`cursor`): cursor object the query was executed on
+        batch_size (:obj:`int`): rows fetched per ``fetchmany`` call
+        close (:obj:`callable`, optional): called when the generator is exhausted or closed
+        metrics (:class:`sqlpy.metrics.QueryMetrics`, optional): records the rows and time
+            spent fetching, once the generator is exhausted or closed
+        convert (:obj:`callable`, optional): converts each batch of rows
+    """
+    fetch_time = 0
+    count = 0
+    try:
+        while True:
+            if metrics is not None:
+                fetching = timer()
+                try:
+                    rows = cur.fetchmany(batch_size)
+                except Exception:
+                    metrics.record_error(call=False)
+                    raise
+                fetch_time += timer() - fetching
+                count += len(rows)
+            else:
+                rows = cur.fetchmany(batch_size)
+            if not rows:
+                return
+            if convert is not None:
+                rows = convert(rows)
+            for row in rows:
+                yield row
+    finally:
+        if metrics is not None:
+            metrics.record_fetch(fetch_time, count)
+        if close is not None:
+            close()
+
+
+def server_side_cursor(cur, name, itersize=None):
+    """
+    Opens a named (server side) cursor on the connection behind ``cur``.
+
+    Rows of a query executed on a named cursor are kept on the server and transferred
+    ``itersize`` rows at a time. Only supported with psycopg2, the cursor factory of
+    ``cur`` is reused so the rows come back in the same shape.
+
+    Args:
+        cur (:obj:`cursor`): cursor object passed to the query function
+        name (:obj:`str`): name of the query, used as a prefix of the cursor name
+        itersize (:obj:`int`, optional): rows transferred per network round trip
+
+    Returns:
+        :obj:`cursor`: the named cursor, or ``None`` when ``cur`` is not a psycopg2 cursor
+    """
+    if extensions is None or not isinstance(cur, extensions.cursor):
+        return None
+    cursor_name = 'sqlpy_{}_{}'.format(name.lower(), uuid.uuid4().hex)
+    named_cur = cur.connection.cursor(cursor_name, cursor_factory=type(cur))
+    named_cur.itersize = itersize or SERVER_SIDE_ITERSIZE
+    return named_cur
+
+
+def close_quietly(cur):
+    """
+    Closes a cursor, logging rather than raising any error doing so.
+    """
+    try:
+        cur.close()
+    except Exception:
+        logger.warning('Could not close cursor "{}"'.format(getattr(cur, 'name', cur)), exc_info=True)
+
+
+#: Snapshot of the counters of a :class:`LRUCache`
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """
+    A small thread safe least recently used cache with hit and miss counters.
+
+    Args:
+        maxsize (:obj:`int`): Maximum number of entries held. ``0`` disables caching.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """
+        Returns the cached value for ``key`` and marks it as most recently used.
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """
+        Stores ``value`` under ``key``, evicting the least recently used entries if full.
+
+        Returns:
+            :obj:`list` of :obj:`tuple`: the evicted ``(key, value)`` pairs
+        """
+        if self.maxsize <= 0:
+            return []
+        evicted = []
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False))
+        return evicted
+
+    def pop(self, key, default=None):
+        """
+        Removes ``key``, without counting a hit or a miss.
+
+        Returns:
+            the value removed, or ``default``
+        """
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def keys(self):
+        """
+        Returns:
+            :obj:`list`: the keys, least recently used first
+        """
+        with self._lock:
+            return list(self._data)
+
+    def clear(self):
+        """
+        Removes all entries and resets the counters.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Returns:
+            :class:`CacheInfo`: ``(hits, misses, maxsize, currsize)``
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self._data))
+
+
+#: A query converted for execution as a server side prepared statement
+PreparedQuery = namedtuple('PreparedQuery', ['statement_name', 'query', 'arg_names'])
+
+
+def prepare_query(name, query):
+    """
+    Converts the parameters of a query into positional ``$n`` placeholders.
+
+    The parameters are found with :func:`scan_params`. ``format`` parameters are numbered
+    in order, each distinct ``pyformat`` parameter name gets one number, and ``%%``
+    escapes become ``%``. The statement name combines the query name with a hash of the
+    SQL, so different SQL under the same name never collide on a connection.
+
+    Args:
+        name (:obj:`str`): name of the query
+        query (:obj:`str`): the SQL statement
+
+    Returns:
+        :class:`PreparedQuery`: ``(statement_name, query, arg_names)`` where ``arg_names``
+            lists the ``pyformat`` names in placeholder order, or is ``None`` for ``format``
+            parameters. ``None`` when the query mixes both styles or can not be scanned.
+    """
+    try:
+        params = scan_params(query)
+    except SQLParseException:
+        return None
+    positional = 0
+    named = []
+    parts = []
+    offset = 0
+    for param in params:
+        parts.append(query[offset:param.start].replace('%%', '%'))
+        if param.name is None:
+            positional += 1
+            parts.append('${}'.format(positional))
+        else:
+            if param.name not in named:
+                named.append(param.name)
+            parts.append('${}'.format(named.index(param.name) + 1))
+        offset = param.end
+    parts.append(query[offset:].replace('%%', '%'))
+    if positional and named:
+        return None
+    statement_name = 'sqlpy_{}_{}'.format(re.sub(r'\W', '_', name.lower())[:40],
+                                          sha1(query.encode('utf-8')).hexdigest()[:8])
+    return PreparedQuery(statement_name, ''.join(parts), tuple(named) if named else None)
+
+
+class PreparedStatements(object):
+    """
+    Registry of the statements prepared on each connection.
+
+    A statement is prepared with ``PREPARE`` the first time it is executed on a connection,
+    and run with ``EXECUTE`` after that. Each connection keeps at most ``maxsize``
+    statements, the least recently used are released with ``DEALLOCATE``. Connections are
+    held by weak reference, so closed connections drop out of the registry.
+
+    Args:
+        maxsize (:obj:`int`): Maximum number of statements prepared per connection.
+    """
+    def __init__(self, maxsize=PREPARED_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._connections = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def statements(self, conn):
+        """
+        Returns:
+            :class:`LRUCache`: the statements prepared on ``conn``
+        """
+        with self._lock:
+            prepared = self._connections.get(conn)
+            if prepared is None:
+                prepared = self._connections[conn] = LRUCache(self.maxsize)
+            return prepared
+
+    def forget(self, conn):
+        """
+        Drops the record of the statements prepared on ``conn``, e.g. after ``DISCARD ALL``.
+        """
+        with self._lock:
+            self._connections.pop(conn, None)
+
+    def execute(self, cur, prepared, args):
+        """
+        Executes a :class:`PreparedQuery` on ``cur``, preparing it first if needed.
+
+        Args:
+            cur (:obj:`cursor`): cursor object
+            prepared (:class:`PreparedQuery`): the converted query
+            args (:obj:`tuple` or :obj:`dict`): the query arguments
+        """
+        statements = self.statements(cur.connection)
+        if statements.get(prepared.statement_name) is None:
+            cur.execute('PREPARE {} AS {}'.format(prepared.statement_name, prepared.query))
+            for statement_name, _ in statements.put(prepared.statement_name, True):
+                cur.execute('DEALLOCATE {}'.format(statement_name))
+        if prepared.arg_names is not None:
+            args = [args[arg] for arg in prepared.arg_names]
+        if args:
+            cur.execute('EXECUTE {} ({})'.format(prepared.statement_name, ', '.join(['%s'] * len(args))), args)
+        else:
+            cur.execute('EXECUTE {}'.format(prepared.statement_name))
+
+
+#: The process wide registry of prepared statements
+prepared_statements = PreparedStatements()
+
+
+def execute_query(cur, query, args, prepared=None):
+    """
+    Helper function executing a query, through its prepared statement when given one.
+
+    Prepared statements are only used with psycopg2 cursors, other cursors execute
+    ``query`` as normal.
+    """
+    if prepared is not None and extensions is not None and isinstance(cur, extensions.cursor):
+        try:
+            prepared_statements.execute(cur, prepared, args)
+        except Exception as e:
+            # invalid_sql_statement_name, the connection lost its prepared statements
+            if getattr(e, 'pgcode', None) == '26000':
+                prepared_statements.forget(cur.connection)
+            raise
+    else:
+        cur.execute(query, args)
+
+
 class Queries(object):
     """
     Builds the prepared functions of SQL statements for execution.
@@ -36,54 +414,653 @@ class Queries(object):
             the expected and supplied parameters to a SQL statement function.
         uppercase_name (:obj:`bool`, optional): Weather to cast the names of the SQL
             statement functions to uppercase.
+        built_cache_size (:obj:`int`, optional): Number of built SQL strings cached by each
+            ``$`` query, keyed by the names of the supplied arguments. ``0`` disables the cache.
+        query_options (:obj:`dict`, optional): Default call arguments of individual SQL
+            statement functions, keyed by the function name. e.g.
+            ``{'BIG_REPORT': {'server_side': True, 'itersize': 5000}}``
+        prepare (:obj:`bool`, optional): Weather to execute the SQL statement functions through
+            server side prepared statements by default. psycopg2 only.
+        lazy (:obj:`bool`, optional): Weather to only index the names of the SQL statements
+            when loading, and parse each one on first access of its function.
+        cache_dir (:obj:`str`, optional): Directory of an on-disk cache of the parsed SQL
+            files, keyed by their content. Not used when ``lazy``.
+        workers (:obj:`int`, optional): Number of processes parsing the SQL files, one file
+            per task, when there are several cores and at least
+            :data:`sqlpy.config.WORKERS_MIN_SIZE` bytes of SQL. Not used when ``lazy``.
+        metrics (:obj:`bool`, optional): Weather to record the calls, errors, rows and latency
+            of each SQL statement function, see :meth:`stats`.
+        slow_query_log (:class:`sqlpy.slowlog.SlowQueryLog`, optional): Records the SQL
+            statement functions executing slower than its threshold.
+        result_cache (:class:`sqlpy.cache.ResultCache`, optional): Caches the results of the
+            SQL statement functions called with ``cache_ttl``, see :mod:`sqlpy.cache`.
+        row_type (:obj:`str`, optional): Default type of the rows returned, ``'tuple'``,
+            ``'namedtuple'``, ``'slots'`` or ``'dict'``, see :mod:`sqlpy.rows`. ``None`` returns
+            the rows of the cursor as they are.
+
+    A query name found more than once is logged as a warning with both locations, the
+    statement loaded last, in file order, is kept.
     """
-    def __init__(self, filepath, strict_parse=False, uppercase_name=True, log_query_params=True):
+    def __init__(self, filepath, strict_parse=False, uppercase_name=True, log_query_params=True,
+                 built_cache_size=BUILT_CACHE_SIZE, query_options=None, prepare=False, lazy=False,
+                 cache_dir=None, workers=None, metrics=False, slow_query_log=None, result_cache=None,
+                 row_type=None):
         self.available_queries = []
-        global STRICT_BUILT_PARSE
-        STRICT_BUILT_PARSE = strict_parse
-        global UPPERCASE_QUERY_NAME
-        UPPERCASE_QUERY_NAME = uppercase_name
-        global LOG_QUERY_PARAMS
-        LOG_QUERY_PARAMS = log_query_params
-        for name, sql_type, fn in load_queries(filepath):
-            self.add_query(name, fn)
+        self._query_names = set()
+        self.query_options = query_options or {}
+        self._lazy = lazy
+        self._lazy_index = {}
+        self._lazy_lock = threading.Lock()
+        self._filepath = filepath
+        self._cache_dir = cache_dir
+        self._workers = workers
+        #: :class:`SQLFileState` of each loaded file, and the file of each query
+        self._files = OrderedDict()
+        self._query_files = {}
+        self._reload_lock = threading.Lock()
+        self._metrics = MetricsRegistry() if metrics else None
+        self._hooks = Hooks()
+        self.slow_query_log = slow_query_log
+        if slow_query_log is not None:
+            self._hooks.add('after_execute', slow_query_log)
+        self.result_cache = result_cache
+        #: :class:`sqlpy.config.QueriesConfig` the functions are made with
+        check_row_type(row_type)
+        self.config = QueriesConfig(strict_parse, uppercase_name, log_query_params, built_cache_size, prepare,
+                                    row_type)
+        files = expand_paths(filepath)
+        # stat before reading, so a change made while loading is picked up by reload
+        for file in files:
+            self._files[file] = SQLFileState(file_stat(file), None, [])
+        if lazy:
+            for name, location in index_queries(files, uppercase_name):
+                previous = self._lazy_index.get(name)
+                if previous:
+                    warn_duplicate(name, location[0], location[3], previous[0], previous[3])
+                self._lazy_index[name] = location
+                self._track_query(name, location[0])
+                if name not in self._query_names:
+                    self._query_names.add(name)
+                    self.available_queries.append(name)
+        else:
+            locations = {}
+            for definition in load_sql_definitions(files, cache_dir, workers, uppercase_name):
+                if definition.name in locations:
+                    warn_duplicate(definition.name, definition.file, definition.line, *locations[definition.name])
+                locations[definition.name] = (definition.file, definition.line)
+                self._track_query(definition.name, definition.file)
+                self.add_query(definition.name, self.make_query(definition))
         logger.info('Found and loaded {} sql queires'.format(len(self.available_queries)))
 
+    def __getattr__(self, name):
+        """
+        Parses and adds the function of a lazily loaded SQL statement on first access.
+        """
+        lazy_index = self.__dict__.get('_lazy_index')
+        if not lazy_index or name not in lazy_index:
+            raise AttributeError("'{}' object has no attribute '{}'".format(type(self).__name__, name))
+        with self._lazy_lock:
+            # another thread may have added it while waiting on the lock
+            if name not in self.__dict__:
+                file, offset, length, line = lazy_index[name]
+                definition = parse_sql_definition(read_query(file, offset, length), file, line,
+                                                  self.config.uppercase_name)
+                self.add_query(name, self.make_query(definition))
+                del lazy_index[name]
+        return self.__dict__[name]
+
     def __repr__(self):
         """
         Prints a list of available SQL statement function by name.
         """
         return "sqlpy.Queries(" + self.available_queries.__repr__() + ")"
 
+    def make_query(self, definition):
+        """
+        Creates the prepared function of a parsed SQL statement.
+
+        Args:
+            definition (:class:`SQLDefinition`)
+
+        Returns:
+            :obj:`functools.partial`
+        """
+        return QueryFnFactory.make_query(definition.query, definition.built, definition.sql_type,
+                                         definition.name, definition.doc, self.query_metrics(definition),
+                                         self._hooks, self.config, self.result_cache)
+
+    def query_metrics(self, definition):
+        """
+        Returns:
+            :class:`sqlpy.metrics.QueryMetrics`: the metrics of a SQL statement, or ``None``
+                when metrics are not enabled
+        """
+        if self._metrics is None:
+            return None
+        return self._metrics.query(definition.name, definition.sql_type)
+
     def add_query(self, name, fn):
         """
         Adds a function partial to the class object.
 
+        Any ``query_options`` given for ``name`` are bound as the default call arguments.
+
         Args:
             name (:obj:`str`)
             fn (:obj:`functools.partial`)
         """
+        options = self.query_options.get(name)
+        if options:
+            fn = with_defaults(fn, options)
         setattr(self, name, fn)
-        if name not in self.available_queries:
+        if name not in self._query_names:
+            self._query_names.add(name)
             self.available_queries.append(name)
 
+    def _track_query(self, name, file):
+        self._files[file].names.append(name)
+        self._query_files[name] = file
+
+    def reload(self):
+        """
+        Reloads the SQL files changed since they were loaded.
+
+        Only the files whose modification time or size changed, and whose content hash
+        differs, are parsed again. Their functions are replaced through :meth:`add_query`,
+        queries no longer in any file are removed and new files matching a directory or
+        glob pattern are added. The other functions are left as they are.
+
+        The changed files are parsed before any function is replaced, so an invalid
+        file raises and leaves every function as it was. Calls already running keep
+        using the function they started with.
+
+        Returns:
+            :class:`ReloadInfo`: ``(files, added, updated, removed)`` the reloaded files,
+                and the names of the added, updated and removed queries
+        """
+        with self._reload_lock:
+            files = expand_paths(self._filepath, missing_ok=True)
+            order = dict((file, i) for i, file in enumerate(files))
+            changed = []
+            for file in files:
+                stat = file_stat(file)
+                state = self._files.get(file)
+                if state is not None and state.stat == stat:
+                    continue
+                digest = file_digest(file)
+                if state is not None and state.digest == digest:
+                    self._files[file] = state._replace(stat=stat)
+                    continue
+                changed.append((file, SQLFileState(stat, digest, [])))
+            deleted = [file for file in self._files if file not in order]
+            if not changed and not deleted:
+                return ReloadInfo([], [], [], [])
+
+            # parse everything first, so an invalid file changes nothing
+            loaded = self._load_files([file for file, state in changed])
+            removed = set()
+            for file in [file for file, state in changed] + deleted:
+                if file not in self._files:
+                    continue
+                names = set(name for name, item in loaded.get(file, ()))
+                removed.update(name for name in self._files[file].names
+                               if name not in names and self._query_files.get(name) == file)
+            # a removed query may still be defined by an unchanged file
+            fallback = {}
+            for name in removed:
+                for file in reversed(files):
+                    if file not in loaded and name in self._files[file].names:
+                        fallback[name] = file
+                        break
+            fallback_files = sorted(set(fallback.values()), key=order.get)
+            loaded.update(self._load_files(fallback_files))
+
+            with self._lazy_lock:
+                for file in deleted:
+                    del self._files[file]
+                for file, state in changed:
+                    self._files[file] = state
+                for name in removed:
+                    del self._query_files[name]
+                added, updated = [], []
+                for file in sorted(loaded, key=order.get):
+                    reparsed = file not in fallback_files
+                    for name, item in loaded[file]:
+                        if reparsed:
+                            self._files[file].names.append(name)
+                        elif fallback.get(name) != file:
+                            continue
+                        owner = self._query_files.get(name)
+                        if owner is not None and owner != file and order.get(owner, -1) > order[file]:
+                            # defined again by a later file, which is kept
+                            continue
+                        (updated if name in self._query_names else added).append(name)
+                        self._query_files[name] = file
+                        self._set_query(name, item)
+                removed = sorted(name for name in removed if name not in self._query_files)
+                for name in removed:
+                    self._lazy_index.pop(name, None)
+                    self.__dict__.pop(name, None)
+                    self._query_names.discard(name)
+                if removed:
+                    # swapped rather than changed in place, for anyone iterating it
+                    removed_names = set(removed)
+                    self.available_queries = [name for name in self.available_queries if name not in removed_names]
+            if self.result_cache is not None:
+                # the results of the previous SQL
+                self.result_cache.clear(updated + removed)
+            reloaded = sorted(set(loaded).difference(fallback_files), key=order.get)
+            logger.info('Reloaded {} sql files, {} queries added, {} updated, {} removed'
+                        .format(len(reloaded), len(added), len(updated), len(removed)))
+            return ReloadInfo(reloaded, added, updated, removed)
+
+    def _load_files(self, files):
+        """
+        Parses, or indexes when lazy, SQL files for :meth:`reload`.
+
+        Returns:
+            :obj:`dict`: ``(name, definition or location)`` pairs keyed by file
+        """
+        loaded = OrderedDict((file, []) for file in files)
+        if not files:
+            return loaded
+        if self._lazy:
+            for name, location in index_queries(files, self.config.uppercase_name):
+                loaded[location[0]].append((name, location))
+        else:
+            for definition in load_sql_definitions(files, self._cache_dir, self._workers, self.config.uppercase_name):
+                loaded[definition.file].append((definition.name, definition))
+        return loaded
+
+    def _set_query(self, name, item):
+        if self._lazy:
+            self._lazy_index[name] = item
+            self.__dict__.pop(name, None)
+            if name not in self._query_names:
+                self._query_names.add(name)
+                self.available_queries.append(name)
+        else:
+            self.add_query(name, self.make_query(item))
+
+    def watch(self, interval=1.0):
+        """
+        Starts a background thread calling :meth:`reload` every ``interval`` seconds.
+
+        Errors while reloading, such as a file saved half way through an edit, are logged
+        and the functions are left as they were until the next poll.
+
+        Returns:
+            :class:`QueriesWatcher`: call its ``stop()`` to stop watching
+        """
+        watcher = QueriesWatcher(self, interval)
+        watcher.start()
+        return watcher
+
+    def add_hook(self, hook, callback):
+        """
+        Registers a callback around the execution of every SQL statement function.
+
+        ``before_execute`` callbacks are called just before the query is sent, ``after_execute``
+        once it has executed, before fetching any rows, and ``on_error`` when executing
+        raises. Each is called with a :class:`sqlpy.hooks.QueryEvent` giving the name, type,
+        SQL, arguments and cursor of the query, and the execution time. Callbacks run in
+        the calling thread, an exception raised by one is logged and ignored.
+
+        Args:
+            hook (:obj:`str`): ``'before_execute'``, ``'after_execute'`` or ``'on_error'``
+            callback (:obj:`callable`): called with the :class:`sqlpy.hooks.QueryEvent`
+        """
+        self._hooks.add(hook, callback)
+
+    def remove_hook(self, hook, callback):
+        """
+        Removes a callback registered with :meth:`add_hook`.
+        """
+        self._hooks.remove(hook, callback)
+
+    def batch(self, cur, mode=None):
+        """
+        Queues calls of the SQL statement functions to execute them together on ``cur``.
+
+        The functions of the returned batch take the same arguments, without the cursor,
+        and return a :class:`sqlpy.batch.BatchResult`. The calls are executed on exit of
+        the ``with`` block, in a single round trip when the driver allows it, see
+        :mod:`sqlpy.batch`.
+
+        .. code-block:: python
+
+            with sql.batch(cur) as batch:
+                user = batch.GET_USER((1,), n=1)
+                orders = batch.GET_ORDERS((1,))
+            user.value, orders.value
+
+        Args:
+            cur (:obj:`cursor`): the cursor the calls are executed on
+            mode (:obj:`str`, optional): ``'pipeline'``, ``'multi'`` or ``'sequential'``,
+                picked from the driver by default
+
+        Returns:
+            :class:`sqlpy.batch.QueryBatch`
+        """
+        # imported here, sqlpy.batch builds on this module
+        from .batch import QueryBatch
+        return QueryBatch(self, cur, mode)
+
+    def bind(self, pool, commit=True, name='default'):
+        """
+        Binds the SQL statement functions to a connection pool.
 
-def get_fn_name(line):
+        The functions of the returned view take the same arguments, without the cursor.
+        Each call checks out a connection, runs the query on a new cursor and commits, or
+        rolls back when it raises, before giving the connection back.
+
+        Args:
+            pool: A pool with ``getconn`` and ``putconn`` methods, such as psycopg2's
+                ``ThreadedConnectionPool``, or a callable returning a new connection, which
+                is closed after each call.
+            commit (:obj:`bool`, optional): Weather to commit after each call, ``False``
+                rolls every call back
+            name (:obj:`str`, optional): name of the pool in :meth:`stats_prometheus`
+
+        Returns:
+            :class:`sqlpy.pool.BoundQueries`
+        """
+        metrics = self._metrics.pool(name) if self._metrics is not None else PoolMetrics(name)
+        return BoundQueries(self, pool, commit, metrics)
+
+    def stats(self):
+        """
+        Reports the metrics of every SQL statement function called so far.
+
+        Returns:
+            :obj:`dict`: :class:`sqlpy.metrics.QueryStats` keyed by the function name, empty
+                when metrics are not enabled
+        """
+        if self._metrics is None:
+            return {}
+        return self._metrics.stats()
+
+    def stats_prometheus(self, prefix='sqlpy'):
+        """
+        Renders :meth:`stats`, and the wait time of the pools bound with :meth:`bind`, in the
+        Prometheus text exposition format.
+
+        Args:
+            prefix (:obj:`str`, optional): prefix of the metric names
+
+        Returns:
+            :obj:`str`
+        """
+        if self._metrics is None:
+            return ''
+        return self._metrics.prometheus(prefix)
+
+    def result_cache_info(self):
+        """
+        Reports the result cache hits and misses of every SQL statement function called
+        with ``cache_ttl``.
+
+        Returns:
+            :obj:`dict`: :class:`sqlpy.cache.QueryCacheInfo` keyed by the function name, empty
+                when no result cache is set
+        """
+        if self.result_cache is None:
+            return {}
+        return self.result_cache.info()
+
+    def built_cache_info(self):
+        """
+        Reports the built SQL cache counters of every ``$`` query.
+
+        Returns:
+            :obj:`dict`: :class:`CacheInfo` keyed by the function name
+        """
+        # only the loaded functions, without parsing lazy ones
+        fns = vars(self)
+        return {name: fns[name].__built_cache__.info() for name in self.available_queries
+                if getattr(fns.get(name), '__built_cache__', None) is not None}
+
+    def identifiers_cache_info(self):
+        """
+        Reports the counters of the SQL cached per query for calls with ``identifiers``.
+
+        Returns:
+            :obj:`dict`: :class:`CacheInfo` keyed by the function name, of the queries
+                called with ``identifiers``
+        """
+        # only the loaded functions, without parsing lazy ones
+        fns = vars(self)
+        caches = {name: getattr(fns.get(name), '__identifiers_cache__', None) for name in self.available_queries}
+        return {name: cache.info() for name, cache in caches.items() if cache is not None and cache.misses}
+
+
+#: Modification time and size, content hash and query names of a loaded SQL file
+SQLFileState = namedtuple('SQLFileState', ['stat', 'digest', 'names'])
+
+#: What :meth:`Queries.reload` changed
+ReloadInfo = namedtuple('ReloadInfo', ['files', 'added', 'updated', 'removed'])
+
+
+def file_stat(file):
+    """Helper function returning the modification time and size of a file"""
+    st = os.stat(file)
+    return getattr(st, 'st_mtime_ns', st.st_mtime), st.st_size
+
+
+def file_digest(file):
+    """Helper function returning the sha1 hex digest of the content of a file"""
+    digest = sha1()
+    for line in iter_file_lines(file):
+        digest.update(line)
+    return digest.hexdigest()
+
+
+class QueriesWatcher(object):
+    """
+    Polls the SQL files of a :class:`Queries` object for changes, see :meth:`Queries.watch`.
+    """
+    def __init__(self, queries, interval):
+        self.queries = queries
+        self.interval = interval
+        self._stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='sqlpy-watcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stops polling, waiting for a reload in progress to finish."""
+        self._stop_event.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                self.queries.reload()
+            except Exception:
+                logger.error('Exception raised reloading sql files, keeping the loaded queries', exc_info=True)
+
+
+def with_defaults(fn, defaults):
+    """
+    Binds default call arguments to a prepared function.
+
+    Args:
+        fn (:obj:`functools.partial`): the prepared function
+        defaults (:obj:`dict`): keyword arguments, still overridable per call
+
+    Returns:
+        :obj:`functools.partial`: the prepared function with the same attributes as ``fn``
+    """
+    fn_defaults = partial(fn, **defaults)
+    fn_defaults.__dict__.update(fn.__dict__)
+    return fn_defaults
+
+
+def get_fn_name(line, uppercase_name=UPPERCASE_QUERY_NAME):
     """
     Extracts the name of a SQL statement
 
     Args:
         line (:obj:`str`): First line of a SQL statement
+        uppercase_name (:obj:`bool`, optional): Weather to uppercase the name
 
     Returns:
         :obj:`str`: Uppercase name of the SQL statement
     """
     name = line.split('-- name:')[1].strip()
-    if UPPERCASE_QUERY_NAME:
+    if uppercase_name:
         return name.upper()
     return name
 
 
+#: A parameter found in SQL by :func:`scan_params`, ``name`` is ``None`` for ``%s``
+SQLParam = namedtuple('SQLParam', ['name', 'start', 'end'])
+
+# every token starts with one of -/'"$%, the lookahead lets the regex engine skip other text
+_scan_re = re.compile(r"""(?=[-/'"$%])(?:
+    (?P<comment>--[^\n]*)
+  | (?P<block_comment>/\*.*?(?:\*/|\Z))
+  | (?P<escape_literal>(?<=(?<!\w)[Ee])'(?:[^'\\]|\\.|'')*(?:'|\Z))
+  | (?P<literal>'(?:[^']|'')*(?:'|\Z))
+  | (?P<quoted_ident>"(?:[^"]|"")*(?:"|\Z))
+  | (?P<dollar_quoted>(?<![\w$])\$(?P<tag>(?:[A-Za-z_][A-Za-z_0-9]*)?)\$.*?(?:\$(?P=tag)\$|\Z))
+  | (?P<escape>%%)
+  | (?P<named>%\((?P<name>[^()]*)\)(?P<spec>s)?)
+  | (?P<unclosed>%\()
+  | (?P<positional>%s)
+)""", re.S | re.X)
+
+
+def scan_params(s):
+    """
+    Scans a string of SQL for its ``format`` and ``pyformat`` parameters in one pass.
+
+    Parameters are found as ``%s`` and ``%(name)s`` tokens. Anything within quoted
+    literals, quoted identifiers, dollar quoted bodies and comments is not a parameter,
+    nor are ``%%`` escapes.
+
+    Args:
+        s (:obj:`str`): Input string
+
+    Returns:
+        :obj:`list` of :class:`SQLParam`: ``(name, start, end)`` of each parameter in order,
+            ``name`` is ``None`` for a ``%s`` parameter
+
+    Raises:
+        SQLParseException: When a ``%(`` is not closed by ``)s``.
+        SQLParseException: When no name is found within the argument while parsing.
+    """
+    if '%' not in s:
+        return []
+    params = []
+    for match in _scan_re.finditer(s):
+        kind = match.lastgroup
+        if kind == 'positional':
+            params.append(SQLParam(None, match.start(), match.end()))
+        elif kind == 'named':
+            if match.group('spec') is None:
+                raise SQLParseException('parse error, arg numbers do not match in string s: ', s)
+            if not match.group('name'):
+                raise SQLParseException('parse error, no argument found between (...): ', s)
+            params.append(SQLParam(match.group('name'), match.start(), match.end()))
+        elif kind == 'unclosed':
+            raise SQLParseException('parse error, arg numbers do not match in string s: ', s)
+    return params
+
+
+_ident = r'(?:"(?:[^"]|"")*"|[A-Za-z_][\w$]*)'
+# the keywords followed by a table name, and the items of a FROM list
+_table_ref_re = re.compile(r'\b(?P<keyword>from|join|into|update|copy|truncate(?:\s+table)?)\b', re.I)
+_from_item_re = re.compile(r'\s*(?:(?:only|lateral)\s+)?(?:(?P<paren>\()|(?P<table>{0}(?:\s*\.\s*{0})*))'
+                           .format(_ident), re.I)
+_alias_re = re.compile(r'\s+(?:as\s+)?(?P<alias>{})'.format(_ident), re.I)
+_list_re = re.compile(r'\s*(?P<paren>\()?')
+_comma_re = re.compile(r'\s*,')
+_ident_re = re.compile(_ident)
+# words which follow a table name, or the keywords above, without being an alias or a table
+_not_tables = frozenset(['as', 'cross', 'do', 'except', 'for', 'from', 'full', 'group', 'having', 'inner', 'intersect',
+                         'join', 'lateral', 'left', 'limit', 'natural', 'nowait', 'of', 'offset', 'on', 'only',
+                         'order', 'returning', 'right', 'select', 'set', 'skip', 'stdin', 'stdout', 'union', 'using',
+                         'values', 'where', 'window', 'with'])
+
+
+def table_name(name):
+    """Helper function normalising a possibly qualified and quoted table name to its lowercase name"""
+    return _ident_re.findall(name)[-1].strip('"').replace('""', '"').lower()
+
+
+def skip_parens(s, pos):
+    """Helper function returning the position after the parenthesis closing the one at ``pos``"""
+    depth = 0
+    for i in range(pos, len(s)):
+        if s[i] == '(':
+            depth += 1
+        elif s[i] == ')':
+            depth -= 1
+            if not depth:
+                return i + 1
+    return len(s)
+
+
+def query_tables(s):
+    """
+    Finds the tables a SQL statement reads or writes.
+
+    Tables are the names following ``FROM`` and ``TRUNCATE``, including comma separated
+    lists, ``JOIN``, ``INTO``, ``UPDATE`` and ``COPY``, outside of literals and comments.
+    Functions called in a ``FROM`` list are skipped, the tables of subqueries are found on
+    their own. The schema is dropped, so ``public.actor`` is ``actor``. Common table
+    expression names may be included, which only widens what a write to them invalidates.
+
+    Args:
+        s (:obj:`str`): Input string
+
+    Returns:
+        :obj:`frozenset` of :obj:`str`: the lowercase table names
+    """
+    # literals and comments are blanked, quoted identifiers are kept
+    s = _scan_re.sub(lambda m: m.group() if m.lastgroup == 'quoted_ident' else ' ', s)
+    tables = set()
+    for match in _table_ref_re.finditer(s):
+        keyword = match.group('keyword').lower()
+        is_list = keyword == 'from' or keyword.startswith('truncate')
+        pos = match.end()
+        while True:
+            item = _from_item_re.match(s, pos)
+            if item is None:
+                break
+            pos = item.end()
+            if item.group('paren'):
+                # a subquery
+                pos = skip_parens(s, item.start('paren'))
+            else:
+                name = table_name(item.group('table'))
+                if name in _not_tables:
+                    break
+                call = _list_re.match(s, pos)
+                if call.group('paren') and keyword in ('from', 'join'):
+                    # a function
+                    pos = skip_parens(s, call.start('paren'))
+                else:
+                    tables.add(name)
+            if not is_list:
+                break
+            alias = _alias_re.match(s, pos)
+            if alias is not None and alias.group('alias').lower() not in _not_tables:
+                pos = alias.end()
+                columns = _list_re.match(s, pos)
+                if columns.group('paren'):
+                    pos = skip_parens(s, columns.start('paren'))
+            comma = _comma_re.match(s, pos)
+            if comma is None:
+                break
+            pos = comma.end()
+    return frozenset(tables)
+
+
 def parse_args(s):
     """
     Sans a string of SQL and parses out named parameters.
@@ -103,66 +1080,78 @@ def parse_args(s):
         SQLParseException: When the number of parameters found do not match.
         SQLParseException: When no name is found within the argument while parsing.
     """
-    if '%(' not in s:
-        return None
-    arg_start = []
-    arg_end = []
-    out = set()
-    for ii, c in enumerate(s):
-        if c != '%' and c != ')':
-            # normal uninteresting character
-            continue
-        elif c == '%' and s[ii + 1] == '(':
-            # start of argument name
-            arg_start.append(ii + 2)
-        elif c == ')' and False if ii + 1 == len(s) else s[ii + 1] == 's':
-            # end of argument name
-            arg_end.append(ii)
-        else:  # pragma: no cover
-            # just a normal )
-            pass
-    if len(arg_start) != len(arg_end):
-        raise SQLParseException('parse error, arg numbers do not match in string s: ', s)
-    for i in range(len(arg_start)):
-        if arg_end[i] - arg_start[i] < 1:
-            raise SQLParseException('parse error, no argument found between (...): ', s)
-        out.add(s[arg_start[i]:arg_end[i]])
-    return out
-
-
-def built_query_tuple(in_arr):
-    """
-    Prepares a built query :obj:`list` and :obj:`dict`.
-
-    Builds a :obj:`list` of query parameters and a :obj:`dict` of query line parts, keyed
-    by the parameters within that line.
+    out = set(param.name for param in scan_params(s) if param.name is not None)
+    return out or None
 
-    Args:
-        in_arr (:obj:`list` of :obj:`str`): List of SQL statement lines
 
-    Returns:
-        :obj:`tuple`: ``(query_arr, query_dict)``
-    """
-    query_arr = []
-    query_dict = {'#': []}
-    arg_offset = 0  # value which tracks the total offset in the array caused by multiple args in a line
-    for i, line in enumerate(in_arr):
-        args = parse_args(line)
-        if not args:
-            query_arr.append({'#': {'idx': i + arg_offset, 'query_line': line}})
-            query_dict['#'].append(i + arg_offset)
-            continue
-        if len(args) > 1:
+class BuiltQuery(object):
+    """
+    Compiled clause table of a built (``$``) SQL statement.
+
+    Every line of the statement is a clause identified by its bit in a bitmask. Lines
+    without parameters are always part of the output, lines with parameters are selected
+    when any of their parameters is supplied. The parameters of each line are parsed once
+    when the statement is loaded, so assembling a query is a single pass over the lines.
+
+    Args:
+        lines (:obj:`list` of :obj:`str`): List of SQL statement lines
+    """
+    def __init__(self, lines):
+        self.lines = list(lines)
+        # scan the whole statement, so literals and comments spanning lines are skipped
+        line_starts = []
+        offset = 0
+        for line in self.lines:
+            line_starts.append(offset)
+            offset += len(line) + 1
+        line_args = [set() for line in self.lines]
+        for param in scan_params('\n'.join(self.lines)):
+            if param.name is not None:
+                line_args[bisect_right(line_starts, param.start) - 1].add(param.name)
+        #: parameter names required by each line
+        self.line_params = []
+        #: bitmask of the lines without parameters
+        self.fixed_mask = 0
+        #: bitmask of the lines containing each parameter
+        self.arg_masks = {}
+        for i, args in enumerate(line_args):
+            bit = 1 << i
+            if not args:
+                self.fixed_mask |= bit
+                self.line_params.append(frozenset())
+                continue
+            self.line_params.append(frozenset(args))
             for arg in args:
-                query_arr.append({arg: {'idx': i + arg_offset, 'query_line': line}})
-                query_dict[arg] = i + arg_offset
-                arg_offset += 1
-            arg_offset -= 1
-        else:
-            arg = args.pop()
-            query_arr.append({arg: {'idx': i + arg_offset, 'query_line': line}})
-            query_dict[arg] = i + arg_offset
-    return (query_arr, query_dict)
+                self.arg_masks[arg] = self.arg_masks.get(arg, 0) | bit
+
+    def build(self, keys):
+        """
+        Assembles the SQL string for a set of supplied argument names.
+
+        Args:
+            keys (:obj:`iterable` of :obj:`str`): names of the supplied arguments
+
+        Returns:
+            :obj:`tuple`: ``(query_built, query_args_set, unmatched)`` the SQL string, the
+                names of the parameters it requires and the supplied names matching no clause
+        """
+        mask = self.fixed_mask
+        unmatched = []
+        arg_masks = self.arg_masks
+        for key in keys:
+            arg_mask = arg_masks.get(key)
+            if arg_mask is None:
+                unmatched.append(key)
+            else:
+                mask |= arg_mask
+        query_built_arr = []
+        query_args_set = set()
+        for line, params in zip(self.lines, self.line_params):
+            if mask & 1:
+                query_built_arr.append(line)
+                query_args_set.update(params)
+            mask >>= 1
+        return '\n'.join(query_built_arr), frozenset(query_args_set), frozenset(unmatched)
 
 
 def arg_key_diff(s1, s2):
@@ -179,31 +1168,26 @@ def arg_key_diff(s1, s2):
     return s1 - s2
 
 
-def parse_sql_entry(entry):
+def parse_fn_name(line, uppercase_name=UPPERCASE_QUERY_NAME):
     """
-    Creates a prepared function for a SQL statement.
+    Extracts the name and :class:`QueryType` of a SQL statement from its first line.
 
-    For a given SQL statement its :class:`QueryType` is matched to its name ending in
-    any of ``<!>, !, $``, for a `RETURN_ID, INSERT_UPDATE_DELETE, SELECT_BUILT` query
-    type respectively. If no end token is found, the query is a `SELECT` query.
-
-    Comments are detected and added to the ``__doc__`` attribute of the returned function
+    Args:
+        line (:obj:`str`): First line of a SQL statement
+        uppercase_name (:obj:`bool`, optional): Weather to uppercase the name
 
     Returns:
-        :obj:`str`: name of the prepared function in UPPERCASE
-        :obj:`functools.partial`: ```fn_partial`` the prepared function
-            the ``fn_partial`` also has these attributes set
-                - ``fn_partial.__doc__``: The comments found on the SQL statement if any
-                - ``fn_partial.__query__``: The string representation of the SQL statement
-                - ``fn_partial.__name__``: The name of the prepared function in UPPERCASE
+        :obj:`tuple`: ``(name, sql_type)`` the name without its type token
+
+    Raises:
+        SQLParseException: When the line does not start with ``-- name:``.
+        SQLParseException: When the name has spaces.
     """
-    lines = entry.split('\n')
-    if not lines[0].startswith('-- name:'):
-        raise SQLParseException('Query does not start with "-- name:": ', lines[0])
-    name = get_fn_name(lines[0])
-    doc = None
+    if not line.startswith('-- name:'):
+        raise SQLParseException('Query does not start with "-- name:": ', line)
+    name = get_fn_name(line, uppercase_name)
     if ' ' in name:
-        raise SQLParseException('Query name has spaces: ', lines[0])
+        raise SQLParseException('Query name has spaces: ', line)
     elif '<!>' in name:
         sql_type = QueryType.RETURN_ID
         name = name.replace('<!>', '')
@@ -218,25 +1202,186 @@ def parse_sql_entry(entry):
         name = name.replace('$', '')
     else:
         sql_type = QueryType.SELECT
-    # collect comments only at the start of the query block
-    comments = list(line.strip('-').strip() for line in takewhile(lambda l: l.startswith('--'), lines[1:]))
-    if comments:
-        doc = '\n'.join(comments)
-        query = lines[len(comments) + 1:]
-    else:
-        query = lines[1:]
-    query_dict = None
-    query_arr = None
-    if sql_type == QueryType.SELECT_BUILT:
-        query_arr, query_dict = built_query_tuple(query)
-    query = '\n'.join(query)
+    return name, sql_type
+
+
+#: Parsed form of a SQL statement, from which its prepared function is made
+SQLDefinition = namedtuple('SQLDefinition', ['name', 'sql_type', 'doc', 'query', 'built', 'file', 'line'])
+# the location is optional, and missing from parse cache entries of earlier versions
+SQLDefinition.__new__.__defaults__ = (None, None)
+
+
+def parse_sql_definition(entry, file=None, line=None, uppercase_name=UPPERCASE_QUERY_NAME):
+    """
+    Parses a SQL statement into its :class:`SQLDefinition`.
+
+    For a given SQL statement its :class:`QueryType` is matched to its name ending in
+    any of ``<!>, !, $``, for a `RETURN_ID, INSERT_UPDATE_DELETE, SELECT_BUILT` query
+    type respectively. If no end token is found, the query is a `SELECT` query.
+
+    Comments are detected and kept as the ``doc`` of the definition.
+
+    Args:
+        entry (:obj:`str`): the SQL statement, starting with its ``-- name:`` line
+        file (:obj:`str`, optional): the file the statement was read from
+        line (:obj:`int`, optional): the line number of the statement in ``file``
+        uppercase_name (:obj:`bool`, optional): Weather to uppercase the name
+
+    Returns:
+        :class:`SQLDefinition`: ``(name, sql_type, doc, query, built, file, line)`` where
+            ``built`` is the :class:`BuiltQuery` clause table of a `SELECT_BUILT` query,
+            else ``None``
+
+    Raises:
+        SQLParseException: When the statement is invalid, with the ``file:line`` location
+            when given.
+    """
+    try:
+        lines = entry.split('\n')
+        name, sql_type = parse_fn_name(lines[0], uppercase_name)
+        doc = None
+        # collect comments only at the start of the query block
+        comments = list(line.strip('-').strip() for line in takewhile(lambda l: l.startswith('--'), lines[1:]))
+        if comments:
+            doc = '\n'.join(comments)
+            query = lines[len(comments) + 1:]
+        else:
+            query = lines[1:]
+        built = None
+        if sql_type == QueryType.SELECT_BUILT:
+            built = BuiltQuery(query)
+        query = '\n'.join(query)
+    except SQLParseException as e:
+        if file is None or e.location:
+            raise
+        raise SQLParseException(e.msg, e.string, format_location(file, line))
+    return SQLDefinition(name, sql_type, doc, query, built, file, line)
+
 
-    fn_partial = QueryFnFactory.make_query(query, query_dict, query_arr, sql_type, name, doc)
+def format_location(file, line):
+    """Formats the location of a SQL statement for messages, as ``file:line``"""
+    return '{}:{}'.format(file, line) if line else file
 
-    return name, sql_type, fn_partial
 
+def warn_duplicate(name, file, line, previous_file, previous_line):
+    """Helper function logging a query name loaded more than once"""
+    logger.warning('Duplicate query name "{}" at {}, replaces the query at {}'.format(
+        name, format_location(file, line), format_location(previous_file, previous_line)))
 
-def format_query_identifiers(query, identifiers, id_quote_fcn, cur):
+
+def parse_sql_entry(entry):
+    """
+    Creates a prepared function for a SQL statement.
+
+    The statement is parsed with :func:`parse_sql_definition`.
+
+    Returns:
+        :obj:`str`: name of the prepared function in UPPERCASE
+        :class:`QueryType`: the type of the SQL statement
+        :obj:`functools.partial`: ```fn_partial`` the prepared function
+            the ``fn_partial`` also has these attributes set
+                - ``fn_partial.__doc__``: The comments found on the SQL statement if any
+                - ``fn_partial.__query__``: The string representation of the SQL statement
+                - ``fn_partial.__name__``: The name of the prepared function in UPPERCASE
+    """
+    definition = parse_sql_definition(entry)
+
+    fn_partial = QueryFnFactory.make_query(definition.query, definition.built, definition.sql_type,
+                                           definition.name, definition.doc)
+
+    return definition.name, definition.sql_type, fn_partial
+
+
+def prepare_built_query(built, built_cache, args, strict_parse=False):
+    """
+    Builds the SQL string of a built (``$``) query for the supplied arguments.
+
+    The SQL only depends on which argument names are supplied, so it is looked up in
+    ``built_cache`` first. Parameters required by the built SQL which are missing from
+    ``args`` are set to ``None``.
+
+    Args:
+        built (:class:`BuiltQuery`): the compiled clause table
+        built_cache (:class:`LRUCache`): cache of built SQL keyed by argument names
+        args (:obj:`dict`): the query arguments
+        strict_parse (:obj:`bool`, optional): Weather a supplied argument must match a
+            SQL clause
+
+    Returns:
+        :obj:`str`: the built SQL string
+
+    Raises:
+        SQLpyException: When ``args`` is not a :obj:`dict`.
+        SQLArgumentException: When strictly parsing and a supplied argument does not match
+            a SQL clause.
+    """
+    if not isinstance(args, dict):
+        raise SQLpyException('Only dict args are supported for built SQL. {} supplied'
+                             .format(type(args)))
+    arg_keys = frozenset(args)
+    cached = built_cache.get(arg_keys)
+    if cached is None:
+        cached = built.build(arg_keys)
+        built_cache.put(arg_keys, cached)
+    query_built, query_args_set, unmatched = cached
+    if unmatched and strict_parse:
+        raise SQLArgumentException('Named argument supplied which does not match a SQL clause: ',
+                                   key=sorted(unmatched)[0])
+    # do a diff of the keys in input args and query_built
+    # set anything missing to None
+    diff = arg_key_diff(query_args_set, arg_keys)
+    if diff:
+        for key in diff:
+            args.setdefault(key, None)
+    return query_built
+
+
+#: The identifiers quoted by every function, keyed by the quoting function, the
+#: connection encoding and the identifier
+quoted_identifiers = LRUCache(QUOTED_IDENT_CACHE_SIZE)
+
+
+def quote_identifier(ident, id_quote_fcn, cur, encoding=None):
+    """
+    Helper function quoting an identifier with ``id_quote_fcn``, through :data:`quoted_identifiers`.
+    """
+    key = (id_quote_fcn, encoding, ident)
+    try:
+        quoted = quoted_identifiers.get(key)
+    except TypeError:
+        return id_quote_fcn(ident, cur)
+    if quoted is None:
+        quoted = id_quote_fcn(ident, cur)
+        quoted_identifiers.put(key, quoted)
+    return quoted
+
+
+def identifiers_key(identifiers):
+    """
+    Helper function normalising the ``identifiers`` of a call into a cache key, a dict
+    being keyed by its items in any order.
+
+    Returns:
+        :obj:`tuple` or :obj:`frozenset`: the key, ``None`` when the identifiers can not
+            be hashed, or are given as iterators which would be consumed
+    """
+    try:
+        if isinstance(identifiers, dict):
+            key = frozenset((k, v if isinstance(v, str) else tuple(v)) for k, v in identifiers.items()
+                            if isinstance(v, (str, list, tuple)))
+            if len(key) != len(identifiers):
+                return None
+        elif isinstance(identifiers, (list, tuple)):
+            key = tuple(identifiers)
+        else:
+            return None
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def format_query_identifiers(query, identifiers, id_quote_fcn, cur, cache=None):
     """
     Safely tokenizes SQL identifiers to be used in a SQL statement.
 
@@ -248,11 +1393,15 @@ def format_query_identifiers(query, identifiers, id_quote_fcn, cur):
     To use multiple identifiers in different parts of the query "identifier groups", you must
     use a dict type.
 
+    Each identifier is quoted once per connection encoding, through :data:`quoted_identifiers`.
+
     Args:
         query (:obj:`string`): the unprepared query string
         identifers (:obj:`list` or :obj:`dict`): iterable or dictionary of iterables
         id_quote_fcn (:func:`id_quote_fcn`): function for safely escaping values
         cur (:obj:`cursor`): cursor object
+        cache (:class:`LRUCache`, optional): the formatted queries of the function, keyed by
+            the query, the connection encoding and the normalised ``identifiers``
 
     Returns:
         :obj:`str`: query string
@@ -260,205 +1409,658 @@ def format_query_identifiers(query, identifiers, id_quote_fcn, cur):
     def normalise(v):
         return [v] if isinstance(v, str) else v
 
+    # the quoting, and so the SQL, depends on the encoding of the connection
+    encoding = getattr(getattr(cur, 'connection', None), 'encoding', None)
+    key = identifiers_key(identifiers) if cache is not None else None
+    if key is not None:
+        key = (query, encoding, key)
+        formatted = cache.get(key)
+        if formatted is not None:
+            return formatted
+
     if isinstance(identifiers, dict):
-        ids = {k: ','.join(list(id_quote_fcn(i, cur) for i in normalise(v))) for k, v in identifiers.items()}
-        return query.format(**ids)
+        ids = {k: ','.join(list(quote_identifier(i, id_quote_fcn, cur, encoding) for i in normalise(v)))
+               for k, v in identifiers.items()}
+        formatted = query.format(**ids)
     elif isinstance(identifiers, (list, tuple)):
-        ids = list(id_quote_fcn(i, cur) for i in identifiers)
-        return query.format(*ids)
+        ids = list(quote_identifier(i, id_quote_fcn, cur, encoding) for i in identifiers)
+        formatted = query.format(*ids)
     else:
         raise SQLParseException("Invalid data type passed as identifiers. Must be dict of iterables, dict of strings, list or tuple", identifiers)
+    if key is not None:
+        cache.put(key, formatted)
+    return formatted
+
+
+# the default of ResultCache.get, None being a result
+_NOT_CACHED = object()
 
 
 class QueryFnFactory:
     @staticmethod
-    def make_query(query, query_dict, query_arr, sql_type, name, doc):
+    def make_query(query, built, sql_type, name, doc, metrics=None, hooks=None, config=DEFAULT_CONFIG,
+                   result_cache=None):
+        # the settings are bound as defaults, so each Queries object keeps its own
+        log_query_params_default = config.log_query_params
+        prepare_default = config.prepare
+        row_type_default = config.row_type
+        strict_parse = config.strict_parse
+        # a write without a table found invalidates every cached result
+        tables = query_tables(query) if result_cache is not None else frozenset()
+
+        prepared = None
+        if sql_type in (QueryType.SELECT, QueryType.INSERT_UPDATE_DELETE, QueryType.RETURN_ID):
+            prepared = prepare_query(name, query)
+        row_factory = RowFactory(name)
+        identifiers_cache = LRUCache(IDENTIFIERS_CACHE_SIZE)
 
         if sql_type == QueryType.INSERT_UPDATE_DELETE:
-            def fn(query, cur, args=tuple(), many=None, identifiers=None, log_query_params=LOG_QUERY_PARAMS, **kwargs):
+            def fn(query, cur, args=tuple(), many=None, identifiers=None, log_query_params=log_query_params_default,
+                   prepare=prepare_default, copy=False, copy_format='csv', buffer_size=None, page_size=None,
+                   commit_every=None, savepoint_every=None, progress=None, **kwargs):
+                started = timer() if metrics is not None else 0
+                if many:
+                    check_many_args(page_size, commit_every, savepoint_every)
                 if identifiers:  # pragma: no cover
                     if not quote_ident:
                         raise SQLpyException('"quote_ident" is not supported')
-                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur)
-                logger.info('Executing: {}'.format(name))
-                log_query(query, args, log_query_params)
+                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur,
+                                                     identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    # the rows of a copy may be an iterator, or too many to format
+                    log_query(query, '<rows>' if copy else args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, cur, log_query_params, bool(many or copy))
                 try:
-                    if many and execute_values:
-                        execute_values(cur, query, args)
-                    elif many and not execute_values:
-                        cur.executemany(query, args)
+                    if copy:
+                        result = copy_rows(cur, query, args, copy_format, buffer_size or COPY_BUFFER_SIZE)
+                    elif many:
+                        execute_many(cur, query, args, page_size or MANY_PAGE_SIZE, commit_every, savepoint_every,
+                                     progress)
                     else:
-                        cur.execute(query, args)
+                        execute_query(cur, query, args, prepared if prepare and not identifiers else None)
                 except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
+                    # pages committed before the error are written
+                    if result_cache is not None and many:
+                        result_cache.invalidate(tables or None)
                     logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
                                  .format(type(e), name, query), exc_info=True)
                     raise
                 else:
+                    if event is not None:
+                        hooks.after_execute(event)
+                    if metrics is not None:
+                        metrics.record(started, executing, timer())
+                    if result_cache is not None:
+                        result_cache.invalidate(tables or None)
+                    if copy:
+                        if logger.isEnabledFor(logging.INFO):
+                            logger.info('Copied {} rows ({} bytes) in {:.3f}s, {:.0f} rows/s'
+                                        .format(result.rows, result.bytes, result.duration, result.rows_per_second))
+                        return result
                     return True
 
             fn_partial = partial(fn, query)
 
         elif sql_type == QueryType.RETURN_ID:
-            def fn(query, cur, args=tuple(), n=None, many=None, identifiers=None, log_query_params=LOG_QUERY_PARAMS, **kwargs):
-                if n and (not isinstance(n, int) or n < 1):
-                    raise SQLpyException('"n" must be an Integer >= 1')
+            def fn(query, cur, args=tuple(), n=None, many=None, identifiers=None, log_query_params=log_query_params_default,
+                   stream=False, batch_size=None, prepare=prepare_default, page_size=None, commit_every=None,
+                   savepoint_every=None, progress=None, row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_fetch_args(n, stream, batch_size)
+                if row_type is not None:
+                    check_row_type(row_type)
+                if many:
+                    check_many_args(page_size, commit_every, savepoint_every)
                 if identifiers:  # pragma: no cover
                     if not quote_ident:
                         raise SQLpyException('"quote_ident" is not supported')
-                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur)
-                logger.info('Executing: {}'.format(name))
-                log_query(query, args, log_query_params)
+                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur,
+                                                     identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query, args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, cur, log_query_params, bool(many))
+                returned = None
                 try:
-                    if many and execute_values:
-                        execute_values(cur, query, args)
-                    elif many and not execute_values:
-                        cur.executemany(query, args)
+                    if many and stream:
+                        # the pages are executed as the returned rows are consumed
+                        pages = iter_many(cur, query, args, page_size or MANY_PAGE_SIZE, commit_every,
+                                          savepoint_every, progress, fetch=True)
+                    elif many:
+                        returned = fetch_many(cur, query, args, page_size or MANY_PAGE_SIZE, commit_every,
+                                              savepoint_every, progress)
                     else:
-                        cur.execute(query, args)
+                        execute_query(cur, query, args, prepared if prepare and not identifiers else None)
                 except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
+                    # pages committed before the error are written
+                    if result_cache is not None and many:
+                        result_cache.invalidate(tables or None)
                     logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
                                  .format(type(e), name, query), exc_info=True)
                     raise
                 else:
-                    if not n:
-                        return cur.fetchall()
-                    if n == 1:
-                        return cur.fetchone()
-                    else:
-                        return cur.fetchmany(n)
+                    if event is not None:
+                        hooks.after_execute(event)
+                    convert = partial(row_factory.convert, cur, row_type) if row_type is not None else None
+                    if many and stream:
+                        if metrics is not None:
+                            metrics.record(started, executing, timer())
+                        if result_cache is not None:
+                            # the pages are written as the rows are consumed
+                            return result_cache.invalidate_after(iter_returning(pages, metrics, convert),
+                                                                 tables or None)
+                        return iter_returning(pages, metrics, convert)
+                    if result_cache is not None:
+                        result_cache.invalidate(tables or None)
+                    if many:
+                        if metrics is not None:
+                            metrics.record(started, executing, timer(), rows=len(returned))
+                        if convert is not None:
+                            returned = convert(returned)
+                        if n == 1:
+                            return returned[0] if returned else None
+                        return returned[:n] if n else returned
+                    return fetch_results(cur, n, stream, batch_size, metrics=metrics, started=started,
+                                         executing=executing, convert=convert)
 
             fn_partial = partial(fn, query)
 
         elif sql_type == QueryType.CALL_PROC:
-            def fn(query, cur, args=tuple(), n=None, identifiers=None, log_query_params=LOG_QUERY_PARAMS, **kwargs):
-                if n and (not isinstance(n, int) or n < 1):
-                    raise SQLpyException('"n" must be an Integer >= 1')
+            def fn(query, cur, args=tuple(), n=None, identifiers=None, log_query_params=log_query_params_default,
+                   stream=False, batch_size=None, row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_fetch_args(n, stream, batch_size)
+                if row_type is not None:
+                    check_row_type(row_type)
                 if identifiers:  # pragma: no cover
                     if not quote_ident:
                         raise SQLpyException('"quote_ident" is not supported')
-                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur)
-                logger.info('Executing: {}'.format(name))
-                log_query(query, args, log_query_params)
+                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur,
+                                                     identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query, args, log_query_params)
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, cur, log_query_params)
                 try:
                     cur.callproc(query, args)
                 except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
                     logger.error('Exception Type "{}" raised, on executing procedure "{}"\n____\n{}\n____'
                                  .format(type(e), name, query), exc_info=True)
                     raise
                 else:
-                    if not n:
-                        return cur.fetchall()
-                    if n == 1:
-                        return cur.fetchone()
-                    else:
-                        return cur.fetchmany(n)
+                    if event is not None:
+                        hooks.after_execute(event)
+                    # the tables a procedure writes are unknown
+                    if result_cache is not None:
+                        result_cache.invalidate(None)
+                    convert = partial(row_factory.convert, cur, row_type) if row_type is not None else None
+                    return fetch_results(cur, n, stream, batch_size, metrics=metrics, started=started,
+                                         executing=executing, convert=convert)
 
             fn_partial = partial(fn, query)
 
         elif sql_type == QueryType.SELECT:
-            def fn(query, cur, args=tuple(), n=None, identifiers=None, log_query_params=LOG_QUERY_PARAMS, **kwargs):
-                if n and (not isinstance(n, int) or n < 1):
-                    raise SQLpyException('"n" must be an Integer >= 1')
+            def fn(query, cur, args=tuple(), n=None, identifiers=None, log_query_params=log_query_params_default,
+                   stream=False, batch_size=None, server_side=False, itersize=None, prepare=prepare_default,
+                   cache_ttl=None, columnar=False, row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_fetch_args(n, stream, batch_size)
+                if row_type is not None:
+                    check_row_type(row_type)
+                if columnar:
+                    columnar = check_columnar_args(columnar, n, stream)
+                cache_key = None
+                if result_cache is not None and cache_ttl and not stream and not columnar:
+                    cache_key = result_cache.key(name, cur, args, identifiers, n, row_type)
+                    if cache_key is not None:
+                        result = result_cache.get(cache_key, _NOT_CACHED)
+                        if result is not _NOT_CACHED:
+                            logger.debug('Cached result of: {}'.format(name))
+                            return result
+                        version = result_cache.version(tables)
                 if identifiers:  # pragma: no cover
                     if not quote_ident:
                         raise SQLpyException('"quote_ident" is not supported')
-                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur)
-                logger.info('Executing: {}'.format(name))
-                log_query(query, args, log_query_params)
+                    query = format_query_identifiers(query, identifiers, extensions.quote_ident, cur,
+                                                     identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query, args, log_query_params)
+                query_cur = server_side_cursor(cur, name, itersize) if server_side else None
+                if query_cur is None:
+                    query_cur = cur
+                    # fall back to fetchmany batching on drivers without named cursors
+                    if server_side:
+                        batch_size = batch_size or itersize
+                else:
+                    # psycopg2 only uses itersize when iterating, not for fetchmany
+                    batch_size = batch_size or query_cur.itersize
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query, args, query_cur, log_query_params)
                 try:
-                    cur.execute(query, args)
+                    # a named cursor can only declare a plain query
+                    execute_query(query_cur, query, args,
+                                  prepared if prepare and not identifiers and query_cur is cur else None)
                 except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
                     logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
                                  .format(type(e), name, query), exc_info=True)
+                    if query_cur is not cur:
+                        close_quietly(query_cur)
                     raise
                 else:
-                    if not n:
-                        return cur.fetchall()
-                    if n == 1:
-                        return cur.fetchone()
-                    else:
-                        return cur.fetchmany(n)
+                    if event is not None:
+                        hooks.after_execute(event)
+                    if columnar:
+                        return fetch_columns(query_cur, columnar, batch_size,
+                                             close=partial(close_quietly, query_cur) if query_cur is not cur else None,
+                                             metrics=metrics, started=started, executing=executing)
+                    # converted once fetched, a named cursor only describes its result then
+                    convert = partial(row_factory.convert, query_cur, row_type) if row_type is not None else None
+                    result = fetch_results(query_cur, n, stream, batch_size,
+                                           close=partial(close_quietly, query_cur) if query_cur is not cur else None,
+                                           metrics=metrics, started=started, executing=executing, convert=convert)
+                    if cache_key is not None:
+                        result_cache.put(cache_key, result, cache_ttl, tables, version)
+                    return result
 
             fn_partial = partial(fn, query)
 
         elif sql_type == QueryType.SELECT_BUILT:
-            def fn(query, query_dict, query_arr, cur, args=dict(), n=None, identifiers=None, log_query_params=LOG_QUERY_PARAMS, **kwargs):
-                if n and (not isinstance(n, int) or n < 1):
-                    raise SQLpyException('"n" must be an Integer >= 1')
-                if not isinstance(args, dict):
-                    raise SQLpyException('Only dict args are supported for built SQL. {} supplied'
-                                         .format(type(args)))
-                logger.info('Executing: {}'.format(name))
-                query_built = ''
-                query_args_set = set()
-                # throw all the non arg containing lines in first
-                noarg_idx = query_dict.get('#')
-                query_built_arr = list(query_arr[idx]['#'] for idx in noarg_idx)
-                # now add lines with args into the mix
-                for key, value in args.items():
-                    arg_idx = query_dict.get(key)
-                    if arg_idx:
-                        # check if dict line item has already been added
-                        if query_arr[arg_idx][key] not in query_built_arr:
-                            query_built_arr.append(query_arr[arg_idx][key])
-                            # add the args required by this line to tracker
-                            query_args_set.update(parse_args(query_arr[arg_idx][key]['query_line']))
-                    else:
-                        if STRICT_BUILT_PARSE:
-                            raise SQLArgumentException('Named argument supplied which does not match a SQL clause: ', key=key)
-                # do a diff of the keys in input args and query_built
-                # set anything missing to None
-                diff = arg_key_diff(query_args_set, set(args.keys()))
-                if diff:
-                    for key in diff:
-                        args.setdefault(key, None)
-                # sort the final built up query array and reduce query into string
-                query_built_arr = sorted(query_built_arr, key=lambda x: x.get('idx'))
-                for q in query_built_arr:
-                    if q.get('query_line') not in query_built:
-                        query_built = "{}\n{}".format(query_built, q.get('query_line'))
+            def fn(query, built, built_cache, cur, args=dict(), n=None, identifiers=None, log_query_params=log_query_params_default,
+                   stream=False, batch_size=None, server_side=False, itersize=None, cache_ttl=None, columnar=False,
+                   row_type=row_type_default, **kwargs):
+                started = timer() if metrics is not None else 0
+                check_fetch_args(n, stream, batch_size)
+                if row_type is not None:
+                    check_row_type(row_type)
+                if columnar:
+                    columnar = check_columnar_args(columnar, n, stream)
+                cache_key = None
+                if result_cache is not None and cache_ttl and not stream and not columnar:
+                    # keyed before building, which sets the missing arguments
+                    cache_key = result_cache.key(name, cur, args, identifiers, n, row_type)
+                    if cache_key is not None:
+                        result = result_cache.get(cache_key, _NOT_CACHED)
+                        if result is not _NOT_CACHED:
+                            logger.debug('Cached result of: {}'.format(name))
+                            return result
+                        version = result_cache.version(tables)
+                query_built = prepare_built_query(built, built_cache, args, strict_parse)
                 if identifiers:  # pragma: no cover
                     if not quote_ident:
                         raise SQLpyException('"quote_ident" is not supported')
-                    query_built = format_query_identifiers(query_built, identifiers, extensions.quote_ident, cur)
-                log_query(query_built, args, log_query_params)
+                    query_built = format_query_identifiers(query_built, identifiers, extensions.quote_ident, cur,
+                                                           identifiers_cache)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info('Executing: {}'.format(name))
+                    log_query(query_built, args, log_query_params)
+                query_cur = server_side_cursor(cur, name, itersize) if server_side else None
+                if query_cur is None:
+                    query_cur = cur
+                    # fall back to fetchmany batching on drivers without named cursors
+                    if server_side:
+                        batch_size = batch_size or itersize
+                else:
+                    # psycopg2 only uses itersize when iterating, not for fetchmany
+                    batch_size = batch_size or query_cur.itersize
+                executing = timer() if metrics is not None else 0
+                event = None
+                if hooks is not None and hooks.active:
+                    event = hooks.before_execute(name, sql_type, query_built, args, query_cur, log_query_params)
                 try:
-                    cur.execute(query_built, args)
+                    query_cur.execute(query_built, args)
                 except Exception as e:
+                    if metrics is not None:
+                        metrics.record_error()
+                    if event is not None:
+                        hooks.on_error(event, e)
                     logger.error('Exception Type "{}" raised, on executing query "{}"\n____\n{}\n____'
                                  .format(type(e), name, query_built), exc_info=True)
+                    if query_cur is not cur:
+                        close_quietly(query_cur)
                     raise
                 else:
-                    if not n:
-                        return cur.fetchall()
-                    if n == 1:
-                        return cur.fetchone()
-                    else:
-                        return cur.fetchmany(n)
+                    if event is not None:
+                        hooks.after_execute(event)
+                    if columnar:
+                        return fetch_columns(query_cur, columnar, batch_size,
+                                             close=partial(close_quietly, query_cur) if query_cur is not cur else None,
+                                             metrics=metrics, started=started, executing=executing)
+                    # converted once fetched, a named cursor only describes its result then
+                    convert = partial(row_factory.convert, query_cur, row_type) if row_type is not None else None
+                    result = fetch_results(query_cur, n, stream, batch_size,
+                                           close=partial(close_quietly, query_cur) if query_cur is not cur else None,
+                                           metrics=metrics, started=started, executing=executing, convert=convert)
+                    if cache_key is not None:
+                        result_cache.put(cache_key, result, cache_ttl, tables, version)
+                    return result
 
-            fn_partial = partial(fn, query, query_dict, query_arr)
+            built_cache = LRUCache(config.built_cache_size)
+            fn_partial = partial(fn, query, built, built_cache)
+            fn_partial.__built__ = built
+            fn_partial.__built_cache__ = built_cache
 
         fn_partial.__doc__ = doc
         fn_partial.__query__ = query
+        fn_partial.__prepared__ = prepared
+        fn_partial.__sql_type__ = sql_type
+        fn_partial.__tables__ = tables
+        fn_partial.__row_factory__ = row_factory
+        fn_partial.__identifiers_cache__ = identifiers_cache
         fn_partial.__name__ = name
         fn_partial.func_name = name
 
         return fn_partial
 
 
-def parse_queires_string(s):
-    """Splits and processes SQL file into individual expressions"""
-    return [parse_sql_entry(expression.strip('\n')) for expression in s.split('\n\n') if expression]
+def expand_paths(filepath, missing_ok=False):
+    """
+    Expands the SQL file locations given to :class:`Queries` into a list of files.
 
+    Each location can be a file, a directory whose ``.sql`` files are loaded in name order,
+    including subdirectories, or a glob pattern whose matches are loaded in name order.
 
-def load_queries(filepath):
-    """Loads SQL statements as ``strings`` from files"""
+    Args:
+        filepath (:obj:`list` of :obj:`str` or :obj:`str`)
+        missing_ok (:obj:`bool`, optional): Weather to skip missing files and patterns
+            matching no files, instead of raising.
+
+    Returns:
+        :obj:`list` of :obj:`str`
+
+    Raises:
+        SQLLoadException: When a file does not exist or a pattern matches no files.
+    """
     if type(filepath) != list:
         filepath = [filepath]
-    f = ''
-    for file in filepath:
-        if not os.path.exists(file):
-            raise SQLLoadException('Could not find file', file)
-        with open(file, 'rU') as queries_file:
-            f = f + '\n\n' + queries_file.read().strip('\n')
-    return parse_queires_string(f)
+    files = []
+    for path in filepath:
+        if os.path.isdir(path):
+            found = []
+            for root, dirs, names in os.walk(path):
+                found.extend(os.path.join(root, name) for name in names if name.endswith('.sql'))
+            files.extend(sorted(found))
+        elif os.path.exists(path):
+            files.append(path)
+        elif glob.has_magic(path):
+            found = sorted(match for match in glob.glob(path) if os.path.isfile(match))
+            if not found and not missing_ok:
+                raise SQLLoadException('Could not find file', path)
+            files.extend(found)
+        elif not missing_ok:
+            raise SQLLoadException('Could not find file', path)
+    return files
+
+
+def iter_file_lines(file):
+    """
+    Yields the lines of a file as ``bytes``, through ``mmap`` for files of at least
+    ``MMAP_MIN_SIZE`` bytes.
+    """
+    with open(file, 'rb') as queries_file:
+        size = os.fstat(queries_file.fileno()).st_size
+        # an empty file can not be mapped
+        if not size or size < MMAP_MIN_SIZE:
+            for line in queries_file:
+                yield line
+            return
+        mapped = mmap.mmap(queries_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for line in iter(mapped.readline, b''):
+                yield line
+        finally:
+            mapped.close()
+
+
+def iter_sql_entries(file):
+    """
+    Yields the SQL statements of a file one at a time, streaming the file line by line.
+
+    Statements are separated by empty lines. Line endings are normalised to ``\\n``.
+
+    Yields:
+        :obj:`tuple`: ``(entry, line)`` the statement and the line number it starts on
+    """
+    lines = []
+    start = None
+    number = 0
+    for raw in iter_file_lines(file):
+        text = raw.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+        if text.endswith('\n'):
+            text = text[:-1]
+        for line in text.split('\n'):
+            number += 1
+            if line:
+                if start is None:
+                    start = number
+                lines.append(line)
+            elif start is not None:
+                yield '\n'.join(lines), start
+                lines = []
+                start = None
+    if start is not None:
+        yield '\n'.join(lines), start
+
+
+def iter_sql_definitions(file, uppercase_name=UPPERCASE_QUERY_NAME):
+    """Yields the :class:`SQLDefinition` of each SQL statement of a file as it is read"""
+    for entry, line in iter_sql_entries(file):
+        yield parse_sql_definition(entry, file, line, uppercase_name)
+
+
+def load_sql_definitions(filepath, cache_dir=None, workers=None, uppercase_name=UPPERCASE_QUERY_NAME):
+    """
+    Loads SQL statements as :class:`SQLDefinition` from files, directories or glob patterns.
+
+    With ``workers`` the files are parsed in a pool of that many processes, one file per
+    task, see :func:`use_workers`. The definitions are still yielded in file order, the
+    same as a serial load.
+
+    Args:
+        filepath (:obj:`list` of :obj:`str` or :obj:`str`): the SQL files, see :func:`expand_paths`
+        cache_dir (:obj:`str`, optional): directory of the on-disk parse cache, see
+            :func:`parse_sql_file`
+        workers (:obj:`int`, optional): number of processes parsing the files
+        uppercase_name (:obj:`bool`, optional): Weather to uppercase the query names
+
+    Yields:
+        :class:`SQLDefinition`
+    """
+    files = expand_paths(filepath)
+    if use_workers(files, workers):
+        if ProcessPoolExecutor is None:
+            raise SQLpyException('"workers" requires concurrent.futures, install the "futures" package')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            tasks = [executor.submit(parse_sql_file_task, file, cache_dir, uppercase_name) for file in files]
+            for task in tasks:
+                for definition in task.result():
+                    yield definition
+        return
+    for file in files:
+        for definition in parse_sql_file(file, cache_dir, uppercase_name):
+            yield definition
+
+
+def use_workers(files, workers):
+    """
+    Helper function deciding weather to parse ``files`` in a pool of ``workers`` processes.
+
+    The pool is only used with several cores and at least ``WORKERS_MIN_SIZE`` bytes of
+    SQL, below that starting the processes and pickling the definitions take longer than
+    a serial parse, see ``benchmarks/bench_workers.py``.
+    """
+    if not workers or workers < 2 or len(files) < 2:
+        return False
+    try:
+        if multiprocessing.cpu_count() < 2:
+            return False
+    except NotImplementedError:  # pragma: no cover
+        return False
+    return sum(os.path.getsize(file) for file in files) >= WORKERS_MIN_SIZE
+
+
+def parse_sql_file_task(file, cache_dir, uppercase_name):
+    """
+    Parses a SQL file in a worker process of :func:`load_sql_definitions`.
+
+    Returns:
+        :obj:`list` of :class:`SQLDefinition`
+    """
+    return list(parse_sql_file(file, cache_dir, uppercase_name))
+
+
+def parse_sql_file(file, cache_dir=None, uppercase_name=UPPERCASE_QUERY_NAME):
+    """
+    Parses the SQL statements of a file into :class:`SQLDefinition`.
+
+    Without a ``cache_dir`` the statements are parsed as the file is read. With a
+    ``cache_dir`` the parsed definitions are pickled to a cache entry keyed by a
+    hash of the file content, the sqlpy version and the name casing. Later loads of the
+    same file read the entry instead of parsing. A missing, stale or corrupted entry
+    falls back to parsing the file, and is rewritten.
+
+    Args:
+        file (:obj:`str`): the SQL file
+        cache_dir (:obj:`str`, optional): directory of the on-disk parse cache
+        uppercase_name (:obj:`bool`, optional): Weather to uppercase the query names
+
+    Returns:
+        iterable of :class:`SQLDefinition`
+    """
+    if not os.path.exists(file):
+        raise SQLLoadException('Could not find file', file)
+    if not cache_dir:
+        return iter_sql_definitions(file, uppercase_name)
+    key = sha1('{}:{}:'.format(VERSION, bool(uppercase_name)).encode('utf-8'))
+    for line in iter_file_lines(file):
+        key.update(line)
+    cache_path = os.path.join(cache_dir, key.hexdigest() + '.pickle')
+    definitions = read_parse_cache(cache_path)
+    if definitions is not None:
+        # the same content may be cached from another file
+        return [definition._replace(file=file) for definition in definitions]
+    definitions = list(iter_sql_definitions(file, uppercase_name))
+    write_parse_cache(cache_path, definitions)
+    return definitions
+
+
+def read_parse_cache(cache_path):
+    """
+    Reads the :class:`SQLDefinition` list of a parse cache entry.
+
+    Returns:
+        :obj:`list` of :class:`SQLDefinition`, or ``None`` when the entry is missing or invalid
+    """
+    try:
+        with open(cache_path, 'rb') as cache_file:
+            definitions = pickle.loads(cache_file.read())
+    except (IOError, OSError):
+        return None
+    except Exception:
+        logger.warning('Ignoring corrupted parse cache entry "{}"'.format(cache_path), exc_info=True)
+        return None
+    if not isinstance(definitions, list) or not all(isinstance(d, SQLDefinition) for d in definitions):
+        logger.warning('Ignoring invalid parse cache entry "{}"'.format(cache_path))
+        return None
+    return definitions
+
+
+def write_parse_cache(cache_path, definitions):
+    """
+    Writes a parse cache entry, atomically so concurrent readers never see a partial entry.
+
+    Failing to write is logged, the cache is only an optimisation.
+    """
+    cache_dir = os.path.dirname(cache_path)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as cache_file:
+            cache_file.write(pickle.dumps(definitions, pickle.HIGHEST_PROTOCOL))
+        getattr(os, 'replace', os.rename)(tmp_path, cache_path)
+    except (IOError, OSError):
+        logger.warning('Could not write parse cache entry "{}"'.format(cache_path), exc_info=True)
+
+
+def index_queries(filepath, uppercase_name=UPPERCASE_QUERY_NAME):
+    """
+    Indexes SQL statements in files by name, without parsing them.
+
+    Returns:
+        :obj:`list` of :obj:`tuple`: ``(name, (file, offset, length, line))`` for each statement,
+            the location of its bytes to be read with :func:`read_query`
+    """
+    index = []
+    for file in expand_paths(filepath):
+        offset = 0
+        number = 0
+        start = None
+        header = None
+        for line in iter_file_lines(file):
+            number += 1
+            blank = line in (b'\n', b'\r\n')
+            if start is None and not blank:
+                start, header = (offset, number), line
+            elif start is not None and blank:
+                # statements are separated by an empty line
+                index.append(index_entry(file, header, start, offset, uppercase_name))
+                start = None
+            offset += len(line)
+        if start is not None:
+            index.append(index_entry(file, header, start, offset, uppercase_name))
+    return index
+
+
+def index_entry(file, header, start, end, uppercase_name=UPPERCASE_QUERY_NAME):
+    """Helper function of :func:`index_queries` locating a single statement"""
+    offset, line = start
+    try:
+        name, sql_type = parse_fn_name(header.decode('utf-8').rstrip('\r\n'), uppercase_name)
+    except SQLParseException as e:
+        raise SQLParseException(e.msg, e.string, format_location(file, line))
+    return name, (file, offset, end - offset, line)
+
+
+def read_query(file, offset, length):
+    """Reads a single SQL statement located by :func:`index_queries`"""
+    with open(file, 'rb') as queries_file:
+        queries_file.seek(offset)
+        entry = queries_file.read(length).decode('utf-8')
+    return entry.replace('\r\n', '\n').strip('\n')
+
+
+def load_queries(filepath):
+    """Loads SQL statements as ``strings`` from files"""
+    return [(definition.name, definition.sql_type,
+             QueryFnFactory.make_query(definition.query, definition.built, definition.sql_type,
+                                       definition.name, definition.doc))
+            for definition in load_sql_definitions(filepath)]
@@ -2,9 +2,29 @@ from __future__ import print_function
 import pytest
 import os
 import glob
+import inspect
+import contextlib
+import datetime
 import functools
+import gc
+import io
+import sqlite3
+import struct
+import threading
+import time
+import types
 import psycopg2
-from sqlpy import Queries, load_queries, SQLLoadException,\
+import sqlpy.bulk
+import sqlpy.config
+import sqlpy.hooks
+import sqlpy.metrics
+import sqlpy.sqlpy
+from sqlpy.bulk import CopyReader, copy_statement, csv_value, write_copy
+from sqlpy.columnar import infer_dtype
+from sqlpy.rows import ROW_TYPES
+from sqlpy.sqlpy import (BuiltQuery, PreparedStatements, format_query_identifiers, parse_args, prepare_query,
+                         query_tables, scan_params, server_side_cursor)
+from sqlpy import Queries, ResultCache, SlowQueryLog, load_queries, SQLLoadException,\
     SQLParseException, SQLArgumentException, SQLpyException, parse_sql_entry, QueryType
 import logging
 
@@ -119,6 +139,81 @@ SELECT 1;
 """.strip('\n')
 
 
+@pytest.fixture
+def sql_built_multi():
+        return """
+-- name: test_built_multi$
+SELECT * FROM testdb
+WHERE 1=1
+AND col_1 = %(val_1)s
+AND (col_2 = %(val_2)s OR col_3 = %(val_3)s)
+""".strip('\n')
+
+
+class RecordingCursor(object):
+    """Minimal DB API cursor recording the executed SQL."""
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.executed = []
+        self.pending = []
+
+    def execute(self, query, args=None):
+        self.executed.append((query, args))
+        self.pending = list(self.rows)
+
+    def fetchall(self):
+        rows, self.pending = self.pending, []
+        return rows
+
+    def fetchone(self):
+        return self.pending.pop(0) if self.pending else None
+
+    def fetchmany(self, size):
+        rows, self.pending = self.pending[:size], self.pending[size:]
+        return rows
+
+
+@pytest.fixture
+def recording_cur():
+    return RecordingCursor(rows=[(1,), (2,), (3,)])
+
+
+@pytest.fixture
+def sqlite_cur():
+    db = sqlite3.connect(':memory:')
+    cur = db.cursor()
+    cur.execute('CREATE TABLE nums (x INTEGER)')
+    cur.executemany('INSERT INTO nums VALUES (?)', [(i,) for i in range(25)])
+    yield cur
+    db.close()
+
+
+@pytest.fixture
+def sql_select_nums():
+    return """
+-- name: select_nums
+SELECT x FROM nums WHERE x >= ? ORDER BY x
+""".strip('\n')
+
+
+class CountingCursor(object):
+    """Wraps a DB API cursor counting the fetch calls made on it."""
+    def __init__(self, cur):
+        self.cur = cur
+        self.calls = []
+
+    def __getattr__(self, attr):
+        return getattr(self.cur, attr)
+
+    def fetchall(self):
+        self.calls.append('fetchall')
+        return self.cur.fetchall()
+
+    def fetchmany(self, size):
+        self.calls.append(size)
+        return self.cur.fetchmany(size)
+
+
 @pytest.fixture(scope="module")
 def db_cur():
     db_host = 'localhost'
@@ -170,6 +265,246 @@ from public.actor
 limit 1;"""
 
 
+class TestLoadPaths:
+    def test_load_dir(self, tmpdir):
+        tmpdir.join('b.sql').write('-- name: second\nSELECT 2')
+        tmpdir.join('a.sql').write('-- name: first\nSELECT 1\n\n\n-- name: third\nSELECT 3\n')
+        tmpdir.mkdir('sub').join('c.sql').write('-- name: fourth\nSELECT 4')
+        tmpdir.join('notes.txt').write('not sql')
+        sql = Queries(str(tmpdir))
+        assert sql.available_queries == ['FIRST', 'THIRD', 'SECOND', 'FOURTH']
+
+    def test_load_glob(self, tmpdir):
+        tmpdir.join('a.sql').write('-- name: first\nSELECT 1')
+        tmpdir.join('b.sql').write('-- name: second\nSELECT 2')
+        sql = Queries(str(tmpdir.join('*.sql')), lazy=True)
+        assert sql.available_queries == ['FIRST', 'SECOND']
+        assert sql.SECOND.__query__ == 'SELECT 2'
+
+    def test_load_glob_missing(self, tmpdir):
+        with pytest.raises(SQLLoadException):
+            Queries(str(tmpdir.join('*.sql')))
+
+    def test_load_location(self, tmpdir):
+        tmpdir.join('a.sql').write('-- name: first\nSELECT 1\n\n-- doc\n-- name: second\nSELECT 2')
+        with pytest.raises(SQLParseException, match=r'a\.sql:4$'):
+            Queries(str(tmpdir))
+        with pytest.raises(SQLParseException, match=r'a\.sql:4$'):
+            Queries(str(tmpdir), lazy=True)
+
+    def test_load_line_numbers(self, tmpdir):
+        tmpdir.join('a.sql').write_binary(b'\r\n-- name: first\r\nSELECT 1\r\n\r\n\r\n-- name: second$\r\n'
+                                          b'SELECT 2\r\nWHERE a = %(a)s')
+        definitions = list(sqlpy.sqlpy.load_sql_definitions(str(tmpdir)))
+        assert [(d.name, d.line) for d in definitions] == [('FIRST', 2), ('SECOND', 6)]
+        assert definitions[0].file == str(tmpdir.join('a.sql'))
+        assert definitions[1].query == 'SELECT 2\nWHERE a = %(a)s'
+
+    def test_load_mmap(self, queries_file, monkeypatch):
+        expected = Queries(queries_file)
+        monkeypatch.setattr(sqlpy.sqlpy, 'MMAP_MIN_SIZE', 0)
+        sql = Queries(queries_file)
+        assert sql.available_queries == expected.available_queries
+        assert sql.TEST_SELECT.__query__ == expected.TEST_SELECT.__query__
+
+
+def fn_defaults(fn):
+    """Returns the default arguments of a query function by name."""
+    try:
+        spec = inspect.getfullargspec(fn.func)
+    except AttributeError:  # Python 2
+        spec = inspect.getargspec(fn.func)
+    return dict(zip(spec.args[-len(spec.defaults):], spec.defaults))
+
+
+class TestConfig:
+    @pytest.fixture
+    def queries_path(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: select_built$\nSELECT x FROM nums\nWHERE x >= %(low)s')
+        return str(queries_file)
+
+    def check(self, sql, strict_parse, uppercase_name, log_query_params, built_cache_size, prepare, row_type):
+        select = getattr(sql, 'SELECT_NUMS' if uppercase_name else 'select_nums')
+        built = getattr(sql, 'SELECT_BUILT' if uppercase_name else 'select_built')
+        defaults = fn_defaults(select)
+        assert defaults['log_query_params'] is log_query_params
+        assert defaults['prepare'] is prepare
+        assert defaults['row_type'] == row_type
+        assert built.__built_cache__.maxsize == built_cache_size
+        if strict_parse:
+            with pytest.raises(SQLArgumentException):
+                sqlpy.sqlpy.prepare_built_query(built.__built__, built.__built_cache__, {'low': 1, 'high': 2},
+                                                sql.config.strict_parse)
+        assert sql.config == (strict_parse, uppercase_name, log_query_params, built_cache_size, prepare, row_type)
+
+    def test_instances(self, queries_path):
+        first = Queries(queries_path, strict_parse=True, uppercase_name=False, log_query_params=False,
+                        built_cache_size=4, prepare=True, row_type='dict')
+        second = Queries(queries_path)
+        # making the second object changes nothing of the first
+        self.check(first, True, False, False, 4, True, 'dict')
+        self.check(second, False, True, True, 128, False, None)
+        assert sqlpy.sqlpy.get_fn_name('-- name: select_nums') == 'SELECT_NUMS'
+
+    def test_strict_built(self, queries_path, recording_cur):
+        strict = Queries(queries_path, strict_parse=True)
+        loose = Queries(queries_path)
+        assert loose.SELECT_BUILT(recording_cur, {'low': 24, 'high': 30}) == [(1,), (2,), (3,)]
+        with pytest.raises(SQLArgumentException):
+            strict.SELECT_BUILT(recording_cur, {'low': 24, 'high': 30})
+        assert len(recording_cur.executed) == 1
+
+    def test_parallel(self, queries_path):
+        errors = []
+        row_types = (None,) + ROW_TYPES
+        settings = [(bool(i % 2), bool(i % 3), not i % 2, 1 + i, bool(i % 5), row_types[i % 5]) for i in range(8)]
+        lazy = [False, True]
+
+        def work(i):
+            try:
+                for j in range(25):
+                    sql = Queries(queries_path, lazy=lazy[j % 2],
+                                  **dict(zip(sqlpy.config.QueriesConfig._fields, settings[i])))
+                    self.check(sql, *settings[i])
+                    sql.reload()
+            except Exception as e:  # pragma: no cover
+                errors.append(e)
+        threads = [threading.Thread(target=work, args=(i,)) for i in range(len(settings))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert errors == []
+
+
+class TestWorkers:
+    @pytest.fixture(autouse=True)
+    def pool(self, monkeypatch):
+        # the pool is used for these small files, as if on several cores
+        monkeypatch.setattr(sqlpy.sqlpy, 'WORKERS_MIN_SIZE', 0)
+        monkeypatch.setattr(sqlpy.sqlpy.multiprocessing, 'cpu_count', lambda: 2)
+
+    @pytest.fixture
+    def sql_dir(self, tmpdir):
+        for i in range(4):
+            tmpdir.join('q{}.sql'.format(i)).write('-- name: select_{0}\nSELECT {0}\n\n'
+                                                   '-- name: built_{0}$\nSELECT {0}\nWHERE a = %(a)s'.format(i))
+        return str(tmpdir)
+
+    def test_workers(self, sql_dir, recording_cur):
+        serial = Queries(sql_dir)
+        sql = Queries(sql_dir, workers=2)
+        assert sql.available_queries == serial.available_queries
+        assert sql.BUILT_3.__query__ == serial.BUILT_3.__query__
+        sql.BUILT_3(recording_cur, {'a': 1})
+        assert recording_cur.executed[0] == ('SELECT 3\nWHERE a = %(a)s', {'a': 1})
+
+    def test_use_workers(self, sql_dir, monkeypatch):
+        files = sqlpy.sqlpy.expand_paths(sql_dir)
+        assert sqlpy.sqlpy.use_workers(files, 2)
+        assert not sqlpy.sqlpy.use_workers(files, 1)
+        assert not sqlpy.sqlpy.use_workers(files[:1], 2)
+        monkeypatch.setattr(sqlpy.sqlpy, 'WORKERS_MIN_SIZE', 1 << 20)
+        assert not sqlpy.sqlpy.use_workers(files, 2)
+        monkeypatch.setattr(sqlpy.sqlpy, 'WORKERS_MIN_SIZE', 0)
+        monkeypatch.setattr(sqlpy.sqlpy.multiprocessing, 'cpu_count', lambda: 1)
+        assert not sqlpy.sqlpy.use_workers(files, 2)
+        # a serial load without a pool
+        monkeypatch.setattr(sqlpy.sqlpy, 'ProcessPoolExecutor', None)
+        assert Queries(sql_dir, workers=2).available_queries == Queries(sql_dir).available_queries
+
+    def test_workers_uppercase(self, sql_dir):
+        sql = Queries(sql_dir, workers=2, uppercase_name=False)
+        assert sql.available_queries[:2] == ['select_0', 'built_0']
+
+    def test_workers_duplicate(self, sql_dir, tmpdir, caplog):
+        tmpdir.join('q4.sql').write('-- name: select_1\nSELECT 41')
+        sql = Queries(sql_dir, workers=2)
+        assert sql.SELECT_1.__query__ == 'SELECT 41'
+        assert sql.available_queries.count('SELECT_1') == 1
+        message, = [r.getMessage() for r in caplog.records if 'Duplicate' in r.getMessage()]
+        assert message.endswith('q4.sql:1, replaces the query at {}:1'.format(tmpdir.join('q1.sql')))
+
+
+class TestReload:
+    @pytest.fixture
+    def sql_dir(self, tmpdir):
+        tmpdir.join('a.sql').write('-- name: first\nSELECT 1\n\n-- name: second\nSELECT 2')
+        tmpdir.join('b.sql').write('-- name: third\nSELECT 3')
+        return tmpdir
+
+    @staticmethod
+    def edit(file, content):
+        # a different size, so the change is seen whatever the mtime resolution
+        file.write(content)
+        os.utime(str(file), (1, os.stat(str(file)).st_mtime + 10))
+
+    @pytest.mark.parametrize('lazy', [False, True])
+    def test_reload(self, sql_dir, lazy):
+        sql = Queries(str(sql_dir), lazy=lazy)
+        third = sql.THIRD
+        first = sql.FIRST
+        self.edit(sql_dir.join('a.sql'), '-- name: first\nSELECT 11\n\n-- name: fourth\nSELECT 4')
+        info = sql.reload()
+        assert info == sqlpy.sqlpy.ReloadInfo([str(sql_dir.join('a.sql'))], ['FOURTH'], ['FIRST'], ['SECOND'])
+        assert sql.available_queries == ['FIRST', 'THIRD', 'FOURTH']
+        assert sql.FIRST.__query__ == 'SELECT 11'
+        assert first.__query__ == 'SELECT 1'
+        assert sql.FOURTH.__query__ == 'SELECT 4'
+        assert sql.THIRD is third
+        assert not hasattr(sql, 'SECOND')
+
+    def test_reload_unchanged(self, sql_dir):
+        sql = Queries(str(sql_dir))
+        assert sql.reload() == sqlpy.sqlpy.ReloadInfo([], [], [], [])
+        os.utime(str(sql_dir.join('b.sql')), (1, os.stat(str(sql_dir.join('b.sql'))).st_mtime + 10))
+        assert sql.reload().files == [str(sql_dir.join('b.sql'))]
+        # only touched, the content hash is unchanged
+        os.utime(str(sql_dir.join('b.sql')), (1, os.stat(str(sql_dir.join('b.sql'))).st_mtime + 10))
+        assert sql.reload().files == []
+
+    def test_reload_new_and_deleted_file(self, sql_dir):
+        sql = Queries(str(sql_dir))
+        sql_dir.join('b.sql').remove()
+        sql_dir.join('c.sql').write('-- name: fifth\nSELECT 5')
+        info = sql.reload()
+        assert (info.added, info.removed) == (['FIFTH'], ['THIRD'])
+        assert sql.available_queries == ['FIRST', 'SECOND', 'FIFTH']
+
+    def test_reload_duplicate_fallback(self, sql_dir):
+        sql_dir.join('c.sql').write('-- name: first\nSELECT 111')
+        sql = Queries(str(sql_dir))
+        assert sql.FIRST.__query__ == 'SELECT 111'
+        sql_dir.join('c.sql').remove()
+        info = sql.reload()
+        assert (info.updated, info.removed) == (['FIRST'], [])
+        assert sql.FIRST.__query__ == 'SELECT 1'
+
+    def test_reload_parse_error(self, sql_dir):
+        sql = Queries(str(sql_dir))
+        self.edit(sql_dir.join('a.sql'), '-- name: first\nSELECT 11\n\nnot a query')
+        with pytest.raises(SQLParseException):
+            sql.reload()
+        assert sql.FIRST.__query__ == 'SELECT 1'
+        assert sql.available_queries == ['FIRST', 'SECOND', 'THIRD']
+
+    def test_watch(self, sql_dir):
+        sql = Queries(str(sql_dir))
+        watcher = sql.watch(interval=0.01)
+        try:
+            self.edit(sql_dir.join('b.sql'), '-- name: third\nSELECT 33')
+            for i in range(500):
+                if sql.THIRD.__query__ == 'SELECT 33':
+                    break
+                time.sleep(0.01)
+            assert sql.THIRD.__query__ == 'SELECT 33'
+        finally:
+            watcher.stop()
+        assert not watcher.thread.is_alive()
+
+
 class TestQuery:
     def test_query(self, queries_file):
         sql = Queries(queries_file)
@@ -188,6 +523,75 @@ class TestQuery:
         assert len(sql.TEST_SELECT.args) == 1
 
 
+class TestLazy:
+    def test_lazy_available(self, queries_file):
+        sql = Queries(queries_file, lazy=True)
+        assert sql.available_queries == Queries(queries_file).available_queries
+        assert 'TEST_SELECT' not in vars(sql)
+        assert repr(sql) == 'sqlpy.Queries(' + repr(sql.available_queries) + ')'
+
+    def test_lazy_access(self, queries_file):
+        sql = Queries(queries_file, lazy=True)
+        fcn = sql.TEST_SELECT
+        assert isinstance(fcn, functools.partial)
+        assert fcn is sql.TEST_SELECT
+        assert fcn.__doc__ == 'testing the sqlpi module pls work\nsecond line comment'
+        assert fcn.__query__ == Queries(queries_file).TEST_SELECT.__query__
+        assert sql.INSERT_ACTORS.__query__ == Queries(queries_file).INSERT_ACTORS.__query__
+
+    def test_lazy_missing(self, queries_file):
+        sql = Queries(queries_file, lazy=True)
+        with pytest.raises(AttributeError):
+            sql.NOT_A_QUERY
+
+    def test_lazy_crlf(self, tmpdir, recording_cur):
+        queries_file = tmpdir.join('crlf.sql')
+        queries_file.write_binary(b'-- name: first$\r\n-- doc\r\nSELECT 1\r\nWHERE 1=1\r\n'
+                                  b'AND a = %(a)s\r\n\r\n-- name: second\r\nSELECT 2')
+        sql = Queries(str(queries_file), lazy=True)
+        assert sql.available_queries == ['FIRST', 'SECOND']
+        assert sql.built_cache_info() == {}
+        sql.FIRST(recording_cur, {'a': 1})
+        assert recording_cur.executed[0][0] == 'SELECT 1\nWHERE 1=1\nAND a = %(a)s'
+        assert sql.SECOND.__query__ == 'SELECT 2'
+
+
+class TestParseCache:
+    def test_cache_write(self, queries_file, tmpdir):
+        cache_dir = tmpdir.join('cache')
+        sql = Queries(queries_file, cache_dir=str(cache_dir))
+        assert len(cache_dir.listdir()) == 1
+        cached = Queries(queries_file, cache_dir=str(cache_dir))
+        assert cached.available_queries == sql.available_queries
+        assert cached.TEST_SELECT.__doc__ == sql.TEST_SELECT.__doc__
+        assert cached.CUSTOMERS_OR_STAFF_IN_COUNTRY.__built__.lines == \
+            sql.CUSTOMERS_OR_STAFF_IN_COUNTRY.__built__.lines
+
+    def test_cache_read(self, queries_file, tmpdir, monkeypatch):
+        Queries(queries_file, cache_dir=str(tmpdir))
+        monkeypatch.setattr(sqlpy.sqlpy, 'parse_sql_definition', None)
+        sql = Queries(queries_file, cache_dir=str(tmpdir))
+        assert sql.TEST_SELECT.__name__ == 'TEST_SELECT'
+
+    def test_cache_key(self, queries_file, tmpdir):
+        queries_file_copy = tmpdir.join('queries.sql')
+        queries_file_copy.write('-- name: first\nSELECT 1')
+        Queries(str(queries_file_copy), cache_dir=str(tmpdir.join('cache')))
+        Queries(str(queries_file_copy), cache_dir=str(tmpdir.join('cache')), uppercase_name=False)
+        queries_file_copy.write('-- name: second\nSELECT 2')
+        sql = Queries(str(queries_file_copy), cache_dir=str(tmpdir.join('cache')))
+        assert sql.available_queries == ['SECOND']
+        assert len(tmpdir.join('cache').listdir()) == 3
+
+    def test_cache_corrupted(self, queries_file, tmpdir):
+        Queries(queries_file, cache_dir=str(tmpdir))
+        cache_entry, = tmpdir.listdir()
+        cache_entry.write_binary(b'not a pickle')
+        sql = Queries(queries_file, cache_dir=str(tmpdir))
+        assert sql.TEST_SELECT.__name__ == 'TEST_SELECT'
+        assert cache_entry.read_binary() != b'not a pickle'
+
+
 @pytest.mark.usefixtures("enable_logging")
 class TestInitLogging:
     def test_logging(self, queries_file, caplog):
@@ -244,6 +648,1353 @@ class TestQueryTypes:
         assert sql_type == QueryType.CALL_PROC
 
 
+class TestStream:
+    def test_stream(self, sqlite_cur, sql_select_nums):
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        cur = CountingCursor(sqlite_cur)
+        output = fcn(cur, (5,), stream=True, batch_size=10)
+        assert isinstance(output, types.GeneratorType)
+        assert list(output) == [(i,) for i in range(5, 25)]
+        assert cur.calls == [10, 10, 10]
+
+    def test_stream_default_batch(self, sqlite_cur, sql_select_nums):
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        cur = CountingCursor(sqlite_cur)
+        assert len(list(fcn(cur, (0,), stream=True))) == 25
+        assert 'fetchall' not in cur.calls
+
+    def test_stream_early_close(self, sqlite_cur, sql_select_nums):
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        output = fcn(sqlite_cur, (0,), stream=True, batch_size=2)
+        assert next(output) == (0,)
+        output.close()
+        assert fcn(sqlite_cur, (20,)) == [(i,) for i in range(20, 25)]
+
+    def test_stream_built(self, sql_built_multi, recording_cur):
+        name, sql_type, fcn = parse_sql_entry(sql_built_multi)
+        assert list(fcn(recording_cur, {'val_1': 1}, stream=True)) == [(1,), (2,), (3,)]
+
+    def test_stream_n(self, sqlite_cur, sql_select_nums):
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        with pytest.raises(SQLpyException):
+            fcn(sqlite_cur, (0,), n=2, stream=True)
+        with pytest.raises(SQLpyException):
+            fcn(sqlite_cur, (0,), stream=True, batch_size=0)
+
+
+class TestServerSide:
+    def test_not_psycopg2(self, sqlite_cur):
+        assert server_side_cursor(sqlite_cur, 'SELECT_NUMS', 10) is None
+
+    def test_fallback(self, sqlite_cur, sql_select_nums):
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        cur = CountingCursor(sqlite_cur)
+        output = fcn(cur, (10,), stream=True, server_side=True, itersize=5)
+        assert list(output) == [(i,) for i in range(10, 25)]
+        assert cur.calls == [5, 5, 5, 5]
+
+    def test_named_cursor_batches(self, sqlite_cur, sql_select_nums, monkeypatch):
+        named = []
+
+        def named_cursor(cur, name, itersize=None):
+            named.append(CountingCursor(cur.connection.cursor()))
+            named[0].itersize = itersize or sqlpy.config.SERVER_SIDE_ITERSIZE
+            return named[0]
+        monkeypatch.setattr(sqlpy.sqlpy, 'server_side_cursor', named_cursor)
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        assert list(fcn(sqlite_cur, (10,), stream=True, server_side=True, itersize=6)) == [(i,) for i in range(10, 25)]
+        # fetched itersize rows at a time, as psycopg2 ignores it for fetchmany
+        assert named[0].calls == [6, 6, 6, 6]
+        del named[:]
+        assert len(list(fcn(sqlite_cur, (0,), stream=True, server_side=True, itersize=6, batch_size=10))) == 25
+        assert named[0].calls == [10, 10, 10, 10]
+
+    def test_fallback_fetchall(self, sqlite_cur, sql_select_nums):
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        assert fcn(sqlite_cur, (20,), server_side=True) == [(i,) for i in range(20, 25)]
+
+    def test_query_options(self, queries_file, recording_cur):
+        sql = Queries(queries_file, query_options={'TEST_SELECT': {'stream': True, 'batch_size': 2}})
+        output = sql.TEST_SELECT(recording_cur)
+        assert isinstance(output, types.GeneratorType)
+        assert list(output) == [(1,), (2,), (3,)]
+        assert sql.TEST_SELECT.__name__ == 'TEST_SELECT'
+        assert sql.TEST_SELECT(recording_cur, stream=False) == [(1,), (2,), (3,)]
+
+
+class FakeConnection(object):
+    pass
+
+
+class TestPrepared:
+    def test_prepare_format(self):
+        prepared = prepare_query('GET_ACTORS', "select * from actor where a = %s and b = %s and c like 'x%%'")
+        assert prepared.query == "select * from actor where a = $1 and b = $2 and c like 'x%'"
+        assert prepared.arg_names is None
+        assert prepared.statement_name.startswith('sqlpy_get_actors_')
+
+    def test_prepare_pyformat(self):
+        prepared = prepare_query('GET_ACTORS', 'select * from actor where a = %(a)s or b = %(b)s or c = %(a)s')
+        assert prepared.query == 'select * from actor where a = $1 or b = $2 or c = $1'
+        assert prepared.arg_names == ('a', 'b')
+
+    def test_prepare_mixed(self):
+        assert prepare_query('GET_ACTORS', 'select * from actor where a = %(a)s or b = %s') is None
+
+    def test_prepare_name_hash(self):
+        prepared1 = prepare_query('GET_ACTORS', 'select 1')
+        prepared2 = prepare_query('GET_ACTORS', 'select 2')
+        assert prepared1.statement_name != prepared2.statement_name
+
+    def test_registry(self, recording_cur):
+        recording_cur.connection = FakeConnection()
+        registry = PreparedStatements(maxsize=1)
+        prepared1 = prepare_query('Q1', 'select * from actor where a = %(a)s')
+        prepared2 = prepare_query('Q2', 'select 2')
+        registry.execute(recording_cur, prepared1, {'a': 1})
+        registry.execute(recording_cur, prepared1, {'a': 2})
+        registry.execute(recording_cur, prepared2, ())
+        executed = [q for q, args in recording_cur.executed]
+        assert executed == [
+            'PREPARE {} AS select * from actor where a = $1'.format(prepared1.statement_name),
+            'EXECUTE {} (%s)'.format(prepared1.statement_name),
+            'EXECUTE {} (%s)'.format(prepared1.statement_name),
+            'PREPARE {} AS select 2'.format(prepared2.statement_name),
+            'DEALLOCATE {}'.format(prepared1.statement_name),
+            'EXECUTE {}'.format(prepared2.statement_name),
+        ]
+        assert recording_cur.executed[2][1] == [2]
+
+    def test_registry_per_connection(self, recording_cur):
+        registry = PreparedStatements()
+        prepared = prepare_query('Q1', 'select 1')
+        for _ in range(2):
+            recording_cur.connection = FakeConnection()
+            registry.execute(recording_cur, prepared, ())
+        assert sum(1 for q, args in recording_cur.executed if q.startswith('PREPARE')) == 2
+
+    def test_not_psycopg2(self, sqlite_cur, sql_select_nums):
+        name, sql_type, fcn = parse_sql_entry(sql_select_nums)
+        assert fcn(sqlite_cur, (23,), prepare=True) == [(23,), (24,)]
+
+
+class TestScanParams:
+    def test_scan_positions(self):
+        s = 'SELECT %s, %(val_1)s FROM testdb'
+        params = scan_params(s)
+        assert [p.name for p in params] == [None, 'val_1']
+        assert [s[p.start:p.end] for p in params] == ['%s', '%(val_1)s']
+
+    def test_scan_skips_literals(self):
+        s = ("SELECT '%(a)s', E'\\' %(b)s', \"%(c)s\", $$%(d)s$$, $fn$ %s $fn$, 100%% "
+             "FROM testdb WHERE x = %(val_1)s")
+        assert [p.name for p in scan_params(s)] == ['val_1']
+
+    def test_scan_dollar_in_identifier(self):
+        # $ within an identifier, or a positional $1, starts no dollar quote
+        assert [p.name for p in scan_params('SELECT $1, foo$bar$ , %(x)s')] == ['x']
+        assert [p.name for p in scan_params('SELECT a$$b, %(x)s, $$ %(y)s $$')] == ['x']
+
+    def test_scan_skips_comments(self):
+        s = 'SELECT 1 -- %(a)s\n/* %(b)s\n%s */ FROM testdb WHERE x = %(val_1)s'
+        assert [p.name for p in scan_params(s)] == ['val_1']
+
+    def test_scan_escaped_quote(self):
+        assert [p.name for p in scan_params("SELECT 'it''s %(a)s', %(val_1)s")] == ['val_1']
+
+    def test_scan_trailing_percent(self):
+        assert scan_params('SELECT 100 %') == []
+
+    def test_parse_args(self):
+        assert parse_args('AND col_1 = %(val_1)s OR col_2 = %(val_1)s') == {'val_1'}
+        assert parse_args('AND col_1 = %s') is None
+
+    def test_built_literal_across_lines(self):
+        built = BuiltQuery(['SELECT * FROM testdb', "WHERE note = 'a", "%(val_2)s'", 'AND col_1 = %(val_1)s'])
+        assert built.line_params == [frozenset(), frozenset(), frozenset(), frozenset(['val_1'])]
+
+
+class TestMetrics:
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: insert_num!\nINSERT INTO nums VALUES (?)\n\n'
+                           '-- name: select_missing\nSELECT x FROM missing')
+        return Queries(str(queries_file), metrics=True)
+
+    def test_stats(self, sql, sqlite_cur):
+        sql.SELECT_NUMS(sqlite_cur, (20,))
+        sql.SELECT_NUMS(sqlite_cur, (0,), n=1)
+        assert len(list(sql.SELECT_NUMS(sqlite_cur, (10,), stream=True, batch_size=4))) == 15
+        sql.INSERT_NUM(sqlite_cur, (30,))
+        with pytest.raises(sqlite3.OperationalError):
+            sql.SELECT_MISSING(sqlite_cur)
+        stats = sql.stats()
+        select = stats['SELECT_NUMS']
+        assert (select.calls, select.errors, select.rows) == (3, 0, 5 + 1 + 15)
+        assert select.sql_type == QueryType.SELECT
+        assert select.build.count == select.execute.count == select.fetch.count == 3
+        assert select.execute.buckets[-1] == (float('inf'), 3)
+        assert select.execute.sum > 0
+        insert = stats['INSERT_NUM']
+        assert (insert.calls, insert.rows, insert.execute.count, insert.fetch.count) == (1, 0, 1, 0)
+        missing = stats['SELECT_MISSING']
+        assert (missing.calls, missing.errors, missing.execute.count) == (1, 1, 0)
+
+    def test_stats_threads(self, sql, tmpdir):
+        db_path = str(tmpdir.join('nums.db'))
+        db = sqlite3.connect(db_path)
+        db.execute('CREATE TABLE nums (x INTEGER)')
+        db.commit()
+        db.close()
+
+        def work():
+            db = sqlite3.connect(db_path)
+            for i in range(50):
+                sql.SELECT_NUMS(db.cursor(), (0,))
+            db.close()
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert sql.stats()['SELECT_NUMS'].calls == 200
+
+    def test_ended_threads(self):
+        metrics = sqlpy.metrics.QueryMetrics('SELECT_NUMS', QueryType.SELECT)
+        for i in range(50):
+            thread = threading.Thread(target=metrics.record, args=(0, 0.001, 0.002, 0.003, 2))
+            thread.start()
+            thread.join()
+        # the shards of ended threads are folded into the retired total, on Python 2 the
+        # locals of the last thread may only be dropped shortly after join returns
+        for _ in range(100):
+            gc.collect()
+            if not metrics._shards:
+                break
+            time.sleep(0.01)
+        assert len(metrics._shards) == 0
+        metrics.record_error()
+        stats = metrics.stats()
+        assert (stats.calls, stats.errors, stats.rows, stats.fetch.count) == (51, 1, 100, 50)
+        assert len(metrics._shards) == 1
+
+    def test_stats_disabled(self, sqlite_cur, sql_select_nums, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write(sql_select_nums)
+        sql = Queries(str(queries_file))
+        sql.SELECT_NUMS(sqlite_cur, (0,))
+        assert sql.stats() == {}
+        assert sql.stats_prometheus() == ''
+
+    def test_prometheus(self, sql, sqlite_cur):
+        sql.SELECT_NUMS(sqlite_cur, (20,))
+        text = sql.stats_prometheus()
+        assert '# TYPE sqlpy_query_calls_total counter' in text
+        assert 'sqlpy_query_calls_total{query="SELECT_NUMS",type="SELECT"} 1\n' in text
+        assert 'sqlpy_query_rows_total{query="SELECT_NUMS",type="SELECT"} 5\n' in text
+        assert '# TYPE sqlpy_query_duration_seconds histogram' in text
+        assert ('sqlpy_query_duration_seconds_bucket{query="SELECT_NUMS",type="SELECT",phase="fetch",le="+Inf"} 1\n'
+                in text)
+        assert 'sqlpy_query_duration_seconds_count{query="SELECT_NUMS",type="SELECT",phase="build"} 1\n' in text
+        assert text.endswith('\n')
+
+
+class TestHooks:
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: select_built$\nSELECT x FROM nums\nWHERE 1=1\nAND x >= %(low)s\n\n'
+                           '-- name: select_missing\nSELECT x FROM missing')
+        return Queries(str(queries_file))
+
+    def test_hooks(self, sql, sqlite_cur):
+        events = []
+        sql.add_hook('before_execute', lambda event: events.append(('before', event.name, event.duration)))
+        sql.add_hook('after_execute', lambda event: events.append(('after', event.name, event.query, event.args,
+                                                                   event.sql_type, event.duration >= 0)))
+        assert sql.SELECT_NUMS(sqlite_cur, (24,)) == [(24,)]
+        assert events == [('before', 'SELECT_NUMS', None),
+                          ('after', 'SELECT_NUMS', 'SELECT x FROM nums WHERE x >= ? ORDER BY x', (24,),
+                           QueryType.SELECT, True)]
+
+    def test_hooks_built_query(self, sql, sqlite_cur):
+        queries = []
+        sql.add_hook('after_execute', lambda event: queries.append(event.query))
+        sql.SELECT_BUILT(sqlite_cur, {})
+        assert queries == ['SELECT x FROM nums\nWHERE 1=1']
+
+    def test_hooks_context(self, sql, sqlite_cur):
+        spans = []
+        sql.add_hook('before_execute', lambda event: event.context.update(span=len(spans)))
+        sql.add_hook('after_execute', lambda event: spans.append(event.context['span']))
+        sql.SELECT_NUMS(sqlite_cur, (0,))
+        sql.SELECT_NUMS(sqlite_cur, (0,))
+        assert spans == [0, 1]
+
+    def test_hooks_error(self, sql, sqlite_cur):
+        errors = []
+        sql.add_hook('on_error', lambda event: errors.append((event.name, type(event.error))))
+        with pytest.raises(sqlite3.OperationalError):
+            sql.SELECT_MISSING(sqlite_cur)
+        assert errors == [('SELECT_MISSING', sqlite3.OperationalError)]
+
+    def test_hook_raising(self, sql, sqlite_cur):
+        def broken(event):
+            raise RuntimeError('broken hook')
+        sql.add_hook('before_execute', broken)
+        assert sql.SELECT_NUMS(sqlite_cur, (24,)) == [(24,)]
+
+    def test_remove_hook(self, sql, sqlite_cur, monkeypatch):
+        events = []
+        callback = events.append
+        sql.add_hook('after_execute', callback)
+        sql.remove_hook('after_execute', callback)
+        # no event is created without hooks
+        monkeypatch.setattr(sqlpy.hooks, 'QueryEvent', None)
+        sql.SELECT_NUMS(sqlite_cur, (24,))
+        assert events == []
+
+    def test_unknown_hook(self, sql):
+        with pytest.raises(SQLpyException, match='Unknown hook'):
+            sql.add_hook('before_fetch', print)
+
+
+class ExplainConnection(object):
+    """Connection handing out cursors which record their queries and return a plan."""
+    autocommit = False
+
+    def __init__(self, fail=False):
+        self.executed = []
+        self.fail = fail
+
+    def cursor(self):
+        return ExplainCursor(self)
+
+
+class ExplainCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, args=None):
+        self.connection.executed.append(query)
+        if self.connection.fail and query.startswith('EXPLAIN'):
+            raise ValueError('can not explain')
+
+    def executemany(self, query, args):
+        self.connection.executed.append(query)
+        list(args)
+
+    def fetchone(self):
+        return ([{'Plan': {'Node Type': 'Seq Scan'}}],)
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+class TestSlowQueryLog:
+    @pytest.fixture
+    def queries_path(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x')
+        return str(queries_file)
+
+    def test_slow(self, queries_path, sqlite_cur):
+        slow_log = SlowQueryLog(0)
+        sql = Queries(queries_path, slow_query_log=slow_log)
+        sql.SELECT_NUMS(sqlite_cur, (24,))
+        sql.SELECT_NUMS(sqlite_cur, (24,), log_query_params=False)
+        first, second = slow_log.dump()
+        assert (first['name'], first['sql_type'], first['args'], first['plan']) == ('SELECT_NUMS', 'SELECT', (24,), None)
+        assert first['query'] == 'SELECT x FROM nums WHERE x >= ? ORDER BY x'
+        assert second['args'] == '<redacted>'
+        slow_log.clear()
+        assert slow_log.dump() == []
+
+    def test_bulk(self, tmpdir, monkeypatch):
+        monkeypatch.setattr(sqlpy.bulk, 'execute_values', None)
+        queries_file = tmpdir.join('insert.sql')
+        queries_file.write('-- name: insert_num!\nINSERT INTO nums VALUES (?)')
+        slow_log = SlowQueryLog(0, explain=True, explain_interval=0)
+        sql = Queries(str(queries_file), slow_query_log=slow_log)
+        connection = ExplainConnection()
+        sql.INSERT_NUM(connection.cursor(), [(1,), (2,)], many=True)
+        sql.INSERT_NUM(connection.cursor(), iter([(1,)]), many=True)
+        # the rows are not kept, nor explained
+        assert [(entry['args'], entry['plan']) for entry in slow_log.dump()] == [('<2 rows>', None), ('<rows>', None)]
+        assert not any(query.startswith('EXPLAIN') for query in connection.executed)
+
+    def test_threshold(self, queries_path, sqlite_cur):
+        slow_log = SlowQueryLog(60)
+        sql = Queries(queries_path, slow_query_log=slow_log)
+        sql.SELECT_NUMS(sqlite_cur, (24,))
+        assert slow_log.dump() == []
+
+    def test_ring_buffer(self, queries_path, sqlite_cur):
+        slow_log = SlowQueryLog(0, maxlen=3)
+        sql = Queries(queries_path, slow_query_log=slow_log)
+        for i in range(5):
+            sql.SELECT_NUMS(sqlite_cur, (i,))
+        assert [entry['args'] for entry in slow_log.dump()] == [(2,), (3,), (4,)]
+
+    def test_explain(self, queries_path):
+        slow_log = SlowQueryLog(0, explain=True, explain_interval=60)
+        sql = Queries(queries_path, slow_query_log=slow_log)
+        connection = ExplainConnection()
+        assert sql.SELECT_NUMS(connection.cursor(), (1,)) == [(1,)]
+        sql.SELECT_NUMS(connection.cursor(), (1,))
+        first, second = slow_log.dump()
+        assert first['plan'] == [{'Plan': {'Node Type': 'Seq Scan'}}]
+        # explained at most once per interval
+        assert second['plan'] is None
+        assert connection.executed[1:4] == ['SAVEPOINT sqlpy_explain',
+                                            'EXPLAIN (FORMAT JSON) SELECT x FROM nums WHERE x >= ? ORDER BY x',
+                                            'RELEASE SAVEPOINT sqlpy_explain']
+
+    def test_explain_sampling(self, queries_path):
+        slow_log = SlowQueryLog(0, explain=True, explain_sample_rate=0, explain_interval=0)
+        sql = Queries(queries_path, slow_query_log=slow_log)
+        connection = ExplainConnection()
+        sql.SELECT_NUMS(connection.cursor(), (1,))
+        assert slow_log.dump()[0]['plan'] is None
+        assert len(connection.executed) == 1
+
+    def test_explain_failure(self, queries_path):
+        slow_log = SlowQueryLog(0, explain=True)
+        sql = Queries(queries_path, slow_query_log=slow_log)
+        connection = ExplainConnection(fail=True)
+        assert sql.SELECT_NUMS(connection.cursor(), (1,)) == [(1,)]
+        assert slow_log.dump()[0]['plan'] is None
+        assert connection.executed[-1] == 'ROLLBACK TO SAVEPOINT sqlpy_explain'
+
+
+class TestMany:
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('many.sql')
+        queries_file.write('-- name: insert_nums!\nINSERT INTO nums VALUES (?)')
+        return Queries(str(queries_file), query_options={'INSERT_NUMS': {'page_size': 10}})
+
+    @pytest.fixture
+    def executemany(self, monkeypatch):
+        monkeypatch.setattr(sqlpy.bulk, 'execute_values', None)
+
+    def test_pages(self, sql, monkeypatch):
+        pages = []
+        monkeypatch.setattr(sqlpy.bulk, 'execute_values',
+                            lambda cur, query, page, page_size, fetch: pages.append((len(page), page_size)))
+        consumed = []
+
+        def rows():
+            for i in range(25):
+                consumed.append(i)
+                yield (i,)
+
+        progress = []
+        sql.INSERT_NUMS(None, rows(), many=True, progress=lambda count, n: progress.append((count, n)))
+        assert pages == [(10, 10), (10, 10), (5, 5)]
+        assert progress == [(10, 1), (20, 2), (25, 3)]
+        sql.INSERT_NUMS(None, [(i,) for i in range(5)], many=True, page_size=2)
+        assert pages[3:] == [(2, 2), (2, 2), (1, 1)]
+
+    def test_page_generator(self):
+        rows = iter(range(7))
+        pages = sqlpy.bulk.iter_pages(rows, 3)
+        assert next(pages) == [0, 1, 2]
+        # rows are only consumed one page at a time
+        assert next(rows) == 3
+        assert list(pages) == [[4, 5, 6]]
+
+    def test_commit(self, sql, sqlite_cur, executemany):
+        commits = []
+        conn = sqlite_cur.connection
+
+        class Connection(object):
+            def commit(self):
+                commits.append(sqlite_cur.execute('SELECT count(*) FROM nums').fetchone()[0])
+
+        class Cursor(object):
+            connection = Connection()
+
+            def executemany(self, query, page):
+                sqlite_cur.executemany(query, page)
+
+        sql.INSERT_NUMS(Cursor(), ((i,) for i in range(25, 50)), many=True, commit_every=2)
+        assert commits == [45, 50]
+        # every commit went through the cursor's connection, none through sqlite
+        conn.rollback()
+        assert sqlite_cur.execute('SELECT count(*) FROM nums').fetchone()[0] == 0
+
+    def test_savepoint(self, sql, sqlite_cur, executemany):
+        # let the savepoints manage the transaction, as Python 2 sqlite3 commits before them
+        sqlite_cur.connection.isolation_level = None
+        sqlite_cur.execute('CREATE UNIQUE INDEX nums_x ON nums (x)')
+
+        def rows():
+            for i in range(25, 60):
+                yield (i,)
+            yield (25,)
+
+        with pytest.raises(sqlite3.IntegrityError):
+            sql.INSERT_NUMS(sqlite_cur, rows(), many=True, savepoint_every=2)
+        # the pages since the last savepoint were rolled back
+        assert sqlite_cur.execute('SELECT max(x) FROM nums').fetchone()[0] == 44
+
+    def test_returning(self, tmpdir, monkeypatch):
+        executed = []
+
+        def execute_values(cur, query, page, page_size, fetch):
+            executed.append(page)
+            return [(x * 10,) for x, in page] if fetch else None
+
+        monkeypatch.setattr(sqlpy.bulk, 'execute_values', execute_values)
+        queries_file = tmpdir.join('many.sql')
+        queries_file.write('-- name: insert_nums<!>\nINSERT INTO nums VALUES %s RETURNING x * 10')
+        sql = Queries(str(queries_file), metrics=True)
+        rows = [(i,) for i in range(25)]
+        # every page returns its rows, not only the last one
+        assert sql.INSERT_NUMS(None, rows, many=True, page_size=10) == [(i * 10,) for i in range(25)]
+        assert sql.INSERT_NUMS(None, rows, many=True, page_size=10, n=1) == (0,)
+        assert sql.INSERT_NUMS(None, rows, many=True, page_size=10, n=2) == [(0,), (10,)]
+        assert sql.INSERT_NUMS(None, [], many=True, n=1) is None
+        assert sql.stats()['INSERT_NUMS'].rows == 25 + 25 + 25
+
+    def test_returning_executemany(self, tmpdir, sqlite_cur, executemany):
+        queries_file = tmpdir.join('many.sql')
+        queries_file.write('-- name: insert_nums<!>\nINSERT INTO nums VALUES (?) RETURNING x * 10')
+        sql = Queries(str(queries_file))
+        # executemany keeps no rows per statement, so each row is executed and fetched
+        assert sql.INSERT_NUMS(sqlite_cur, [(i,) for i in range(30, 35)], many=True, page_size=2) == \
+            [(i * 10,) for i in range(30, 35)]
+        returned = sql.INSERT_NUMS(sqlite_cur, ((i,) for i in range(40, 45)), many=True, stream=True, page_size=2)
+        assert list(returned) == [(i * 10,) for i in range(40, 45)]
+
+    def test_returning_stream(self, tmpdir, monkeypatch):
+        executed = []
+
+        def execute_values(cur, query, page, page_size, fetch):
+            executed.append(page)
+            return [(x * 10,) for x, in page]
+
+        monkeypatch.setattr(sqlpy.bulk, 'execute_values', execute_values)
+        queries_file = tmpdir.join('many.sql')
+        queries_file.write('-- name: insert_nums<!>\nINSERT INTO nums VALUES %s RETURNING x * 10')
+        sql = Queries(str(queries_file), metrics=True)
+        returned = sql.INSERT_NUMS(None, ((i,) for i in range(25)), many=True, stream=True, page_size=10)
+        assert isinstance(returned, types.GeneratorType)
+        assert executed == []
+        assert next(returned) == (0,)
+        # a page is only executed once the rows of the previous one are consumed
+        assert len(executed) == 1
+        assert list(returned) == [(i * 10,) for i in range(1, 25)]
+        assert len(executed) == 3
+        stats = sql.stats()['INSERT_NUMS']
+        assert (stats.calls, stats.rows, stats.fetch.count) == (1, 25, 1)
+
+    def test_args(self, sql):
+        with pytest.raises(SQLpyException):
+            sql.INSERT_NUMS(None, [(1,)], many=True, page_size=0)
+        with pytest.raises(SQLpyException):
+            sql.INSERT_NUMS(None, [(1,)], many=True, commit_every=1, savepoint_every=1)
+
+
+class SqlitePool(object):
+    """Stand-in for psycopg2's ThreadedConnectionPool, blocking when exhausted."""
+    def __init__(self, path, size):
+        self.path = path
+        self.free = [sqlite3.connect(path, check_same_thread=False) for i in range(size)]
+        self.available = threading.Semaphore(size)
+        self.lock = threading.Lock()
+        self.closed = 0
+
+    def getconn(self):
+        self.available.acquire()
+        with self.lock:
+            return self.free.pop()
+
+    def putconn(self, conn, close=False):
+        if close:
+            conn.close()
+            self.closed += 1
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self.lock:
+            self.free.append(conn)
+        self.available.release()
+
+
+class TestBind:
+    @pytest.fixture
+    def db_path(self, tmpdir):
+        path = str(tmpdir.join('nums.db'))
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE nums (x INTEGER)')
+        db.executemany('INSERT INTO nums VALUES (?)', [(i,) for i in range(25)])
+        db.commit()
+        db.close()
+        return path
+
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: insert_num!\nINSERT INTO nums VALUES (?)\n\n'
+                           '-- name: select_missing\nSELECT x FROM missing')
+        return Queries(str(queries_file), metrics=True)
+
+    def count(self, db_path):
+        db = sqlite3.connect(db_path)
+        try:
+            return db.execute('SELECT count(*) FROM nums').fetchone()[0]
+        finally:
+            db.close()
+
+    def test_pool(self, sql, db_path):
+        pool = SqlitePool(db_path, 1)
+        db = sql.bind(pool)
+        assert db.SELECT_NUMS((22,)) == [(22,), (23,), (24,)]
+        assert db.SELECT_NUMS((22,), n=1) == (22,)
+        assert db.INSERT_NUM((30,))
+        # committed, so visible from another connection
+        assert self.count(db_path) == 26
+        assert len(pool.free) == 1
+        stats = db.pool_stats()
+        assert (stats.name, stats.checkouts, stats.errors, stats.wait.count) == ('default', 3, 0, 3)
+        assert 'sqlpy_pool_wait_seconds_count{pool="default"} 3' in sql.stats_prometheus()
+        with pytest.raises(AttributeError):
+            db.MISSING_QUERY
+
+    def test_rollback(self, sql, db_path):
+        pool = SqlitePool(db_path, 1)
+        db = sql.bind(pool, commit=False)
+        db.INSERT_NUM((30,))
+        assert self.count(db_path) == 25
+        db = sql.bind(pool)
+        with pytest.raises(sqlite3.OperationalError):
+            db.SELECT_MISSING()
+        assert len(pool.free) == 1
+
+    def test_stream(self, sql, db_path):
+        pool = SqlitePool(db_path, 1)
+        rows = sql.bind(pool).SELECT_NUMS((0,), stream=True, batch_size=5)
+        assert next(rows) == (0,)
+        # the connection is held until the stream is done
+        assert pool.free == []
+        assert len(list(rows)) == 24
+        assert len(pool.free) == 1
+
+    def test_factory(self, sql, db_path):
+        opened = []
+
+        def connect():
+            conn = sqlite3.connect(db_path)
+            opened.append(conn)
+            return conn
+
+        db = sql.bind(connect)
+        assert db.SELECT_NUMS((24,)) == [(24,)]
+        with pytest.raises(sqlite3.ProgrammingError):
+            opened[0].cursor()
+        with pytest.raises(SQLpyException):
+            sql.bind(object())
+
+    def test_wait(self, sql, db_path):
+        pool = SqlitePool(db_path, 2)
+        db = sql.bind(pool, name='nums')
+
+        def work():
+            for i in range(20):
+                db.SELECT_NUMS((0,), n=1)
+        threads = [threading.Thread(target=work) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = db.pool_stats()
+        assert stats.checkouts == stats.wait.count == 80
+        assert len(pool.free) == 2
+
+
+def mogrify(query, args):
+    """Client side binding of ? and %(name)s parameters, enough for the batch tests."""
+    if isinstance(args, dict):
+        for key, value in args.items():
+            query = query.replace('%({})s'.format(key), repr(value))
+        return query
+    for value in args:
+        query = query.replace('?', repr(value), 1)
+    return query
+
+
+class MultiCursor(object):
+    """Driver cursor running multi-statement SQL on sqlite, with nextset support."""
+    def __init__(self, db):
+        self.db = db
+        self.round_trips = 0
+        self.results = []
+        self.queries = []
+
+    def mogrify(self, query, args):
+        return mogrify(query, args)
+
+    def execute(self, query, args=None):
+        self.round_trips += 1
+        self.queries.append(query)
+        self.results = [self.db.execute(mogrify(statement, args or ())).fetchall()
+                        for statement in query.split(';\n')]
+
+    def nextset(self):
+        self.results.pop(0)
+        return True if self.results else None
+
+    def fetchall(self):
+        return self.results[0]
+
+    def fetchone(self):
+        return self.results[0][0] if self.results[0] else None
+
+    def fetchmany(self, size):
+        return self.results[0][:size]
+
+
+class PipelineConnection(object):
+    """psycopg 3 like connection on sqlite, sending all statements of a pipeline at once."""
+    def __init__(self, db):
+        self.db = db
+        self.round_trips = 0
+        self.queued = None
+
+    @contextlib.contextmanager
+    def pipeline(self):
+        self.queued = []
+        yield
+        self.round_trips += 1
+        for cur, query, args in self.queued:
+            cur.rows = self.db.execute(query, args).fetchall()
+        self.queued = None
+
+    def cursor(self):
+        return PipelineCursor(self)
+
+
+class PipelineCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.rows = []
+        self.closed = False
+
+    def execute(self, query, args=()):
+        if self.connection.queued is None:
+            self.connection.round_trips += 1
+            self.rows = self.connection.db.execute(query, args).fetchall()
+        else:
+            self.connection.queued.append((self, query, args))
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def fetchmany(self, size):
+        return self.rows[:size]
+
+    def close(self):
+        self.closed = True
+
+
+class RoundTripCursor(CountingCursor):
+    def execute(self, query, args=()):
+        self.calls.append('execute')
+        return self.cur.execute(query, args)
+
+
+class TestBatch:
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: count_nums\nSELECT count(*) FROM nums\n\n'
+                           '-- name: insert_num!\nINSERT INTO nums VALUES (?)\n\n'
+                           '-- name: select_built$\nSELECT x FROM nums\nWHERE x >= %(low)s\nORDER BY x\n\n'
+                           '-- name: select_missing\nSELECT x FROM missing\n\n'
+                           '-- name: get_num@\nget_num')
+        return Queries(str(queries_file), metrics=True)
+
+    def run(self, sql, cur):
+        with sql.batch(cur) as batch:
+            high = batch.SELECT_NUMS((22,))
+            inserted = batch.INSERT_NUM((25,))
+            count = batch.COUNT_NUMS(n=1)
+            first = batch.SELECT_NUMS(args=(0,), n=2)
+            assert not count.done
+        return batch, high.value, inserted.value, count.value, first.value
+
+    def test_multi(self, sql, sqlite_cur):
+        cur = MultiCursor(sqlite_cur.connection)
+        batch, high, inserted, count, first = self.run(sql, cur)
+        assert batch.mode == 'multi'
+        assert cur.round_trips == 1
+        assert (high, inserted, count, first) == ([(22,), (23,), (24,)], True, (26,), [(0,), (1,)])
+        with sql.batch(cur) as batch:
+            built = batch.SELECT_BUILT({'low': 24})
+        assert built.value == [(24,), (25,)]
+        stats = sql.stats()['SELECT_NUMS']
+        assert (stats.calls, stats.rows) == (2, 5)
+
+    def test_multi_statements(self, tmpdir, sqlite_cur):
+        queries_file = tmpdir.join('ends.sql')
+        queries_file.write('-- name: max_num\nSELECT max(x) FROM nums;\n\n'
+                           '-- name: min_num\nSELECT min(x) FROM nums -- the first one\n\n'
+                           '-- name: count_nums\nSELECT count(*) FROM nums ;  \n')
+        sql = Queries(str(queries_file))
+        cur = MultiCursor(sqlite_cur.connection)
+        with sql.batch(cur) as batch:
+            high = batch.MAX_NUM(n=1)
+            low = batch.MIN_NUM(n=1)
+            count = batch.COUNT_NUMS(n=1)
+        assert cur.queries == ['SELECT max(x) FROM nums;\n'
+                               'SELECT min(x) FROM nums -- the first one\n;\n'
+                               'SELECT count(*) FROM nums']
+        assert (high.value, low.value, count.value) == ((24,), (0,), (25,))
+
+    def test_pipeline(self, sql, sqlite_cur):
+        conn = PipelineConnection(sqlite_cur.connection)
+        batch, high, inserted, count, first = self.run(sql, conn.cursor())
+        assert batch.mode == 'pipeline'
+        assert conn.round_trips == 1
+        assert (high, inserted, count, first) == ([(22,), (23,), (24,)], True, (26,), [(0,), (1,)])
+
+    def test_sequential(self, sql, sqlite_cur):
+        cur = RoundTripCursor(sqlite_cur)
+        batch, high, inserted, count, first = self.run(sql, cur)
+        assert batch.mode == 'sequential'
+        assert cur.calls.count('execute') == 4
+        assert (high, inserted, count, first) == ([(22,), (23,), (24,)], True, (26,), [(0,), (1,)])
+        with sql.batch(cur) as batch:
+            high = batch.SELECT_NUMS((24,), row_type='dict')
+        assert high.value == [{'x': 24}, {'x': 25}]
+
+    def test_failure(self, sql, sqlite_cur):
+        cur = MultiCursor(sqlite_cur.connection)
+        with pytest.raises(sqlite3.OperationalError):
+            with sql.batch(cur) as batch:
+                batch.SELECT_NUMS((22,))
+                batch.SELECT_MISSING()
+        assert sql.stats()['SELECT_NUMS'].errors == 1
+        # a failing block executes nothing
+        with pytest.raises(ValueError):
+            with sql.batch(cur) as batch:
+                pending = batch.SELECT_NUMS((22,))
+                raise ValueError()
+        assert cur.round_trips == 1
+        with pytest.raises(SQLpyException):
+            pending.value
+
+    def test_unsupported(self, sql, sqlite_cur):
+        batch = sql.batch(sqlite_cur)
+        with pytest.raises(SQLpyException):
+            batch.SELECT_NUMS((1,), stream=True)
+        with pytest.raises(SQLpyException):
+            batch.GET_NUM()
+        with pytest.raises(SQLpyException):
+            batch.SELECT_NUMS((1,), n=0.5)
+        with pytest.raises(AttributeError):
+            batch.MISSING
+        with pytest.raises(SQLpyException):
+            sql.batch(sqlite_cur, mode='parallel')
+        batch.execute()
+        with pytest.raises(SQLpyException):
+            batch.execute()
+
+
+class TestResultCache:
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: select_other\nSELECT x FROM other\n\n'
+                           '-- name: select_built$\nSELECT x FROM nums\nWHERE 1=1\nAND x >= %(low)s\n\n'
+                           '-- name: insert_num!\nINSERT INTO nums VALUES (?)\n\n'
+                           '-- name: insert_other!\nINSERT INTO main.other (x) VALUES (?)')
+        return Queries(str(queries_file), result_cache=ResultCache(),
+                       query_options={'SELECT_NUMS': {'cache_ttl': 60}, 'SELECT_OTHER': {'cache_ttl': 60}})
+
+    @pytest.fixture
+    def cur(self, sqlite_cur):
+        sqlite_cur.execute('CREATE TABLE other (x INTEGER)')
+        return RoundTripCursor(sqlite_cur)
+
+    def test_query_tables(self):
+        assert query_tables('SELECT * FROM public.actor a, "Film" AS f JOIN film_actor fa ON fa.x = a.x '
+                            "WHERE a.name = 'from junk' -- JOIN junk") == {'actor', 'film', 'film_actor'}
+        assert query_tables('SELECT * FROM generate_series(1, 2) g, (SELECT x FROM nums) n') == {'nums'}
+        assert query_tables('INSERT INTO public.actor (name) VALUES (%s) '
+                            'ON CONFLICT (id) DO UPDATE SET name = 1') == {'actor'}
+        assert query_tables('UPDATE actor SET x = 1 FROM film WHERE 1 = 1') == {'actor', 'film'}
+        assert query_tables('TRUNCATE TABLE a, b') == {'a', 'b'}
+        assert query_tables('SELECT extract(year FROM now())') == frozenset()
+
+    def test_hit(self, sql, cur):
+        assert sql.SELECT_NUMS(cur, (23,)) == [(23,), (24,)]
+        assert sql.SELECT_NUMS(cur, (23,)) == [(23,), (24,)]
+        assert sql.SELECT_NUMS(cur, (23,), n=1) == (23,)
+        assert cur.calls.count('execute') == 2
+        assert sql.result_cache_info() == {'SELECT_NUMS': (1, 2, 1 / 3.0)}
+
+    def test_built(self, sql, recording_cur):
+        # keyed on the arguments given, before the missing ones are set
+        for args in ({'low': 1}, {'low': 1}, {'low': 2}):
+            assert sql.SELECT_BUILT(recording_cur, args, cache_ttl=60) == [(1,), (2,), (3,)]
+        assert len(recording_cur.executed) == 2
+        # not cached without a ttl
+        sql.SELECT_BUILT(recording_cur, {'low': 1})
+        assert len(recording_cur.executed) == 3
+
+    def test_returns_copy(self, sql, cur):
+        sql.SELECT_NUMS(cur, (24,)).append((0,))
+        assert sql.SELECT_NUMS(cur, (24,)) == [(24,)]
+
+    def test_ttl(self, sql, cur):
+        sql.SELECT_NUMS(cur, (24,), cache_ttl=0.01)
+        time.sleep(0.02)
+        sql.SELECT_NUMS(cur, (24,), cache_ttl=0.01)
+        assert cur.calls.count('execute') == 2
+
+    def test_invalidate(self, sql, cur):
+        sql.SELECT_NUMS(cur, (24,))
+        sql.SELECT_OTHER(cur)
+        sql.INSERT_NUM(cur, (30,))
+        assert sql.SELECT_NUMS(cur, (24,)) == [(24,), (30,)]
+        sql.SELECT_OTHER(cur)
+        assert cur.calls.count('execute') == 4
+        # a schema qualified name invalidates the same table
+        sql.INSERT_OTHER(cur, (1,))
+        assert sql.SELECT_OTHER(cur) == [(1,)]
+
+    def test_invalidated_while_executing(self, sql, cur):
+        cache = sql.result_cache
+        version = cache.version({'nums'})
+        cache.invalidate({'nums'})
+        cache.put(('SELECT_NUMS',), [(1,)], 60, frozenset(['nums']), version)
+        assert len(cache) == 0
+
+    def test_lru(self, sqlite_cur, sql):
+        cache = ResultCache(maxsize=2, max_rows=3)
+        sql = Queries(sql._filepath, result_cache=cache)
+        for low in (20, 22, 23, 24):
+            sql.SELECT_NUMS(sqlite_cur, (low,), cache_ttl=60)
+        assert len(cache) == 2
+        assert cache._tables == {'nums': set(cache._entries.keys())}
+        cache.clear(['SELECT_NUMS'])
+        assert (len(cache), cache._tables) == (0, {})
+
+    def test_unhashable_args(self, sql, cur, recording_cur):
+        cache = sql.result_cache
+        assert cache.key('SELECT_NUMS', cur, [{'a': [1]}]) is not None
+        assert cache.key('SELECT_NUMS', cur, [bytearray(b'1')]) is None
+        assert sql.SELECT_NUMS(recording_cur, [bytearray(b'1')]) == [(1,), (2,), (3,)]
+        assert len(cache) == 0
+
+    def test_connections(self, sql, sqlite_cur):
+        other = sqlite3.connect(':memory:').cursor()
+        other.execute('CREATE TABLE nums (x INTEGER)')
+        other.executemany('INSERT INTO nums VALUES (?)', [(i,) for i in range(100, 103)])
+        assert sql.SELECT_NUMS(sqlite_cur, (23,)) == [(23,), (24,)]
+        # the results of another database are not shared
+        assert sql.SELECT_NUMS(other, (23,)) == [(100,), (101,), (102,)]
+        assert sql.SELECT_NUMS(sqlite_cur, (23,)) == [(23,), (24,)]
+        assert sql.result_cache_info()['SELECT_NUMS'].hits == 1
+
+    def test_namespace(self, sql, sqlite_cur):
+        # a caller given namespace shares the results of connections to the same database
+        cache = ResultCache(namespace=lambda cur: 'nums_db')
+        sql = Queries(sql._filepath, result_cache=cache)
+        assert sql.SELECT_NUMS(sqlite_cur, (23,), cache_ttl=60) == [(23,), (24,)]
+        assert sql.SELECT_NUMS(sqlite3.connect(':memory:').cursor(), (23,), cache_ttl=60) == [(23,), (24,)]
+        assert len(cache) == 1
+
+
+class TestColumnar:
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x, x * 0.5 AS half, \'n\' || x AS label, '
+                           'CASE WHEN x % 5 THEN x END AS sparse FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: select_built$\nSELECT x FROM nums\nWHERE x < 3\n\n'
+                           '-- name: select_twice\nSELECT x, x FROM nums\n\n'
+                           '-- name: insert_num!\nINSERT INTO nums VALUES (?)')
+        return Queries(str(queries_file), metrics=True)
+
+    def test_infer_dtype(self):
+        assert infer_dtype([1, 2]) == 'i8'
+        assert infer_dtype([1, 2.5]) == 'f8'
+        assert infer_dtype([1, None]) == 'f8'
+        assert infer_dtype([True, None]) == 'O'
+        assert infer_dtype([datetime.date(2020, 1, 1)]) == 'M8[D]'
+        assert infer_dtype([datetime.datetime(2020, 1, 1), None]) == 'M8[us]'
+        assert infer_dtype(['a', 1]) == 'O'
+        assert infer_dtype([None, None]) == 'O'
+        assert infer_dtype([None], type_code=23) == 'f8'
+        assert infer_dtype([], type_code=16) == '?'
+
+    def test_numpy(self, sql, sqlite_cur):
+        np = pytest.importorskip('numpy')
+        cur = CountingCursor(sqlite_cur)
+        columns = sql.SELECT_NUMS(cur, (18,), columnar=True, batch_size=3)
+        assert cur.calls == [3, 3, 3, 3]
+        assert list(columns) == ['x', 'half', 'label', 'sparse']
+        assert columns['x'].dtype == np.int64 and columns['x'].tolist() == list(range(18, 25))
+        assert columns['half'].dtype == np.float64 and columns['half'][1] == 9.5
+        assert columns['label'].dtype == object and columns['label'][0] == 'n18'
+        # NULL in a later batch turns the integers into floats
+        assert columns['sparse'].dtype == np.float64 and np.isnan(columns['sparse'][2])
+        assert sql.stats()['SELECT_NUMS'].rows == 7
+        assert sql.SELECT_BUILT(sqlite_cur, {}, columnar='numpy')['x'].tolist() == [0, 1, 2]
+
+    def test_empty(self, sql, sqlite_cur):
+        pytest.importorskip('numpy')
+        columns = sql.SELECT_NUMS(sqlite_cur, (100,), columnar=True)
+        assert [len(array) for array in columns.values()] == [0, 0, 0, 0]
+
+    def test_dict_rows(self, sql, sqlite_cur):
+        pytest.importorskip('numpy')
+        sqlite_cur.row_factory = lambda cur, row: dict(zip([column[0] for column in cur.description], row))
+        assert sql.SELECT_NUMS(sqlite_cur, (23,), columnar=True)['label'].tolist() == ['n23', 'n24']
+
+    def test_named_cursor(self, sql, sqlite_cur, monkeypatch):
+        pytest.importorskip('numpy')
+
+        class NamedCursor(CountingCursor):
+            """Describes its result only once fetched from, as a psycopg2 named cursor"""
+            name = 'sqlpy_select_nums'
+            fetched = False
+
+            @property
+            def description(self):
+                return self.cur.description if self.fetched else None
+
+            def fetchmany(self, size):
+                self.fetched = True
+                return super(NamedCursor, self).fetchmany(size)
+        monkeypatch.setattr(sqlpy.sqlpy, 'server_side_cursor',
+                            lambda cur, name, itersize=None: NamedCursor(cur.connection.cursor()))
+        columns = sql.SELECT_NUMS(sqlite_cur, (20,), columnar=True, server_side=True, batch_size=2)
+        assert columns['x'].tolist() == [20, 21, 22, 23, 24]
+
+    def test_pandas(self, sql, sqlite_cur):
+        pytest.importorskip('pandas')
+        frame = sql.SELECT_NUMS(sqlite_cur, (20,), columnar='pandas', batch_size=2)
+        assert list(frame.columns) == ['x', 'half', 'label', 'sparse']
+        assert frame['x'].tolist() == [20, 21, 22, 23, 24]
+
+    def test_unsupported(self, sql, sqlite_cur):
+        with pytest.raises(SQLpyException):
+            sql.SELECT_NUMS(sqlite_cur, (20,), columnar='arrow')
+        with pytest.raises(SQLpyException):
+            sql.SELECT_NUMS(sqlite_cur, (20,), columnar=True, n=1)
+        with pytest.raises(SQLpyException):
+            sql.SELECT_NUMS(sqlite_cur, (20,), columnar=True, stream=True)
+        pytest.importorskip('numpy')
+        with pytest.raises(SQLpyException):
+            sql.SELECT_TWICE(sqlite_cur, columnar=True)
+
+
+
+class TestRowType:
+    @pytest.fixture
+    def sql(self, tmpdir):
+        queries_file = tmpdir.join('nums.sql')
+        queries_file.write('-- name: select_nums\nSELECT x, x * 2 AS "double x" FROM nums WHERE x >= ? ORDER BY x\n\n'
+                           '-- name: select_all\nSELECT * FROM nums WHERE x = 24\n\n'
+                           '-- name: select_built$\nSELECT x FROM nums\nWHERE x < 2')
+        return Queries(str(queries_file))
+
+    def test_row_types(self, sql, sqlite_cur):
+        assert sql.SELECT_NUMS(sqlite_cur, (24,), row_type='tuple') == [(24, 48)]
+        row = sql.SELECT_NUMS(sqlite_cur, (24,), row_type='namedtuple')[0]
+        assert (row.x, row._1, type(row).__name__) == (24, 48, 'SELECT_NUMS')
+        row = sql.SELECT_NUMS(sqlite_cur, (24,), row_type='slots')[0]
+        assert (row.x, row._1, tuple(row), row._asdict()) == (24, 48, (24, 48), {'x': 24, '_1': 48})
+        assert not hasattr(row, '__dict__')
+        assert row == sql.SELECT_NUMS(sqlite_cur, (24,), row_type='slots')[0]
+        assert sql.SELECT_NUMS(sqlite_cur, (24,), row_type='dict') == [{'x': 24, 'double x': 48}]
+        assert sql.SELECT_BUILT(sqlite_cur, {}, row_type='dict') == [{'x': 0}, {'x': 1}]
+
+    def test_fetch_modes(self, sql, sqlite_cur):
+        assert sql.SELECT_NUMS(sqlite_cur, (23,), n=1, row_type='dict') == {'x': 23, 'double x': 46}
+        assert sql.SELECT_NUMS(sqlite_cur, (30,), n=1, row_type='dict') is None
+        assert [row.x for row in sql.SELECT_NUMS(sqlite_cur, (20,), n=2, row_type='namedtuple')] == [20, 21]
+        rows = sql.SELECT_NUMS(sqlite_cur, (20,), stream=True, batch_size=2, row_type='slots')
+        assert [row.x for row in rows] == [20, 21, 22, 23, 24]
+
+    def test_dict_rows(self, sql, sqlite_cur):
+        sqlite_cur.row_factory = lambda cur, row: dict(zip([column[0] for column in cur.description], row))
+        assert sql.SELECT_NUMS(sqlite_cur, (24,), row_type='tuple') == [(24, 48)]
+        assert sql.SELECT_NUMS(sqlite_cur, (24,), row_type='namedtuple')[0].x == 24
+
+    def test_class_cached(self, sql, sqlite_cur):
+        factory = sql.SELECT_ALL.__row_factory__
+        first = type(sql.SELECT_ALL(sqlite_cur, row_type='slots')[0])
+        assert type(sql.SELECT_ALL(sqlite_cur, row_type='slots')[0]) is first
+        # rebuilt once the columns change
+        sqlite_cur.execute('ALTER TABLE nums ADD COLUMN y INTEGER')
+        row = sql.SELECT_ALL(sqlite_cur, row_type='slots')[0]
+        assert type(row) is not first and (row.x, row.y) == (24, None)
+        assert factory.converter(sqlite_cur, 'slots').row_class is type(row)
+
+    def test_default(self, sql, sqlite_cur):
+        sql = Queries(sql._filepath, row_type='dict', query_options={'SELECT_BUILT': {'row_type': 'tuple'}})
+        assert sql.SELECT_NUMS(sqlite_cur, (24,)) == [{'x': 24, 'double x': 48}]
+        assert sql.SELECT_NUMS(sqlite_cur, (24,), row_type=None) == [(24, 48)]
+        assert sql.SELECT_BUILT(sqlite_cur, {}) == [(0,), (1,)]
+
+    def test_unsupported(self, sql, sqlite_cur):
+        with pytest.raises(SQLpyException):
+            sql.SELECT_NUMS(sqlite_cur, (24,), row_type='object')
+        with pytest.raises(SQLpyException):
+            Queries(sql._filepath, row_type=dict)
+
+
+class TestIdentifiersCache:
+    @pytest.fixture
+    def quoted(self, monkeypatch):
+        monkeypatch.setattr(sqlpy.sqlpy, 'quoted_identifiers', sqlpy.sqlpy.LRUCache(8))
+        calls = []
+
+        def quote(ident, cur):
+            calls.append(ident)
+            return '"{}"'.format(ident)
+        return quote, calls
+
+    def test_formatted(self, quoted):
+        quote, calls = quoted
+        cache = sqlpy.sqlpy.LRUCache(4)
+        query = 'SELECT * FROM t ORDER BY {} {}'
+        for _ in range(3):
+            assert (format_query_identifiers(query, ('name', 'id'), quote, None, cache) ==
+                    'SELECT * FROM t ORDER BY "name" "id"')
+        assert (format_query_identifiers(query, ['id', 'name'], quote, None, cache) ==
+                'SELECT * FROM t ORDER BY "id" "name"')
+        # each identifier quoted once, each combination formatted once
+        assert calls == ['name', 'id']
+        assert cache.info() == (2, 2, 4, 2)
+
+    def test_groups(self, quoted):
+        quote, calls = quoted
+        cache = sqlpy.sqlpy.LRUCache(4)
+        query = 'SELECT {cols} FROM t ORDER BY {order}'
+        first = format_query_identifiers(query, {'cols': ['a', 'b'], 'order': 'a'}, quote, None, cache)
+        assert first == 'SELECT "a","b" FROM t ORDER BY "a"'
+        assert format_query_identifiers(query, {'order': 'a', 'cols': ('a', 'b')}, quote, None, cache) == first
+        assert cache.hits == 1 and calls == ['a', 'b']
+        # iterators are formatted, without being cached
+        assert format_query_identifiers(query, {'cols': iter(['b']), 'order': 'b'}, quote, None, cache) == \
+            'SELECT "b" FROM t ORDER BY "b"'
+        assert len(cache) == 1
+
+    def test_encoding(self, quoted):
+        quote, calls = quoted
+        cache = sqlpy.sqlpy.LRUCache(4)
+
+        class Cursor(object):
+            def __init__(self, encoding):
+                self.connection = FakeConnection()
+                self.connection.encoding = encoding
+
+        for encoding in ('UTF8', 'SJIS', 'UTF8'):
+            format_query_identifiers('SELECT {}', ('a',), quote, Cursor(encoding), cache)
+        assert calls == ['a', 'a'] and len(cache) == 2
+
+    def test_functions(self, queries_file):
+        sql = Queries(queries_file)
+        assert sql.TEST_SELECT.__identifiers_cache__ is not sql.TEST_SELECT2.__identifiers_cache__
+        assert sql.identifiers_cache_info() == {}
+
+class CopyCursor(object):
+    """Cursor whose copy_expert reads the whole file into a BytesIO sink."""
+    def __init__(self):
+        self.statement = None
+        self.sink = io.BytesIO()
+
+    def copy_expert(self, sql, file, size=8192):
+        self.statement = sql
+        while True:
+            data = file.read(size)
+            if not data:
+                break
+            self.sink.write(data)
+
+
+class TestCopy:
+    def test_statement(self):
+        assert copy_statement('INSERT INTO users (name, age) VALUES %s') == \
+            "COPY users (name, age) FROM STDIN WITH (FORMAT csv, ENCODING 'UTF8')"
+        assert copy_statement('insert into "My Table" values (%s, %s)', 'binary') == \
+            'COPY "My Table" FROM STDIN WITH (FORMAT binary)'
+        assert copy_statement('COPY users FROM STDIN') == 'COPY users FROM STDIN'
+        with pytest.raises(SQLpyException):
+            copy_statement('UPDATE users SET age = %s')
+        with pytest.raises(SQLpyException):
+            copy_statement('INSERT INTO users VALUES %s', 'text')
+        # COPY would drop the conflict handling, the SELECT and the expressions
+        for query in ('INSERT INTO t (a, b) VALUES %s ON CONFLICT (a) DO UPDATE SET b = EXCLUDED.b',
+                      'INSERT INTO t (a) SELECT x FROM other WHERE y = %s',
+                      'INSERT INTO t (a, b) VALUES (%s, lower(%s))',
+                      'INSERT INTO t (a) VALUES %s RETURNING id'):
+            with pytest.raises(SQLpyException):
+                copy_statement(query)
+        assert copy_statement('INSERT INTO t VALUES ( %s,%s );\n', 'binary') == 'COPY t FROM STDIN WITH (FORMAT binary)'
+
+    def test_csv(self):
+        sink = io.BytesIO()
+        rows = [(1, 'plain', None), (2, '', True), (3, 'a,"b"\nc', b'\x01\xff'),
+                (4, u'\u00e9', datetime.date(2020, 1, 2))]
+        result = write_copy(iter(rows), sink)
+        assert result.rows == 4
+        assert result.bytes == len(sink.getvalue())
+        assert sink.getvalue().decode('utf-8') == (u'1,plain,\n'
+                                                   u'2,"",t\n'
+                                                   u'3,"a,""b""\nc",\\x01ff\n'
+                                                   u'4,\u00e9,2020-01-02\n')
+
+    def test_csv_non_ascii_bytes(self):
+        assert csv_value(bytearray(b'\xc3\xa9')) == '\\xc3a9'
+        # not UTF-8, binary on Python 2 as well
+        assert csv_value(b'\x80\xff') == '\\x80ff'
+        # a str holding UTF-8 text on Python 2
+        assert csv_value(b'caf\xc3\xa9') == (u'caf\u00e9' if bytes is str else '\\x636166c3a9')
+        sink = io.BytesIO()
+        write_copy([(1, b'\x80\xff')], sink)
+        assert sink.getvalue() == b'1,\\x80ff\n'
+
+    def test_binary(self):
+        sink = io.BytesIO()
+        result = write_copy([(1, u'ab', None, 1.5)], sink, 'binary')
+        assert result.rows == 1
+        assert sink.getvalue() == (b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0) +
+                                   struct.pack('!h', 4) + struct.pack('!iq', 8, 1) + struct.pack('!i', 2) + b'ab' +
+                                   struct.pack('!i', -1) + struct.pack('!id', 8, 1.5) + struct.pack('!h', -1))
+        with pytest.raises(SQLpyException):
+            write_copy([(object(),)], io.BytesIO(), 'binary')
+
+    def test_buffers(self):
+        consumed = []
+
+        def rows():
+            for i in range(1000):
+                consumed.append(i)
+                yield (i, 'x' * 10)
+
+        reader = CopyReader(rows(), buffer_size=100)
+        first = reader.read(10)
+        assert first == b'0,xxxxxxxx'
+        # only the rows of the first buffer have been encoded
+        assert len(consumed) < 20
+        rest = reader.read()
+        assert reader.rows == 1000
+        assert reader.bytes == len(first) + len(rest)
+        assert reader.read(10) == b''
+
+    def test_copy_query(self, tmpdir):
+        queries_file = tmpdir.join('copy.sql')
+        queries_file.write('-- name: insert_users!\nINSERT INTO users (name, age) VALUES %s')
+        sql = Queries(str(queries_file), metrics=True)
+        cur = CopyCursor()
+        result = sql.INSERT_USERS(cur, ((str(i), i) for i in range(500)), copy=True, buffer_size=64)
+        assert result.rows == 500
+        assert result.bytes == len(cur.sink.getvalue())
+        assert cur.statement.startswith('COPY users (name, age) FROM STDIN')
+        assert cur.sink.getvalue().splitlines()[-1] == b'499,499'
+        assert sql.stats()['INSERT_USERS'].calls == 1
+
+    def test_copy_unsupported(self, tmpdir, sqlite_cur):
+        queries_file = tmpdir.join('copy.sql')
+        queries_file.write('-- name: insert_nums!\nINSERT INTO nums VALUES (?)')
+        sql = Queries(str(queries_file))
+        with pytest.raises(SQLpyException):
+            sql.INSERT_NUMS(sqlite_cur, [(1,)], copy=True)
+
+
+class TestBuiltQuery:
+    def test_build_order(self):
+        built = BuiltQuery(['SELECT * FROM testdb', 'WHERE 1=1',
+                            'AND col_2 = %(val_2)s', 'AND col_1 = %(val_1)s'])
+        query, required, unmatched = built.build({'val_1', 'val_2', 'val_3'})
+        assert query == 'SELECT * FROM testdb\nWHERE 1=1\nAND col_2 = %(val_2)s\nAND col_1 = %(val_1)s'
+        assert required == {'val_1', 'val_2'}
+        assert unmatched == {'val_3'}
+
+    def test_build_keeps_substring_lines(self):
+        built = BuiltQuery(['SELECT * FROM testdb', 'WHERE col_1 = %(val_1)s OR col_2 = 1', 'OR col_2 = 1'])
+        query, required, unmatched = built.build({'val_1'})
+        assert query.split('\n') == built.lines
+
+    def test_build_param_many_lines(self):
+        built = BuiltQuery(['SELECT * FROM testdb WHERE 1=1', 'AND col_1 = %(val_1)s',
+                            'AND col_2 = %(val_2)s', 'OR col_3 = %(val_1)s'])
+        query, required, unmatched = built.build({'val_1'})
+        assert query == 'SELECT * FROM testdb WHERE 1=1\nAND col_1 = %(val_1)s\nOR col_3 = %(val_1)s'
+
+    def test_build_first_line_param(self):
+        built = BuiltQuery(['SELECT %(val_1)s AS col_1', 'FROM testdb'])
+        query, required, unmatched = built.build({'val_1'})
+        assert query == 'SELECT %(val_1)s AS col_1\nFROM testdb'
+
+    def test_build_no_parse(self, sql_built_multi, recording_cur, monkeypatch):
+        name, sql_type, fcn = parse_sql_entry(sql_built_multi)
+        monkeypatch.setattr(sqlpy.sqlpy, 'parse_args', None)
+        monkeypatch.setattr(sqlpy.sqlpy, 'scan_params', None)
+        fcn.__built_cache__.maxsize = 0
+        fcn(recording_cur, {'val_1': 1, 'val_3': 2})
+        assert recording_cur.executed[0] == ('SELECT * FROM testdb\nWHERE 1=1\nAND col_1 = %(val_1)s\n'
+                                             'AND (col_2 = %(val_2)s OR col_3 = %(val_3)s)',
+                                             {'val_1': 1, 'val_2': None, 'val_3': 2})
+
+
+class TestBuiltCache:
+    def test_cache_hit(self, sql_built_multi, recording_cur):
+        name, sql_type, fcn = parse_sql_entry(sql_built_multi)
+        fcn(recording_cur, {'val_1': 1})
+        fcn(recording_cur, {'val_1': 2})
+        info = fcn.__built_cache__.info()
+        assert (info.hits, info.misses, info.currsize) == (1, 1, 1)
+        assert recording_cur.executed[0][0] == recording_cur.executed[1][0]
+
+    def test_cache_shapes(self, sql_built_multi, recording_cur):
+        name, sql_type, fcn = parse_sql_entry(sql_built_multi)
+        fcn(recording_cur, {'val_1': 1})
+        fcn(recording_cur, {'val_2': 1})
+        assert fcn.__built_cache__.info().misses == 2
+        assert 'col_1' not in recording_cur.executed[1][0]
+        assert 'col_2' in recording_cur.executed[1][0]
+
+    def test_cache_fills_missing_args(self, sql_built_multi, recording_cur):
+        name, sql_type, fcn = parse_sql_entry(sql_built_multi)
+        for _ in range(2):
+            args = {'val_2': 1}
+            fcn(recording_cur, args)
+            assert args == {'val_2': 1, 'val_3': None}
+
+    def test_cache_size(self, queries_file, recording_cur):
+        sql = Queries(queries_file, built_cache_size=1)
+        fcn = sql.CUSTOMERS_OR_STAFF_IN_COUNTRY
+        fcn(recording_cur, {'countires': ['United States']})
+        fcn(recording_cur, {'extra_name': 'BEN'})
+        assert sql.built_cache_info()['CUSTOMERS_OR_STAFF_IN_COUNTRY'].currsize == 1
+
+    def test_cache_strict(self, queries_file, recording_cur):
+        sql = Queries(queries_file, strict_parse=True)
+        kwdata = {'countires': ['United States'], 'extra_param': 'I should not be here'}
+        for _ in range(2):
+            with pytest.raises(SQLArgumentException):
+                sql.CUSTOMERS_OR_STAFF_IN_COUNTRY(recording_cur, dict(kwdata))
+
+
 @pytest.mark.skipif('TRAVIS' not in os.environ, reason="test data only in Travis")
 @pytest.mark.usefixtures("enable_logging")
 class TestExec:
@@ -273,6 +2024,18 @@ class TestExec:
         output = sql.GET_ACTORS_BY_FIRST_NAME(db_cur, data, n=1)
         assert output[0] == 83
 
+    def test_data1_prepare(self, db_cur, queries_file):
+        sql = Queries(queries_file, prepare=True)
+        data = ('BEN',)
+        assert len(sql.GET_ACTORS_BY_FIRST_NAME(db_cur, data)) == 2
+        assert len(sql.GET_ACTORS_BY_FIRST_NAME(db_cur, data)) == 2
+
+    def test_data1_server_side(self, db_cur, queries_file):
+        sql = Queries(queries_file)
+        data = ('BEN',)
+        output = sql.GET_ACTORS_BY_FIRST_NAME(db_cur, data, stream=True, server_side=True, itersize=1)
+        assert len(list(output)) == 2
+
     def test_data1_1(self, db_cur, queries_file):
         sql = Queries(queries_file)
         data = ('BEN',)
@@ -0,0 +1,167 @@
+import asyncio
+import os
+import sqlite3
+import pytest
+from sqlpy import AsyncQueries, AsyncCursorAdapter, QueryType, SlowQueryLog, SQLpyException
+from sqlpy.sqlpy import parse_sql_definition
+
+
+class FakeAsyncCursor(object):
+    """In process asyncio cursor over a sqlite3 cursor, counting awaited calls."""
+    def __init__(self, cur):
+        self.cur = cur
+        self.calls = []
+
+    async def execute(self, query, args=()):
+        self.calls.append('execute')
+        self.cur.execute(query, args)
+
+    async def executemany(self, query, args):
+        self.calls.append('executemany')
+        self.cur.executemany(query, args)
+
+    async def fetchall(self):
+        self.calls.append('fetchall')
+        return self.cur.fetchall()
+
+    async def fetchone(self):
+        self.calls.append('fetchone')
+        return self.cur.fetchone()
+
+    async def fetchmany(self, size):
+        self.calls.append(size)
+        return self.cur.fetchmany(size)
+
+
+@pytest.fixture
+def run():
+    loop = asyncio.new_event_loop()
+    yield loop.run_until_complete
+    loop.close()
+
+
+@pytest.fixture
+def async_cur():
+    db = sqlite3.connect(':memory:')
+    cur = db.cursor()
+    cur.execute('CREATE TABLE nums (x INTEGER)')
+    cur.executemany('INSERT INTO nums VALUES (?)', [(i,) for i in range(25)])
+    yield FakeAsyncCursor(cur)
+    db.close()
+
+
+@pytest.fixture
+def sql_entries():
+    return [
+        "-- name: select_nums\nSELECT x FROM nums WHERE x >= ? ORDER BY x",
+        "-- name: insert_num!\nINSERT INTO nums VALUES (?)",
+        "-- name: delete_nums!\nDELETE FROM nums WHERE x >= ?",
+    ]
+
+
+@pytest.fixture
+def async_sql(tmpdir, sql_entries):
+    queries_file = tmpdir.join('async_queries.sql')
+    queries_file.write('\n\n'.join(sql_entries))
+    return AsyncQueries(str(queries_file))
+
+
+class TestAsyncQueries:
+    def test_load(self):
+        sql = AsyncQueries(os.path.join(os.getcwd(), 'test_queries.sql'))
+        assert 'sqlpy.AsyncQueries(' in repr(sql)
+        assert asyncio.iscoroutinefunction(sql.TEST_SELECT.func)
+
+    def test_select(self, run, async_sql, async_cur):
+        assert run(async_sql.SELECT_NUMS(async_cur, (22,))) == [(22,), (23,), (24,)]
+        assert run(async_sql.SELECT_NUMS(async_cur, (22,), n=1)) == (22,)
+        assert run(async_sql.SELECT_NUMS(async_cur, (22,), n=2)) == [(22,), (23,)]
+
+    def test_insert(self, run, async_sql, async_cur):
+        assert run(async_sql.INSERT_NUM(async_cur, [(100,), (101,)], many=True))
+        assert run(async_sql.DELETE_NUMS(async_cur, (101,)))
+        assert run(async_sql.SELECT_NUMS(async_cur, (24,))) == [(24,), (100,)]
+        assert async_cur.calls[0] == 'executemany'
+
+    def test_stream(self, run, async_sql, async_cur):
+        async def collect():
+            rows = await async_sql.SELECT_NUMS(async_cur, (15,), stream=True, batch_size=4)
+            return [row async for row in rows]
+        assert run(collect()) == [(i,) for i in range(15, 25)]
+        assert async_cur.calls == ['execute', 4, 4, 4, 4]
+
+    def test_adapter(self, run, async_sql, async_cur):
+        class CountingAdapter(AsyncCursorAdapter):
+            count = 0
+
+            async def execute(self, cur, query, args):
+                self.count += 1
+                await super(CountingAdapter, self).execute(cur, query, args)
+        async_sql.adapter = CountingAdapter()
+        definition = parse_sql_definition("-- name: count_nums\nSELECT count(*) FROM nums")
+        assert definition.sql_type == QueryType.SELECT
+        async_sql.add_query(definition.name, async_sql.make_query(definition))
+        assert run(async_sql.COUNT_NUMS(async_cur, n=1)) == (25,)
+        assert async_sql.adapter.count == 1
+
+    def test_metrics(self, run, tmpdir, sql_entries, async_cur):
+        queries_file = tmpdir.join('async_queries.sql')
+        queries_file.write('\n\n'.join(sql_entries))
+        sql = AsyncQueries(str(queries_file), metrics=True)
+
+        async def collect():
+            rows = await sql.SELECT_NUMS(async_cur, (15,), stream=True, batch_size=4)
+            return [row async for row in rows]
+        run(sql.SELECT_NUMS(async_cur, (22,)))
+        run(collect())
+        run(sql.INSERT_NUM(async_cur, (100,)))
+        stats = sql.stats()
+        assert (stats['SELECT_NUMS'].calls, stats['SELECT_NUMS'].rows) == (2, 3 + 10)
+        assert stats['SELECT_NUMS'].fetch.count == 2
+        assert (stats['INSERT_NUM'].calls, stats['INSERT_NUM'].fetch.count) == (1, 0)
+
+    def test_slow_query_log(self, run, tmpdir, sql_entries, async_cur):
+        opened = []
+
+        class Connection(object):
+            def cursor(self):
+                opened.append(True)
+                return FakeAsyncCursor(async_cur.cur)
+
+        async_cur.connection = Connection()
+        queries_file = tmpdir.join('async_queries.sql')
+        queries_file.write('\n\n'.join(sql_entries))
+        slow_log = SlowQueryLog(0, explain=True, explain_interval=0)
+        sql = AsyncQueries(str(queries_file), slow_query_log=slow_log)
+        run(sql.SELECT_NUMS(async_cur, (24,)))
+        # recorded, but not explained on a sync call to the async connection
+        assert [(entry['name'], entry['plan']) for entry in slow_log.dump()] == [('SELECT_NUMS', None)]
+        assert opened == []
+
+    def test_bind_unsupported(self, async_sql):
+        with pytest.raises(SQLpyException):
+            async_sql.bind(sqlite3.connect)
+
+    def test_batch_unsupported(self, async_sql, async_cur):
+        with pytest.raises(SQLpyException):
+            async_sql.batch(async_cur)
+
+    def test_options_unsupported(self, run, async_sql, async_cur):
+        for options in ({'prepare': True}, {'server_side': True}, {'columnar': True}, {'cache_ttl': 60}):
+            with pytest.raises(SQLpyException):
+                run(async_sql.SELECT_NUMS(async_cur, (24,), **options))
+        with pytest.raises(SQLpyException):
+            run(async_sql.INSERT_NUM(async_cur, [(25,)], many=True, page_size=100))
+        # unset options are accepted
+        assert run(async_sql.SELECT_NUMS(async_cur, (24,), prepare=False, copy=None)) == [(24,)]
+
+    def test_returning_many(self, run, tmpdir, async_cur):
+        queries_file = tmpdir.join('async_queries.sql')
+        queries_file.write('-- name: insert_nums<!>\nINSERT INTO nums VALUES (?) RETURNING x * 10')
+        sql = AsyncQueries(str(queries_file), metrics=True)
+        # executemany keeps no rows per statement, so each row is executed and fetched
+        assert run(sql.INSERT_NUMS(async_cur, [(30,), (31,)], many=True)) == [(300,), (310,)]
+        assert run(sql.INSERT_NUMS(async_cur, [(32,), (33,)], many=True, n=1)) == (320,)
+        assert sql.stats()['INSERT_NUMS'].rows == 4
+        with pytest.raises(SQLpyException):
+            run(sql.INSERT_NUMS(async_cur, [(34,)], many=True, stream=True))